@@ -0,0 +1,116 @@
+# ann_index.py —— 纯 NumPy 的向量近似最近邻（IVF）索引
+# 作用：在预计算好的块向量矩阵上做向量召回（不依赖 faiss 等原生库）
+# 向量要求：已归一化（点积即余弦），与 rag_step1_bm25.encode_chunks 的输出一致；
+#           可以是 float32 矩阵 / memmap，也可以是 emb_quant.QuantizedEmbeddings（float16 / int8）
+
+import os
+import math
+import numpy as np
+from emb_quant import score_rows
+
+
+def top_k_desc(ids, sims, k):
+    """按相似度降序、同分按块号升序取前 k"""
+    if k <= 0 or not len(ids):
+        return ids[:0], sims[:0]
+    if len(sims) > k:
+        kth = np.partition(sims, len(sims) - k)[len(sims) - k]
+        keep = sims >= kth
+        ids, sims = ids[keep], sims[keep]
+    order = np.lexsort((ids, -sims))[:k]
+    return ids[order], sims[order]
+
+
+def exact_search(emb, q, k, mask=None, block=65536):
+    """暴力全扫（小 KB 或 ANN 未建时用），按块分批算点积，emb 可以是 memmap / 量化存储"""
+    n = len(emb)
+    sims = np.empty(n, dtype=np.float32)
+    for s in range(0, n, block):
+        sims[s:s + block] = score_rows(emb, q, slice(s, s + block))
+    ids = np.arange(n, dtype=np.int64)
+    if mask is not None:
+        ids, sims = ids[mask], sims[mask]
+    return top_k_desc(ids, sims, k)
+
+
+class IVFIndex:
+    """
+    IVF（倒排文件）近似最近邻：
+      - 建索引：对归一化向量做球面 k-means 得到 nlist 个簇中心，每个块归到最近的簇
+      - 查询：先和簇中心比相似度，只扫描最近的 nprobe 个簇里的块
+    nlist 默认取 sqrt(N)，单次查询约扫描 nprobe * N / nlist 个块，随 KB 增长是次线性的。
+    """
+    ARRAYS = ("centroids", "list_ptr", "list_ids")
+
+    def __init__(self, centroids, list_ptr, list_ids, nprobe=8):
+        self.centroids = centroids      # float32[nlist, dim]
+        self.list_ptr = list_ptr        # int64[nlist+1]，第 c 个簇的块号在 list_ids[list_ptr[c]:list_ptr[c+1]]
+        self.list_ids = list_ids        # int64[N]，按簇排好的块号（簇内块号递增）
+        self.nprobe = nprobe
+
+    @classmethod
+    def build(cls, emb, nlist=None, nprobe=8, iters=8, sample_per_list=32, seed=0,
+              centroids=None, block=65536):
+        """
+        centroids：传入已有簇中心时跳过 k-means，只把块重新分簇（增量重建时复用旧中心）。
+        """
+        n = len(emb)
+        if centroids is None:
+            nlist = min(n, nlist or max(1, int(round(math.sqrt(n)))))
+            rng = np.random.default_rng(seed)
+            m = min(n, nlist * sample_per_list)
+            sample = np.asarray(emb[np.sort(rng.choice(n, m, replace=False))], dtype=np.float32)
+            centroids = sample[rng.choice(m, nlist, replace=False)].copy()
+            for _ in range(iters):
+                assign = np.argmax(sample @ centroids.T, axis=1)
+                order = np.argsort(assign, kind="stable")
+                counts = np.bincount(assign, minlength=nlist)
+                sums = centroids.copy()   # 空簇保留原中心
+                nonempty = np.flatnonzero(counts)
+                starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[nonempty]
+                sums[nonempty] = np.add.reduceat(sample[order], starts, axis=0)
+                norms = np.linalg.norm(sums, axis=1, keepdims=True)
+                norms[norms == 0] = 1.0
+                centroids = (sums / norms).astype(np.float32)
+        centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        assign = np.empty(n, dtype=np.int64)
+        for s in range(0, n, block):
+            assign[s:s + block] = np.argmax(np.asarray(emb[s:s + block]) @ centroids.T, axis=1)
+        list_ids = np.argsort(assign, kind="stable").astype(np.int64)
+        list_ptr = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=len(centroids)), out=list_ptr[1:])
+        return cls(centroids, list_ptr, list_ids, nprobe=nprobe)
+
+    def search(self, emb, q, k, mask=None, nprobe=None):
+        """返回 (块号数组, 相似度数组)，mask 为可选的块级布尔过滤"""
+        nlist = len(self.centroids)
+        nprobe = min(nprobe or self.nprobe, nlist)
+        csim = self.centroids @ q
+        probe = np.argpartition(-csim, nprobe - 1)[:nprobe] if nprobe < nlist else np.arange(nlist)
+        cand = self._gather(probe, mask)
+        if mask is not None and len(cand) < k and nprobe < nlist:
+            # 过滤后探测到的块不够 k 个：按簇中心相似度逐步加倍 nprobe，直到够数或扫完所有簇
+            need = min(k, int(np.count_nonzero(mask)))
+            order = np.argsort(-csim, kind="stable")
+            while len(cand) < need and nprobe < nlist:
+                nprobe = min(nlist, nprobe * 2)
+                cand = self._gather(order[:nprobe], mask)
+        if not len(cand):
+            return cand, np.zeros(0, dtype=np.float32)
+        cand = np.sort(cand)   # 按行号顺序读，对 memmap 更友好
+        sims = score_rows(emb, q, cand)
+        return top_k_desc(cand, sims, k)
+
+    def _gather(self, probe, mask=None):
+        cand = np.concatenate([self.list_ids[self.list_ptr[c]:self.list_ptr[c + 1]] for c in probe])
+        return cand[mask[cand]] if mask is not None else cand
+
+    def save(self, d):
+        for name in self.ARRAYS:
+            np.save(os.path.join(d, f"ann_{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, d, nprobe=8, mmap_mode="r"):
+        arrs = {name: np.load(os.path.join(d, f"ann_{name}.npy"), mmap_mode=mmap_mode)
+                for name in cls.ARRAYS}
+        return cls(arrs["centroids"], arrs["list_ptr"], arrs["list_ids"], nprobe=nprobe)
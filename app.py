@@ -1,284 +1,473 @@
-# app.py
-import os, time
-from fastapi import FastAPI
-from pydantic import BaseModel
-import requests
-from fastapi.responses import JSONResponse
-from fastapi import Query
-from pathlib import Path
-from rag_step1_bm25 import (
-    KB_DIR, clean_text, debug_split_paragraphs_from_text,
-    debug_pack_paragraphs_to_blocks
-)
-
-# 从你的检索脚本里导入
-from rag_step1_bm25 import get_retriever, USE_SEMANTIC
-
-# ====== 启动时加载检索器 ======
-retriever = get_retriever()
-
-app = FastAPI(title="JD PLUS RAG Service")
-
-@app.middleware("http")
-async def _force_utf8_json(request, call_next):
-    resp = await call_next(request)
-    ctype = resp.headers.get("content-type", "")
-    if ctype.startswith("application/json") and "charset=" not in ctype:
-        resp.headers["content-type"] = "application/json; charset=utf-8"
-    return resp
-
-class AskReq(BaseModel):
-    question: str
-    topk: int = 4
-    session_id: str | None = None
-    meta: dict | None = None
-
-def build_prompt(question: str, hits: list[dict]) -> str:
-    """把命中的片段拼成【证据区】提示词，压住瞎编"""
-    refs = []
-    for i, h in enumerate(hits, 1):
-        # 片段不要太长，避免 token 爆炸
-        snippet = h["text"].replace("\n", " ")
-        if len(snippet) > 400:
-            snippet = snippet[:400] + "…"
-        refs.append(f"[{i}] {h['source']}#段{h['idx']}: {snippet}")
-    context = "\n".join(refs)
-    prompt = f"""你是PLUS生活服务包客服助手。请仅依据【证据区】回答，禁止编造未在证据中的信息。
-- 先给结论（1-3条要点，简洁），再给依据编号（如 [1][3]）
-- 术语统一：运费券=免费寄件；开通=开卡；续约=续费
-- 若证据不足或冲突，请输出：“需要人工复核：原因…”，不要给武断结论
-
-【用户问题】
-{question}
-
-【证据区】
-{context}
-"""
-    return prompt
-
-def call_llm_or_rule(prompt: str, hits: list[dict]) -> str:
-    """优先调用公司内网大模型；没配置就用规则式兜底"""
-    if INTERNAL_LLM_URL and INTERNAL_LLM_TOKEN:
-        try:
-            headers = {"Authorization": f"Bearer {INTERNAL_LLM_TOKEN}"}
-            payload = {"model": "internal-default",
-                       "messages": [{"role": "user", "content": prompt}],
-                       "temperature": 0.2, "max_tokens": 512}
-            r = requests.post(INTERNAL_LLM_URL, json=payload, headers=headers, timeout=20)
-            r.raise_for_status()
-            data = r.json()
-            return (data.get("choices", [{}])[0]
-                        .get("message", {}).get("content", "")).strip() or "（模型无响应）"
-        except Exception as e:
-            print("[warn] 调用内网LLM失败，自动用规则兜底：", e)
-
-    # —— 规则兜底（没有LLM时也能跑通）——
-    if not hits:
-        return "需要人工复核：知识库未命中。"
-    first = hits[0]["text"].replace("\n", " ")
-    if len(first) > 220: first = first[:220] + "…"
-    return f"结论：请参考规则片段[1]。\n依据：[1] {first}"
-
-@app.get("/whoami")
-def whoami():
-    import os
-    return {
-        "app": "rag",
-        "from_file": __file__,
-        "pid": os.getpid(),
-        "port_hint": 8000
-    }
-
-
-@app.get("/health")
-def health():
-    return {"ok": True, "use_semantic": bool(USE_SEMANTIC)}
-
-@app.post("/reload")
-def reload_kb():
-    """当你更新了 kb/ 文件后，调用这个接口热加载"""
-    global retriever
-    retriever = get_retriever()
-    return {"ok": True, "chunks": len(retriever.chunks)}
-
-# ① 把命中片段拼成“证据区”+简单回答（先结论后依据）
-def build_simple_answer(question: str, hits: list[dict]) -> tuple[str, list[dict]]:
-    if not hits:
-        return "需要人工复核：知识库未命中。", []
-
-    # 证据片段（截断，防止太长）
-    citations = []
-    lines = []
-    for i, h in enumerate(hits, 1):
-        snip = h["text"].replace("\n", " ")
-        if len(snip) > 160:
-            snip = snip[:160] + "…"
-        citations.append({"source": h["source"], "idx": h["idx"], "snippet": snip})
-        lines.append(f"[{i}] {h['source']}#段{h['idx']}: {snip}")
-
-    # 简单规则：用 Top1 片段先给结论，再给依据编号
-    answer = (
-        "结论：请参考以下规则要点整理的结论，具体以引用片段为准。\n"
-        f"依据：见 {''.join(f'[{i+1}]' for i in range(len(hits)))}"
-    )
-    return answer, citations
-
-# ② 粗略置信度（Top1分+与Top2差值）
-def calc_confidence(hits: list[dict]) -> float:
-    if not hits:
-        return 0.0
-    s1 = hits[0]["score"]
-    s2 = hits[1]["score"] if len(hits) > 1 else 0.0
-    conf = min(0.95, 0.55 + 0.05*s1 + 0.15*max(0, s1 - s2))
-    return round(conf, 2)
-
-# ③ 把“检索→答案→结构化返回”封装
-def make_response(question: str, hits: list[dict]) -> dict:
-    t0 = time.time()
-    answer, citations = build_simple_answer(question, hits)
-    resp = {
-        "answer": answer,
-        "citations": citations,
-        "confidence": calc_confidence(hits),
-        "latency_ms": int((time.time() - t0) * 1000),
-        "fallback": (answer.startswith("需要人工复核"))
-    }
-    return resp
-
-@app.post("/ask")
-def ask(req: AskReq):
-    hits = retriever.retrieve(req.question, topk=req.topk)
-    return make_response(req.question, hits)
-
-# === 调试用：查看已切好的知识库片段 ===
-@app.get("/kb/chunks")
-def kb_chunks(limit: int = 10, show_chars: int = 120):
-    """
-    返回前 N 条切好的片段预览，便于确认 RAG 是否加载成功。
-    - limit: 返回多少条
-    - show_chars: 每条展示多少字符
-    """
-    try:
-        chunks = getattr(retriever, "chunks", [])
-        preview = []
-        for i, ch in enumerate(chunks[:limit], start=1):
-            txt = (ch.get("text") or "").replace("\n", " ")
-            if len(txt) > show_chars:
-                txt = txt[:show_chars] + "…"
-            preview.append({
-                "top": i,
-                "source": ch.get("source"),
-                "idx": ch.get("idx"),
-                "snippet": txt
-            })
-        return {"total_chunks": len(chunks), "preview": preview}
-    except Exception as e:
-        return {"error": f"/kb/chunks 读取失败: {e}"}
-
-# === 调试用：直接测 RAG 检索命中 ===
-@app.get("/kb/search")
-def kb_search(q: str, topk: int = 4, show_chars: int = 160):
-    """
-    直接调用检索器看看命中是否合理
-    用法示例：/kb/search?q=积分兑换的商品是否可以开发票&topk=3
-    """
-    try:
-        hits = retriever.retrieve(q, topk=topk)
-        out = []
-        for h in hits:
-            txt = (h.get("text") or "").replace("\n", " ")
-            if len(txt) > show_chars:
-                txt = txt[:show_chars] + "…"
-            out.append({
-                "score": h.get("score"),
-                "source": h.get("source"),
-                "idx": h.get("idx"),
-                "snippet": txt
-            })
-        return {"question": q, "hits_count": len(out), "hits": out}
-    except Exception as e:
-        return {"error": f"/kb/search 失败: {e}"}
-
-@app.get("/kb/split_preview")
-def kb_split_preview(
-    file: str = Query(..., description="kb 目录下的文件名（例如 rules_daily_utf8.txt）"),
-    level: str = Query("block", description="预览级别：para=只看段落；block=看打包块（不含重叠）"),
-    show_chars: int = Query(160, description="每条预览展示多少字符"),
-    limit: int = Query(30, description="最多显示多少条")
-):
-    """
-    预览“切分结果”：
-      - level=para  → 只看段落级别 (split_into_paragraphs)
-      - level=block → 段落打包后的块（不含重叠）
-    """
-    path = Path(KB_DIR) / file
-    if not path.exists():
-        return {"ok": False, "error": f"文件不存在：{path}"}
-
-    try:
-        text = path.read_text(encoding="utf-8", errors="ignore")
-        paras = debug_split_paragraphs_from_text(text)
-        if level == "para":
-            items = paras
-        else:
-            blocks = debug_pack_paragraphs_to_blocks(paras)
-            items = blocks
-
-        preview = []
-        for i, item in enumerate(items[:limit], start=1):
-            one = item.replace("\n", " ")
-            if show_chars and len(one) > show_chars:
-                one = one[:show_chars] + "…"
-            preview.append({"top": i, "snippet": one})
-
-        return {
-            "ok": True,
-            "file": file,
-            "level": level,
-            "total_items": len(items),
-            "preview": preview
-        }
-    except Exception as e:
-        return {"ok": False, "error": f"/kb/split_preview 失败: {e}"}
-
-
-@app.get("/kb/chunk_fulltext")
-def kb_chunk_fulltext(
-    source: str = Query(..., description="kb 文件名（如 rules_daily_utf8.txt）"),
-    idx: int = Query(..., description="块的 1-based 段号（与你命中里的 idx 一致）")
-):
-    """
-    根据（source, idx）返回最终块的完整正文（就是 retriever 用的块文本）。
-    用于：Coze 看到某个命中后，来这里查整个块的原文（不用再手翻 kb 文件）。
-    """
-    try:
-        chunks = getattr(retriever, "chunks", [])
-        for c in chunks:
-            if c.get("source") == source and int(c.get("idx", -1)) == int(idx):
-                return {
-                    "ok": True,
-                    "source": source,
-                    "idx": idx,
-                    "text": c.get("text", "")
-                }
-        return {"ok": False, "error": f"未找到：{source}#段{idx}"}
-    except Exception as e:
-        return {"ok": False, "error": f"/kb/chunk_fulltext 失败: {e}"}
-
-@app.post("/ask_debug")
-def ask_debug(req: AskReq):
-    hits = retriever.retrieve(req.question, topk=req.topk)
-    # 原样返回命中，便于你调bm25
-    return JSONResponse({
-        "hits": [
-            {
-                "rank": i+1,
-                "score": h["score"],
-                "source": h["source"],
-                "idx": h["idx"],
-                "text": (h["text"][:300] + "…") if len(h["text"]) > 300 else h["text"]
-            } for i, h in enumerate(hits)
-        ]
-
-    }, media_type="application/json; charset=utf-8")
-
+# app.py
+import os, time, threading, datetime
+from fastapi import FastAPI
+from pydantic import BaseModel
+import requests
+from fastapi.responses import JSONResponse, PlainTextResponse
+from fastapi import Query
+from pathlib import Path
+from rag_step1_bm25 import (
+    KB_DIR, clean_text, debug_split_paragraphs_from_text,
+    debug_pack_paragraphs_to_blocks
+)
+
+# 从你的检索脚本里导入
+from rag_step1_bm25 import (
+    get_retriever, refresh_retriever, preload_sem_model, semantic_status, USE_SEMANTIC,
+    query_cache, USE_QUERY_CACHE, normalize_query, RAG_FALLBACKS, tokenizer,
+    INDEX_SHARED, current_index_key
+)
+from singleflight import SingleFlight
+import metrics
+
+# ====== 启动时加载检索器 ======
+_t0 = time.time()
+retriever = get_retriever()
+
+# ====== 索引热切换：后台重建，建好后整体替换 retriever 引用 ======
+# 处理请求时只读一次 retriever 引用，重建期间继续用旧索引；替换是一次赋值，不会看到半成品。
+_index_lock = threading.Lock()   # 只保护 index_state 与替换动作，检索本身不加锁
+index_state = {
+    "version": 1,                # 代际计数：每换一次新索引 +1
+    "building": False,
+    "progress": None,            # {"stage", "done", "total"}
+    "last_build_ms": int((time.time() - _t0) * 1000),
+    "last_build_at": datetime.datetime.now().isoformat(timespec="seconds"),
+    "last_summary": {"mode": "startup"},
+    "last_error": None,
+}
+
+# 多 worker 共享索引（INDEX_SHARED）：/reload 只会落到其中一个 worker，
+# 其余 worker 每隔 INDEX_SYNC_INTERVAL 秒看一眼 CURRENT，发现换了新索引就在后台跟进（直接加载已建好的缓存）
+INDEX_SYNC_INTERVAL = float(os.getenv("INDEX_SYNC_INTERVAL", "2"))   # 秒，<=0 不检查
+_sync_state = {"checked_at": 0.0, "seen_key": None}
+
+def _sync_shared_index():
+    now = time.time()
+    if not INDEX_SHARED or INDEX_SYNC_INTERVAL <= 0 or now - _sync_state["checked_at"] < INDEX_SYNC_INTERVAL:
+        return
+    _sync_state["checked_at"] = now
+    key = current_index_key()
+    if not key or not retriever.cache_key or key in (retriever.cache_key, _sync_state["seen_key"]):
+        return
+    _sync_state["seen_key"] = key   # 每个新 key 只跟进一次，跟进失败不反复重试
+    print(f"[reload] 其他 worker 已更新索引（{key[:12]}），后台跟进")
+    start_rebuild(full=False)
+
+def current_retriever():
+    _sync_shared_index()
+    return retriever
+
+# 并发相同问题只检索一次，其余请求等结果（键含索引代际，换索引后不会拿到旧结果）
+_retrieve_flight = SingleFlight()
+
+def retrieve_coalesced(question: str, topk: int = 4) -> list[dict]:
+    r = current_retriever()
+    key = (r.version, normalize_query(question), topk)
+    hits, shared = _retrieve_flight.do(key, lambda: r.retrieve(question, topk=topk))
+    return [dict(h) for h in hits] if shared else hits
+
+# ====== 指标（/metrics，Prometheus 文本格式）======
+REQUEST_SECONDS = metrics.Histogram("rag_request_seconds", "RAG 服务请求总耗时（秒）", ["path"])
+metrics.CallbackMetric("rag_coalesced_total", "并发相同问题被合并的请求数", "counter", [],
+                       lambda: {(): _retrieve_flight.coalesced})
+# 只读当前已加载的索引：抓取 /metrics 不能触发共享索引同步
+metrics.CallbackMetric("rag_index_chunks", "当前索引的知识块数", "gauge", [],
+                       lambda: {(): len(retriever.chunks) if retriever is not None else 0})
+
+def _rebuild_worker(full: bool):
+    global retriever
+    t0 = time.time()
+
+    def _progress(stage, done, total):
+        index_state["progress"] = {"stage": stage, "done": done, "total": total}
+
+    try:
+        if full:
+            new = get_retriever(progress=_progress)
+            summary = {"mode": "full"}
+        else:
+            new, summary = refresh_retriever(retriever, progress=_progress)
+        with _index_lock:
+            if new is not retriever:
+                retriever = new
+                index_state["version"] += 1
+                query_cache.clear()   # 旧索引的检索结果作废
+            index_state["last_build_ms"] = int((time.time() - t0) * 1000)
+            index_state["last_build_at"] = datetime.datetime.now().isoformat(timespec="seconds")
+            index_state["last_summary"] = {**summary, "elapsed_ms": index_state["last_build_ms"]}
+            index_state["last_error"] = None
+    except Exception as e:
+        print("[reload] 后台重建失败，继续使用旧索引：", repr(e))
+        index_state["last_error"] = repr(e)
+    finally:
+        with _index_lock:
+            index_state["building"] = False
+            index_state["progress"] = None
+
+def start_rebuild(full: bool = False):
+    """启动后台重建；已有重建在跑时返回 None"""
+    with _index_lock:
+        if index_state["building"]:
+            return None
+        index_state["building"] = True
+        index_state["progress"] = {"stage": "scan", "done": 0, "total": 0}
+    t = threading.Thread(target=_rebuild_worker, args=(full,), name="kb-rebuild", daemon=True)
+    t.start()
+    return t
+
+app = FastAPI(title="JD PLUS RAG Service")
+
+# 语义模型默认在服务起来后后台预热；未预热完成前的请求会在首次用到时等待加载
+# SEM_PRELOAD=sync：import 时就同步加载（gunicorn --preload 时只在主进程加载一次，fork 出的 worker 共享模型权重）
+SEM_PRELOAD = os.getenv("SEM_PRELOAD", "1").lower()
+if SEM_PRELOAD == "sync":
+    preload_sem_model(background=False)
+
+@app.on_event("startup")
+async def _on_start():
+    if SEM_PRELOAD != "0":
+        preload_sem_model(background=True)   # 已加载过时什么也不做
+
+@app.middleware("http")
+async def _observe_latency(request, call_next):
+    t0 = time.perf_counter()
+    resp = await call_next(request)
+    route = request.scope.get("route")
+    if route is not None:   # 只统计已注册的路由，避免乱七八糟的 404 路径撑爆标签
+        REQUEST_SECONDS.observe(time.perf_counter() - t0, path=route.path)
+    return resp
+
+@app.middleware("http")
+async def _force_utf8_json(request, call_next):
+    resp = await call_next(request)
+    ctype = resp.headers.get("content-type", "")
+    if ctype.startswith("application/json") and "charset=" not in ctype:
+        resp.headers["content-type"] = "application/json; charset=utf-8"
+    return resp
+
+class AskReq(BaseModel):
+    question: str
+    topk: int = 4
+    session_id: str | None = None
+    meta: dict | None = None
+
+class AskBatchReq(BaseModel):
+    questions: list[str]
+    topk: int = 4
+    debug: bool = False   # True：每条返回与 /ask_debug 相同结构的 hits；False：与 /ask 相同的答案结构
+
+def build_prompt(question: str, hits: list[dict]) -> str:
+    """把命中的片段拼成【证据区】提示词，压住瞎编"""
+    refs = []
+    for i, h in enumerate(hits, 1):
+        # 片段不要太长，避免 token 爆炸
+        snippet = h["text"].replace("\n", " ")
+        if len(snippet) > 400:
+            snippet = snippet[:400] + "…"
+        refs.append(f"[{i}] {h['source']}#段{h['idx']}: {snippet}")
+    context = "\n".join(refs)
+    prompt = f"""你是PLUS生活服务包客服助手。请仅依据【证据区】回答，禁止编造未在证据中的信息。
+- 先给结论（1-3条要点，简洁），再给依据编号（如 [1][3]）
+- 术语统一：运费券=免费寄件；开通=开卡；续约=续费
+- 若证据不足或冲突，请输出：“需要人工复核：原因…”，不要给武断结论
+
+【用户问题】
+{question}
+
+【证据区】
+{context}
+"""
+    return prompt
+
+def call_llm_or_rule(prompt: str, hits: list[dict]) -> str:
+    """优先调用公司内网大模型；没配置就用规则式兜底"""
+    if INTERNAL_LLM_URL and INTERNAL_LLM_TOKEN:
+        try:
+            headers = {"Authorization": f"Bearer {INTERNAL_LLM_TOKEN}"}
+            payload = {"model": "internal-default",
+                       "messages": [{"role": "user", "content": prompt}],
+                       "temperature": 0.2, "max_tokens": 512}
+            r = requests.post(INTERNAL_LLM_URL, json=payload, headers=headers, timeout=20)
+            r.raise_for_status()
+            data = r.json()
+            return (data.get("choices", [{}])[0]
+                        .get("message", {}).get("content", "")).strip() or "（模型无响应）"
+        except Exception as e:
+            print("[warn] 调用内网LLM失败，自动用规则兜底：", e)
+
+    # —— 规则兜底（没有LLM时也能跑通）——
+    if not hits:
+        return "需要人工复核：知识库未命中。"
+    first = hits[0]["text"].replace("\n", " ")
+    if len(first) > 220: first = first[:220] + "…"
+    return f"结论：请参考规则片段[1]。\n依据：[1] {first}"
+
+@app.get("/whoami")
+def whoami():
+    import os
+    return {
+        "app": "rag",
+        "from_file": __file__,
+        "pid": os.getpid(),
+        "port_hint": 8000
+    }
+
+
+@app.get("/health")
+def health():
+    return {
+        "ok": True,
+        "use_semantic": bool(USE_SEMANTIC),
+        "semantic": semantic_status(),
+        "tokenizer": tokenizer.status(),
+        "index": {
+            "version": index_state["version"],
+            "chunks": len(current_retriever().chunks),
+            "shared": INDEX_SHARED,
+            "cache_key": (retriever.cache_key or "")[:20] or None,
+            "building": index_state["building"],
+            "progress": index_state["progress"],
+            "last_build_ms": index_state["last_build_ms"],
+            "last_build_at": index_state["last_build_at"],
+            "last_error": index_state["last_error"],
+        },
+    }
+
+@app.post("/reload")
+def reload_kb(full: bool = False, wait: bool = False):
+    """
+    当你更新了 kb/ 文件后，调用这个接口热加载。
+    默认增量：只重新处理新增/修改过的文件；full=true 时全量重建。
+    重建在后台线程里进行，建好后原子替换，期间 /ask 照常用旧索引；
+    wait=true 时等重建完成再返回变更摘要（脚本里用）。
+    进度与结果见 /health。
+    """
+    t = start_rebuild(full=full)
+    if t is None:
+        return {"ok": True, "accepted": False, "building": True,
+                "version": index_state["version"], "progress": index_state["progress"]}
+    if wait:
+        t.join()
+        return {"ok": index_state["last_error"] is None, "accepted": True,
+                "version": index_state["version"], "chunks": len(current_retriever().chunks),
+                "summary": index_state["last_summary"], "error": index_state["last_error"]}
+    return {"ok": True, "accepted": True, "building": True, "version": index_state["version"]}
+
+@app.get("/metrics")
+def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/cache/stats")
+def cache_stats():
+    """检索结果缓存的命中/未命中计数与占用"""
+    return {"ok": True, "enabled": USE_QUERY_CACHE, "index_version": index_state["version"],
+            **query_cache.stats(), "coalesce": _retrieve_flight.stats()}
+
+@app.post("/cache/clear")
+def cache_clear():
+    query_cache.clear()
+    return {"ok": True}
+
+# ① 把命中片段拼成“证据区”+简单回答（先结论后依据）
+def build_simple_answer(question: str, hits: list[dict]) -> tuple[str, list[dict]]:
+    if not hits:
+        return "需要人工复核：知识库未命中。", []
+
+    # 证据片段（截断，防止太长）
+    citations = []
+    lines = []
+    for i, h in enumerate(hits, 1):
+        snip = h["text"].replace("\n", " ")
+        if len(snip) > 160:
+            snip = snip[:160] + "…"
+        citations.append({"source": h["source"], "idx": h["idx"], "snippet": snip})
+        lines.append(f"[{i}] {h['source']}#段{h['idx']}: {snip}")
+
+    # 简单规则：用 Top1 片段先给结论，再给依据编号
+    answer = (
+        "结论：请参考以下规则要点整理的结论，具体以引用片段为准。\n"
+        f"依据：见 {''.join(f'[{i+1}]' for i in range(len(hits)))}"
+    )
+    return answer, citations
+
+# ② 粗略置信度（Top1分+与Top2差值）
+def calc_confidence(hits: list[dict]) -> float:
+    if not hits:
+        return 0.0
+    s1 = hits[0]["score"]
+    s2 = hits[1]["score"] if len(hits) > 1 else 0.0
+    conf = min(0.95, 0.55 + 0.05*s1 + 0.15*max(0, s1 - s2))
+    return round(conf, 2)
+
+# ③ 把“检索→答案→结构化返回”封装
+def make_response(question: str, hits: list[dict], t0: float | None = None) -> dict:
+    """t0：请求开始时间（含检索）；不传则只计组装答案的耗时"""
+    t0 = t0 or time.time()
+    answer, citations = build_simple_answer(question, hits)
+    resp = {
+        "answer": answer,
+        "citations": citations,
+        "confidence": calc_confidence(hits),
+        "latency_ms": int((time.time() - t0) * 1000),
+        "fallback": (answer.startswith("需要人工复核"))
+    }
+    if resp["fallback"]:
+        RAG_FALLBACKS.inc(reason="no_evidence")
+    return resp
+
+@app.post("/ask")
+def ask(req: AskReq):
+    t0 = time.time()
+    hits = retrieve_coalesced(req.question, topk=req.topk)
+    return make_response(req.question, hits, t0=t0)
+
+# === 调试用：查看已切好的知识库片段 ===
+@app.get("/kb/chunks")
+def kb_chunks(limit: int = 10, show_chars: int = 120):
+    """
+    返回前 N 条切好的片段预览，便于确认 RAG 是否加载成功。
+    - limit: 返回多少条
+    - show_chars: 每条展示多少字符
+    """
+    try:
+        chunks = current_retriever().chunks
+        preview = []
+        for i in range(min(max(limit, 0), len(chunks))):
+            txt = chunks.text(i).replace("\n", " ")
+            if len(txt) > show_chars:
+                txt = txt[:show_chars] + "…"
+            preview.append({
+                "top": i + 1,
+                "source": chunks.source(i),
+                "idx": chunks.idx(i),
+                "snippet": txt
+            })
+        return {"total_chunks": len(chunks), "preview": preview}
+    except Exception as e:
+        return {"error": f"/kb/chunks 读取失败: {e}"}
+
+# === 调试用：直接测 RAG 检索命中 ===
+@app.get("/kb/search")
+def kb_search(q: str, topk: int = 4, show_chars: int = 160):
+    """
+    直接调用检索器看看命中是否合理
+    用法示例：/kb/search?q=积分兑换的商品是否可以开发票&topk=3
+    """
+    try:
+        hits = current_retriever().retrieve(q, topk=topk)
+        out = []
+        for h in hits:
+            txt = (h.get("text") or "").replace("\n", " ")
+            if len(txt) > show_chars:
+                txt = txt[:show_chars] + "…"
+            out.append({
+                "score": h.get("score"),
+                "source": h.get("source"),
+                "idx": h.get("idx"),
+                "snippet": txt
+            })
+        return {"question": q, "hits_count": len(out), "hits": out}
+    except Exception as e:
+        return {"error": f"/kb/search 失败: {e}"}
+
+@app.get("/kb/split_preview")
+def kb_split_preview(
+    file: str = Query(..., description="kb 目录下的文件名（例如 rules_daily_utf8.txt）"),
+    level: str = Query("block", description="预览级别：para=只看段落；block=看打包块（不含重叠）"),
+    show_chars: int = Query(160, description="每条预览展示多少字符"),
+    limit: int = Query(30, description="最多显示多少条")
+):
+    """
+    预览“切分结果”：
+      - level=para  → 只看段落级别 (split_into_paragraphs)
+      - level=block → 段落打包后的块（不含重叠）
+    """
+    path = Path(KB_DIR) / file
+    if not path.exists():
+        return {"ok": False, "error": f"文件不存在：{path}"}
+
+    try:
+        text = path.read_text(encoding="utf-8", errors="ignore")
+        paras = debug_split_paragraphs_from_text(text)
+        if level == "para":
+            items = paras
+        else:
+            blocks = debug_pack_paragraphs_to_blocks(paras)
+            items = blocks
+
+        preview = []
+        for i, item in enumerate(items[:limit], start=1):
+            one = item.replace("\n", " ")
+            if show_chars and len(one) > show_chars:
+                one = one[:show_chars] + "…"
+            preview.append({"top": i, "snippet": one})
+
+        return {
+            "ok": True,
+            "file": file,
+            "level": level,
+            "total_items": len(items),
+            "preview": preview
+        }
+    except Exception as e:
+        return {"ok": False, "error": f"/kb/split_preview 失败: {e}"}
+
+
+@app.get("/kb/chunk_fulltext")
+def kb_chunk_fulltext(
+    source: str = Query(..., description="kb 文件名（如 rules_daily_utf8.txt）"),
+    idx: int = Query(..., description="块的 1-based 段号（与你命中里的 idx 一致）")
+):
+    """
+    根据（source, idx）返回最终块的完整正文（就是 retriever 用的块文本）。
+    用于：Coze 看到某个命中后，来这里查整个块的原文（不用再手翻 kb 文件）。
+    """
+    try:
+        c = current_retriever().chunks.get(source, idx)
+        if c is not None:
+            return {
+                "ok": True,
+                "source": source,
+                "idx": idx,
+                "text": c["text"]
+            }
+        return {"ok": False, "error": f"未找到：{source}#段{idx}"}
+    except Exception as e:
+        return {"ok": False, "error": f"/kb/chunk_fulltext 失败: {e}"}
+
+def _debug_hits(hits: list[dict]) -> list[dict]:
+    return [
+        {
+            "rank": i+1,
+            "score": h["score"],
+            "source": h["source"],
+            "idx": h["idx"],
+            "text": (h["text"][:300] + "…") if len(h["text"]) > 300 else h["text"]
+        } for i, h in enumerate(hits)
+    ]
+
+@app.post("/ask_debug")
+def ask_debug(req: AskReq):
+    hits = retrieve_coalesced(req.question, topk=req.topk)
+    # 原样返回命中，便于你调bm25
+    return JSONResponse({
+        "hits": _debug_hits(hits)
+
+    }, media_type="application/json; charset=utf-8")
+
+@app.post("/ask_batch")
+def ask_batch(req: AskBatchReq):
+    """
+    批量问答（离线评测 / 夜间质检用）：一次请求带多条问题，
+    检索端一起分词、一次编码、矩阵打分，结果按输入顺序返回。
+    """
+    t0 = time.time()
+    all_hits = current_retriever().retrieve_batch(req.questions, topk=req.topk)
+    if req.debug:
+        results = [{"question": q, "hits": _debug_hits(hits)} for q, hits in zip(req.questions, all_hits)]
+    else:
+        results = [{"question": q, **make_response(q, hits, t0=t0)} for q, hits in zip(req.questions, all_hits)]
+    return JSONResponse({"count": len(results), "results": results},
+                        media_type="application/json; charset=utf-8")
+
@@ -0,0 +1,134 @@
+# bench_emb_quant.py —— 块向量量化存储（float16 / int8）对比 float32 的基准
+# 作用：同一批向量分别按 float32 / float16 / int8 存放，比较内存占用、全表扫描 / 候选重排的延迟，
+#       以及排序与 float32 的一致程度（top-k 重合率、top-1 一致率、重排顺序一致率、余弦最大误差），输出 JSON。
+#
+# 用法示例：
+#   python bench_emb_quant.py --n 200000 --dim 512 --out quant.json        # 合成向量（带簇结构，无需模型）
+#   python bench_emb_quant.py --source kb --queries 100                     # 用 KB_DIR 的真实块 + 语义模型编码
+
+import sys
+import json
+import time
+import argparse
+
+import numpy as np
+
+from emb_quant import EMB_KINDS, store_embeddings, score_rows
+from ann_index import exact_search
+
+
+# ===================== 向量来源 =====================
+def synthetic(n, dim, n_queries, seed):
+    """簇状分布的归一化向量（真实句向量大多聚在若干主题附近，近邻之间分差很小，更能暴露量化误差）"""
+    rng = np.random.default_rng(seed)
+    n_clusters = max(1, int(np.sqrt(n)))
+    centers = rng.standard_normal((n_clusters, dim)).astype(np.float32)
+    emb = np.empty((n, dim), dtype=np.float32)
+    block = 65536
+    for s in range(0, n, block):
+        m = min(block, n - s)
+        x = centers[rng.integers(0, n_clusters, m)] + 0.6 * rng.standard_normal((m, dim)).astype(np.float32)
+        emb[s:s + m] = x / np.linalg.norm(x, axis=1, keepdims=True)
+    base = emb[rng.integers(0, n, n_queries)]
+    q = base + 0.5 * rng.standard_normal(base.shape).astype(np.float32) / np.sqrt(dim)
+    q /= np.linalg.norm(q, axis=1, keepdims=True)
+    return emb, q.astype(np.float32)
+
+
+def from_kb(n_queries, seed):
+    """KB_DIR 里的真实块 + 语义模型；查询取块文本的前若干字"""
+    import rag_step1_bm25 as rag
+    r = rag.get_retriever(use_cache=False)
+    if r.emb is None:
+        raise SystemExit("[bench] 语义模型不可用，无法用 --source kb")
+    emb = np.ascontiguousarray(r.emb[:], dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    rows = rng.integers(0, len(r.chunks), n_queries)
+    q = rag.encode_queries([r.chunks.text(int(i))[:20] for i in rows])
+    return emb, q
+
+
+# ===================== 测量 =====================
+def _ms(xs):
+    a = np.asarray(xs) * 1000
+    return {"p50_ms": round(float(np.percentile(a, 50)), 3), "p95_ms": round(float(np.percentile(a, 95)), 3)}
+
+
+def run(emb, queries, topk, n_cand, seed):
+    rng = np.random.default_rng(seed + 1)
+    cands = [np.sort(rng.choice(len(emb), min(n_cand, len(emb)), replace=False)) for _ in queries]
+    ref_top = [exact_search(emb, q, topk)[0] for q in queries]
+    ref_rerank = [c[np.argsort(-score_rows(emb, q, c), kind="stable")] for q, c in zip(queries, cands)]
+
+    out = {}
+    for kind in EMB_KINDS:
+        t0 = time.perf_counter()
+        store = store_embeddings(emb, kind)
+        build_s = time.perf_counter() - t0
+
+        scan, rerank = [], []
+        overlap, top1, same_order = [], [], []
+        for q, c, ref, ref_r in zip(queries, cands, ref_top, ref_rerank):
+            t = time.perf_counter()
+            ids, _ = exact_search(store, q, topk)
+            scan.append(time.perf_counter() - t)
+            overlap.append(len(set(ids.tolist()) & set(ref.tolist())) / max(1, len(ref)))
+            top1.append(bool(len(ids) and ids[0] == ref[0]))
+
+            t = time.perf_counter()
+            sims = score_rows(store, q, c)
+            order = c[np.argsort(-sims, kind="stable")]
+            rerank.append(time.perf_counter() - t)
+            same_order.append(bool(np.array_equal(order[:topk], ref_r[:topk])))
+
+        sample = np.arange(0, len(emb), max(1, len(emb) // 20000))
+        err = np.abs(np.asarray(store[sample]) @ queries[0] - emb[sample] @ queries[0]).max()
+        out[kind] = {
+            "bytes": int(store.nbytes),
+            "bytes_ratio": round(store.nbytes / emb.nbytes, 3),
+            "build_s": round(build_s, 3),
+            "scan": _ms(scan),
+            "rerank": {**_ms(rerank), "candidates": n_cand},
+            f"top{topk}_overlap": round(float(np.mean(overlap)), 4),
+            "top1_agree": round(float(np.mean(top1)), 4),
+            f"rerank_top{topk}_same_order": round(float(np.mean(same_order)), 4),
+            "max_cos_err": float(err),
+        }
+        print(f"[bench] {kind}: {out[kind]['bytes'] / 2**20:.1f} MB，全表扫描 p50 {out[kind]['scan']['p50_ms']} ms，"
+              f"top{topk} 重合 {out[kind][f'top{topk}_overlap']}", file=sys.stderr)
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser(description="块向量量化存储基准")
+    ap.add_argument("--source", default="synthetic", choices=["synthetic", "kb"])
+    ap.add_argument("--n", type=int, default=100000, help="合成向量条数")
+    ap.add_argument("--dim", type=int, default=512)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--topk", type=int, default=10)
+    ap.add_argument("--candidates", type=int, default=30, help="模拟 BM25 初筛后交给重排的候选数")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--out", default=None, help="结果 JSON 路径（默认打印到标准输出）")
+    args = ap.parse_args()
+
+    if args.source == "kb":
+        emb, queries = from_kb(args.queries, args.seed)
+    else:
+        emb, queries = synthetic(args.n, args.dim, args.queries, args.seed)
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {"source": args.source, "n": len(emb), "dim": int(emb.shape[1]),
+                   "queries": len(queries), "topk": args.topk, "seed": args.seed},
+        "results": run(emb, queries, args.topk, args.candidates, args.seed),
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"[bench] 结果已写入 {args.out}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# bench_retrieval.py —— 检索性能基准（可复现）
+# 作用：按指定规模生成合成的中文规则知识库（编号标题 + Q&A 两种写法，走 split_into_paragraphs 的各个分支），
+#       建索引并回放一组查询，输出建索引耗时、内存占用、单查询 p50/p95/p99 延迟和 QPS（BM25 / hybrid），
+#       结果写成 JSON，方便不同版本之间对比。
+#
+# 用法示例：
+#   python bench_retrieval.py --chunks 1000,10000,100000 --modes bm25,hybrid --out bench.json
+#   python bench_retrieval.py --chunks 500000 --modes bm25 --queries 500
+# 每个规模在独立子进程里跑，内存峰值互不影响；同样的 --seed 生成同样的 KB 和查询。
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import subprocess
+import tempfile
+
+# ===================== 合成语料 =====================
+TOPICS = ["洗车", "积分", "会员", "续约", "开通", "退款", "发票", "运费券", "年卡", "门店",
+          "兑换", "权益", "免费寄件", "生活服务包", "优惠券", "账户", "客服", "订单", "保养", "代驾"]
+VERBS = ["过期", "下发", "使用", "退回", "领取", "延期", "转赠", "兑换", "开具", "取消"]
+TEMPLATES = [
+    "{a}自领取之日起{n}天内有效，过期后不可{v}。",
+    "开通{a}后，{b}将在{n}个工作日内下发至账户。",
+    "若{a}已使用，则不支持{v}；如有疑问请联系{b}。",
+    "{a}每月可使用{n}次，{b}不计入次数。",
+    "{a}与{b}不可同时{v}，以最后一次操作为准。",
+    "用户在{b}页面可查看{a}的剩余次数和有效期。",
+    "{a}到期前{n}天系统会提醒用户{v}。",
+    "同一账户每年最多{v}{n}次{a}，超出部分不予处理。",
+]
+QUERY_TEMPLATES = [
+    "{a}多久{v}", "{a}可以{v}吗", "为什么{a}没有{v}", "{a}和{b}能一起用吗",
+    "Q：{a}{v}之后{b}还能用吗？", "您好请问{a}怎么{v}", "{b}里的{a}什么时候{v}",
+]
+
+
+def _sentence(rng):
+    a, b = rng.sample(TOPICS, 2)
+    return rng.choice(TEMPLATES).format(a=a, b=b, v=rng.choice(VERBS), n=rng.randint(1, 90))
+
+
+def _para(rng, lo=2, hi=5):
+    return "".join(_sentence(rng) for _ in range(rng.randint(lo, hi)))
+
+
+def gen_file_text(rng, n_sections):
+    """一个 KB 文件：编号标题（1. / 1.1 / （一） / 一、）段落与 Q&A 交替出现"""
+    lines = []
+    for i in range(1, n_sections + 1):
+        style = rng.random()
+        a, b = rng.sample(TOPICS, 2)
+        if style < 0.45:
+            lines.append(f"{i}. {a}{b}规则")
+            for j in range(1, rng.randint(2, 4)):
+                lines.append(f"{i}.{j} {_para(rng)}")
+        elif style < 0.8:
+            lines.append(f"Q：{a}多久{rng.choice(VERBS)}？")
+            lines.append(f"A：{_para(rng, 1, 4)}")
+        elif style < 0.9:
+            lines.append(f"（{'一二三四五六七八九十'[i % 10]}）{a}说明")
+            lines.append(_para(rng))
+        else:
+            lines.append(f"- {_para(rng, 1, 2)}")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def gen_queries(rng, n):
+    out = []
+    for _ in range(n):
+        a, b = rng.sample(TOPICS, 2)
+        out.append(rng.choice(QUERY_TEMPLATES).format(a=a, b=b, v=rng.choice(VERBS)))
+    return out
+
+
+def gen_kb(kb_dir, target_chunks, seed, sections_per_file=400):
+    """按目标块数生成 KB：先生成一个样本文件量出“每节约多少块”，再按比例写满"""
+    import rag_step1_bm25 as rag
+    rng = random.Random(seed)
+    os.makedirs(kb_dir, exist_ok=True)
+    probe = os.path.join(kb_dir, "rules_00000.txt")
+    with open(probe, "w", encoding="utf-8") as f:
+        f.write(gen_file_text(rng, sections_per_file))
+    per_section = max(1e-3, len(rag.read_file_chunks(probe)) / sections_per_file)
+    total_sections = max(1, int(round(target_chunks / per_section)))
+    remaining = total_sections - sections_per_file
+    k = 1
+    while remaining > 0:
+        n = min(sections_per_file, remaining)
+        with open(os.path.join(kb_dir, f"rules_{k:05d}.txt"), "w", encoding="utf-8") as f:
+            f.write(gen_file_text(rng, n))
+        remaining -= n
+        k += 1
+    if total_sections < sections_per_file:   # 目标很小：样本文件截短重写
+        with open(probe, "w", encoding="utf-8") as f:
+            f.write(gen_file_text(random.Random(seed), total_sections))
+
+
+# ===================== 测量 =====================
+def _rss_mb():
+    """当前常驻内存（MB）；非 Linux 退回峰值"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _peak_rss_mb():
+    import resource
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _index_bytes(r):
+    import numpy as np
+    out = {"bm25": sum(int(getattr(r.bm25, a).nbytes) for a in r.bm25.ARRAYS)}
+    out["emb"] = int(r.emb.nbytes) if r.emb is not None else 0
+    out["ann"] = sum(int(getattr(r.ann, a).nbytes) for a in r.ann.ARRAYS) if r.ann is not None else 0
+    out["text"] = int(r.chunks.nbytes)
+    return out
+
+
+def _latency_stats(lat_s, wall_s):
+    import numpy as np
+    a = np.asarray(lat_s) * 1000
+    return {
+        "n": len(a),
+        "mean_ms": round(float(a.mean()), 3),
+        "p50_ms": round(float(np.percentile(a, 50)), 3),
+        "p95_ms": round(float(np.percentile(a, 95)), 3),
+        "p99_ms": round(float(np.percentile(a, 99)), 3),
+        "max_ms": round(float(a.max()), 3),
+        "qps": round(len(a) / wall_s, 1) if wall_s > 0 else None,
+    }
+
+
+def run_one(args, target_chunks, kb_dir):
+    """子进程里跑一个规模：生成 KB → 建索引 → 各模式回放查询"""
+    os.environ["KB_DIR"] = kb_dir
+    os.environ["INDEX_CACHE"] = "0"
+    os.environ["QUERY_CACHE"] = "0"     # 测的是检索本身，不让结果缓存掩盖延迟
+    if "hybrid" not in args.modes and "dense" not in args.modes:
+        os.environ.setdefault("USE_SEMANTIC", "0")
+    import rag_step1_bm25 as rag
+
+    t0 = time.perf_counter()
+    gen_kb(kb_dir, target_chunks, args.seed)
+    gen_s = time.perf_counter() - t0
+
+    rss0 = _rss_mb()
+    t0 = time.perf_counter()
+    r = rag.get_retriever(use_cache=False)
+    build_s = time.perf_counter() - t0
+    out = {
+        "target_chunks": target_chunks,
+        "chunks": len(r.chunks),
+        "kb_gen_s": round(gen_s, 3),
+        "build_s": round(build_s, 3),
+        "semantic": r.emb is not None,
+        "modes": {},
+    }
+
+    queries = gen_queries(random.Random(args.seed + 1), args.queries)
+    for mode in args.modes:
+        if mode != "bm25" and r.emb is None:
+            out["modes"][mode] = {"skipped": "语义模型不可用（USE_SEMANTIC=0 或加载失败）"}
+            continue
+        rag.RETRIEVAL_MODE = mode
+        if mode != "bm25" and r.ann is None:
+            t0 = time.perf_counter()
+            r.ann = rag.build_ann(r.emb)
+            out["ann_build_s"] = round(time.perf_counter() - t0, 3)
+            out["ann"] = r.ann is not None
+        for q in queries[:args.warmup]:
+            r.retrieve(q, topk=args.topk)
+        lat = []
+        w0 = time.perf_counter()
+        for q in queries:
+            t = time.perf_counter()
+            r.retrieve(q, topk=args.topk)
+            lat.append(time.perf_counter() - t)
+        stats = _latency_stats(lat, time.perf_counter() - w0)
+        if args.batch > 0:
+            t = time.perf_counter()
+            for i in range(0, len(queries), args.batch):
+                r.retrieve_batch(queries[i:i + args.batch], topk=args.topk)
+            stats["batch_size"] = args.batch
+            stats["batch_qps"] = round(len(queries) / (time.perf_counter() - t), 1)
+        out["modes"][mode] = stats
+    rag.RETRIEVAL_MODE = "bm25"
+
+    out["index_bytes"] = _index_bytes(r)
+    out["rss_mb"] = {"before_build": round(rss0, 1), "after": round(_rss_mb(), 1),
+                     "peak": round(_peak_rss_mb(), 1)}
+    return out
+
+
+def _git_rev():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except Exception:
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="RAG 检索性能基准")
+    ap.add_argument("--chunks", default="1000,10000", help="目标块数，逗号分隔（如 1000,10000,100000,500000）")
+    ap.add_argument("--modes", default="bm25,hybrid", help="检索模式，逗号分隔：bm25 / hybrid / dense")
+    ap.add_argument("--queries", type=int, default=200, help="回放的查询条数")
+    ap.add_argument("--warmup", type=int, default=20)
+    ap.add_argument("--topk", type=int, default=4)
+    ap.add_argument("--batch", type=int, default=0, help=">0 时额外测 retrieve_batch 的吞吐（每批条数）")
+    ap.add_argument("--seed", type=int, default=42)
+    ap.add_argument("--workdir", default=None, help="合成 KB 存放目录（默认临时目录，跑完删除）")
+    ap.add_argument("--keep", action="store_true", help="保留生成的 KB")
+    ap.add_argument("--out", default=None, help="结果 JSON 路径（默认打印到标准输出）")
+    ap.add_argument("--_child", default=None, help=argparse.SUPPRESS)   # 内部用：子进程写结果的路径
+    ap.add_argument("--_kb", default=None, help=argparse.SUPPRESS)
+    args = ap.parse_args()
+    args.modes = [m.strip() for m in args.modes.split(",") if m.strip()]
+    sizes = [int(x) for x in args.chunks.split(",") if x.strip()]
+
+    if args._child:
+        res = run_one(args, sizes[0], args._kb)
+        with open(args._child, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False)
+        return
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="rag_bench_")
+    report = {
+        "git_rev": _git_rev(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "config": {"modes": args.modes, "queries": args.queries, "warmup": args.warmup,
+                   "topk": args.topk, "batch": args.batch, "seed": args.seed,
+                   "env": {k: os.environ[k] for k in ("BM25_K1", "BM25_B", "SEM_MODEL", "SEM_DEVICE", "EMB_DTYPE",
+                                                      "ANN_MIN_CHUNKS", "ANN_NPROBE", "HYBRID_FUSION")
+                           if k in os.environ}},
+        "results": [],
+    }
+    try:
+        for n in sizes:
+            kb_dir = os.path.join(workdir, f"kb_{n}")
+            res_path = os.path.join(workdir, f"result_{n}.json")
+            cmd = [sys.executable, os.path.abspath(__file__), "--chunks", str(n),
+                   "--modes", ",".join(args.modes), "--queries", str(args.queries),
+                   "--warmup", str(args.warmup), "--topk", str(args.topk), "--batch", str(args.batch),
+                   "--seed", str(args.seed), "--_child", res_path, "--_kb", kb_dir]
+            print(f"[bench] {n} 块 ...", file=sys.stderr)
+            proc = subprocess.run(cmd, stdout=subprocess.DEVNULL)
+            if proc.returncode != 0 or not os.path.exists(res_path):
+                report["results"].append({"target_chunks": n, "error": f"子进程退出码 {proc.returncode}"})
+                continue
+            with open(res_path, encoding="utf-8") as f:
+                res = json.load(f)
+            report["results"].append(res)
+            brief = {m: s.get("p50_ms") for m, s in res["modes"].items()}
+            print(f"[bench] {res['chunks']} 块：建索引 {res['build_s']}s，p50(ms) {brief}", file=sys.stderr)
+            if not args.keep:
+                shutil.rmtree(kb_dir, ignore_errors=True)
+    finally:
+        if not args.keep and not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text)
+        print(f"[bench] 结果已写入 {args.out}", file=sys.stderr)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,354 +1,730 @@
-# bridge_to_agent.py —— 本地RAG → Coze 智能体桥接（可被他人访问版）
-# 作用：把“用户问题 + 本地RAG命中片段（证据区）”发送到 Coze Bot，拿回最终中文答案
-# 仅依赖：requests、fastapi、pydantic（以及你本机正在跑的 app.py:8000）
-
-import os
-import json
-import time
-import requests
-from fastapi import FastAPI
-from fastapi.responses import JSONResponse, PlainTextResponse
-from pydantic import BaseModel
-from fastapi import Header
-
-# ===================== 配置区 =====================
-# 【重点】你的本地 RAG 服务地址
-# - 如果只在本机自测，可改回: http://127.0.0.1:8000/ask_debug
-# - 如果要让“同一局域网里”的同事访问到你的Bridge，并让Bridge去请求你这台机的RAG，就要写成你的电脑的局域网IP
-LOCAL_RAG_URL = os.getenv("LOCAL_RAG_URL", "http://127.0.0.1:8000/ask_debug")
-
-# Coze API 配置（务必先在环境变量里配置你自己的 Token 与 BotID）
-# 国内站： https://api.coze.cn/open_api/v2
-# 海外站： https://api.coze.com/open_api/v2
-COZE_BASE      = os.getenv("COZE_BASE", "https://api.coze.cn/open_api/v2")
-COZE_API_TOKEN = os.getenv("COZE_API_TOKEN", "")          # 必填：你的 Coze API Key
-COZE_BOT_ID    = os.getenv("COZE_BOT_ID", "")             # 必填：你的 Bot ID
-COZE_USER_ID   = os.getenv("COZE_USER_ID", "lan_user")    # 可随意指定一个“用户ID”
-
-# ===================== 请求体模型 =====================
-class BridgeReq(BaseModel):
-    question: str
-    topk: int = 4
-    mode: str = "answer"   # "answer"：RAG+Coze；"check"：只看RAG命中与证据，不发Coze
-
-# ===================== 工具函数 =====================
-def call_local_rag(question: str, topk: int = 4) -> dict:
-    """
-    调用你本地的 RAG 接口，拿命中片段。
-    建议配合 app.py 的 /ask_debug 使用：返回 {"hits":[{score, source, idx, text}, ...]}
-    """
-    try:
-        r = requests.post(LOCAL_RAG_URL, json={"question": question, "topk": topk}, timeout=20)
-        r.raise_for_status()
-        return r.json()
-    except Exception as e:
-        return {"error": f"RAG调用失败: {e}", "results": [], "hits": []}
-
-def build_context_from_hits(hits: list[dict], max_refs: int = 3, max_each: int = 300) -> str:
-    """
-    把命中片段拼成【证据区】字符串。最多取 max_refs 条，每条最多 max_each 字符。
-    兼容 /ask_debug 的字段(text) 和 /ask 的字段(snippet)。
-    """
-    if not hits:
-        return ""
-    parts = []
-    for i, h in enumerate(hits[:max_refs], 1):
-        text = (h.get("text") or h.get("snippet") or "").replace("\n", " ")
-        if len(text) > max_each:
-            text = text[:max_each] + "…"
-        src = h.get("source") or "unknown"
-        idx = h.get("idx") or h.get("paragraphIndex") or "?"
-        parts.append(f"[{i}] {src}#段{idx}: {text}")
-    return "\n".join(parts)
-
-def call_coze_chat(question: str, context: str) -> dict:
-    """
-    把“用户问题 + 证据区”发到 Coze，并“强制”抽取最后一条 assistant 文本作为 final。
-    若失败/报错，会把错误信息作为 final 返回，便于你直接看到问题。
-    """
-    if not COZE_API_TOKEN or not COZE_BOT_ID:
-        return {"ok": False, "status": 0, "final": "（缺少 COZE_API_TOKEN / COZE_BOT_ID 环境变量）"}
-
-    prompt = f"""你是PLUS生活服务包客服助手。请严格依据【证据区】回答，禁止编造未在证据中的信息。
-- 先给结论（1-3条要点），再给依据编号（如 [1][3]）
-- 术语统一：运费券=免费寄件；开通=开卡；续约=续费
-- 若证据不足或冲突，请输出：“需要人工复核：原因…”，不要给武断结论
-
-【用户问题】
-{question}
-
-【证据区】
-{context}
-"""
-
-    url = f"{COZE_BASE}/chat"
-    headers = {
-        "Authorization": f"Bearer {COZE_API_TOKEN}",
-        "Content-Type": "application/json",
-    }
-    body = {
-        "bot_id": COZE_BOT_ID,
-        "user": f"{COZE_USER_ID}-{int(time.time() * 1000) % 1000000}",  # 每次一个新会话，如果你确实需要连续多轮，再把这行改回固定的 COZE_USER_ID
-        "query": prompt,
-        "stream": False
-    }
-
-    def _pick_last_assistant(data: dict) -> str | None:
-        """
-        选择规则（按优先级）：
-        1) 第一优先：messages 里第一条 role=assistant 且 type in {"answer","final","reply"} 的 content/text
-        2) 第二优先：messages 里 role=assistant 但 type 不是 {"follow_up","verbose"} 的“最后一条有文本”
-        3) 第三优先：messages 里“最后一条有文本”的（任何 type）
-        4) 兜底：data/data 顶层的 content/answer
-        """
-        if not isinstance(data, dict):
-            return None
-
-        # 错误包优先直接返回错误信息
-        code = data.get("code")
-        if isinstance(code, int) and code not in (0, 200):
-            return data.get("msg") or data.get("message") or json.dumps(data, ensure_ascii=False)
-
-        d = data.get("data") if isinstance(data.get("data"), dict) else data
-
-        # 统一拿列表
-        msgs = None
-        for key in ("messages", "list", "message_list"):
-            if isinstance(d.get(key), list):
-                msgs = d.get(key)
-                break
-        if not isinstance(msgs, list) or not msgs:
-            # 没有 messages，看看是否直接给了 content/answer
-            direct = d.get("content") or d.get("answer") or data.get("content") or data.get("answer")
-            return (direct.strip() if isinstance(direct, str) and direct.strip() else None)
-
-        # 1) 第一优先：第一条 assistant 且 type=answer/final/reply
-        for m in msgs:
-            role = (m.get("role") or m.get("sender") or m.get("sender_type") or "").lower()
-            mtype = (m.get("type") or "").lower()
-            if role == "assistant" and mtype in ("answer", "final", "reply"):
-                t = m.get("content") or m.get("text")
-                if isinstance(t, str) and t.strip():
-                    return t.strip()
-
-        # 2) 第二优先：从后往前找 assistant，且类型不是 follow_up/verbose 的“最后一条”
-        for m in reversed(msgs):
-            role = (m.get("role") or m.get("sender") or m.get("sender_type") or "").lower()
-            mtype = (m.get("type") or "").lower()
-            if role == "assistant" and mtype not in ("follow_up", "verbose"):
-                t = m.get("content") or m.get("text")
-                if isinstance(t, str) and t.strip():
-                    return t.strip()
-
-        # 3) 第三优先：就拿最后一条“有文本”的
-        for m in reversed(msgs):
-            t = m.get("content") or m.get("text")
-            if isinstance(t, str) and t.strip():
-                return t.strip()
-
-        # 4) 顶层兜底
-        top = d.get("content") or d.get("answer") or data.get("content") or data.get("answer")
-        return (top.strip() if isinstance(top, str) and top.strip() else None)
-
-        return None
-
-    try:
-        r = requests.post(url, headers=headers, json=body, timeout=45)
-        status = r.status_code
-        text = r.text
-        try:
-            data = r.json()
-        except Exception:
-            data = None
-
-        final = _pick_last_assistant(data) if isinstance(data, dict) else None
-        if not final:
-            final = text.strip() if isinstance(text, str) and text.strip() else "（未提取到回答，且无可读返回）"
-
-        return {
-            "ok": (200 <= status < 300),
-            "status": status,
-            "final": final,
-            "data": data,
-            "raw": text[:2000],
-            "via": "force_pick_last_assistant"
-        }
-    except Exception as e:
-        return {"ok": False, "status": 0, "final": f"（请求异常：{repr(e)}）"}
-
-def ask_pipeline(question: str, topk: int = 4, mode: str = "answer") -> dict:
-    """
-    主流程：
-      - mode="check": 只返回 RAG 命中与证据（不调用 Coze）
-      - mode="answer": RAG→拼证据→调用 Coze→返回最终答案
-    """
-    rag = call_local_rag(question, topk=topk)
-    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
-    # —— 新增：二次重排 ——
-    hits = reweight_hits(question, hits)
-    # —— 用重排后的命中构建证据区（取前3条）——
-    context = build_context_from_hits(hits, max_refs=3)
-
-    if not context.strip():
-        return {
-            "stage": "answer",
-            "question": question,
-            "context": context,
-            "coze_result": {
-                "ok": True,
-                "status": 200,
-                "messages": [{"role": "assistant", "type": "answer",
-                              "content": "需要人工复核：知识库未命中或证据不足。"}],
-                "final": "需要人工复核：知识库未命中或证据不足。"
-            }
-        }
-
-    if mode != "answer":
-        return {
-            "stage": "check_only",
-            "question": question,
-            "hits_count": len(hits),
-            "context": context,
-            "raw_hits": hits[:4],
-        }
-
-    coze = call_coze_chat(question, context)
-    return {
-        "stage": "answer",
-        "question": question,
-        "context": context,
-        "coze_result": coze
-    }
-
-# ===================== FastAPI 应用与路由 =====================
-app = FastAPI(title="Bridge to Coze Bot", version="1.0.0")
-
-# 统一把 JSON 响应头加上 charset=utf-8，避免中文显示成乱码
-@app.middleware("http")
-async def _force_utf8_json(request, call_next):
-    resp = await call_next(request)
-    ctype = resp.headers.get("content-type", "")
-    if ctype.startswith("application/json") and "charset=" not in ctype:
-        resp.headers["content-type"] = "application/json; charset=utf-8"
-    return resp
-
-@app.on_event("startup")
-async def _on_start():
-    print("[bridge] STARTED:", __file__)
-
-@app.exception_handler(Exception)
-async def _global_ex_handler(request, exc):
-    import traceback
-    tb = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
-    print("\n[GLOBAL][EXCEPTION]", tb, "\n")
-    return JSONResponse(
-        status_code=200,
-        content={"ok": False, "where": "global", "error": str(exc), "traceback": tb[:2000]},
-    )
-
-@app.get("/whoami")
-def whoami():
-    import os
-    return {"app": "bridge_coze", "pid": os.getpid(), "port_hint": 8016, "rag_url": LOCAL_RAG_URL}
-
-# UTF-8 自检（排查中文乱码）
-@app.get("/utf8-test/json")
-def utf8_test_json():
-    return JSONResponse({"msg": "中文OK，JSON没问题"}, media_type="application/json; charset=utf-8")
-
-@app.get("/utf8-test/text")
-def utf8_test_text():
-    return PlainTextResponse("中文OK，纯文本没问题")
-
-# 运行状况检查
-@app.get("/health")
-def health():
-    rag_ok = False
-    try:
-        r = requests.post(LOCAL_RAG_URL, json={"question":"ping","topk":1}, timeout=5)
-        rag_ok = (r.status_code == 200)
-    except Exception:
-        rag_ok = False
-    return {
-        "ok": True,
-        "rag_url": LOCAL_RAG_URL,
-        "rag_ok": rag_ok,
-        "coze_base": COZE_BASE,
-        "coze_token_set": bool(COZE_API_TOKEN),
-        "coze_bot_set": bool(COZE_BOT_ID),
-    }
-
-# 主入口（JSON）：返回 context + coze_result
-@app.post("/bridge/ask")
-def bridge_ask(req: BridgeReq):
-    q = (req.question or "").strip()
-    if not q:
-        return {"ok": False, "error": "缺少 question"}
-    topk = int(req.topk)
-    mode = (req.mode or "answer").lower()
-    out = ask_pipeline(q, topk=topk, mode=mode)
-    return {"ok": True, **out}
-
-# 一把梭（纯文本）：最适合在平台里直接接收最终答案
-@app.post("/bridge/ask-and-wait")
-def bridge_ask_and_wait(req: BridgeReq, x_bridge_secret: str | None = Header(None)):
-    secret = os.getenv("BRIDGE_SECRET", "")
-    if secret and x_bridge_secret != secret:
-        return PlainTextResponse("Unauthorized", status_code=401)
-    q = (req.question or "").strip()
-    if not q:
-        return PlainTextResponse("（缺少 question）", status_code=200)
-    topk = int(req.topk)
-    rag = call_local_rag(q, topk=topk)
-    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
-    context = build_context_from_hits(hits, max_refs=3)
-    coze = call_coze_chat(q, context)
-    # 这里改一下：
-    final = (coze.get("final") or "").strip() or "（抱歉，未拿到答案）"
-    return PlainTextResponse(final)   # 直接返回纯文本
-
-from fastapi import Request
-
-def _check_secret(req: Request) -> bool:
-    secret = os.getenv("BRIDGE_SECRET", "")
-    if not secret:
-        return True  # 未设置则不校验（本地开发用），线上务必设置
-    return req.headers.get("X-Bridge-Secret") == secret
-
-@app.post("/debug/rag-only")
-async def debug_rag_only(req: BridgeReq, request: Request):
-    if not _check_secret(request):
-        return PlainTextResponse("Unauthorized", status_code=401)
-    rag = call_local_rag(req.question, topk=req.topk)
-    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
-    context = build_context_from_hits(hits, max_refs=4, max_each=200)
-    return {"question": req.question, "hits_count": len(hits), "context": context, "raw_hits": hits[:4]}
-
-@app.post("/debug/coze-raw")
-async def debug_coze_raw(req: BridgeReq, request: Request):
-    if not _check_secret(request):
-        return PlainTextResponse("Unauthorized", status_code=401)
-    rag = call_local_rag(req.question, topk=req.topk)
-    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
-    context = build_context_from_hits(hits, max_refs=3)
-    coze = call_coze_chat(req.question, context)
-    return {"question": req.question, "context": context, "status": coze.get("status"),
-            "final_picked": coze.get("final"), "data": coze.get("data"), "raw": coze.get("raw")}
-
-# 诊断信息
-@app.get("/diag")
-def diag():
-    import os, time
-    return {
-        "signature": "bridge_diag_v1",
-        "file": __file__,
-        "pid": os.getpid(),
-        "time": int(time.time())
-    }
-
-# 直接作为脚本跑一把（可选）
-if __name__ == "__main__":
-    demo = ask_pipeline("为什么积分只有9分", topk=3, mode="check")
-
-    print(json.dumps(demo, ensure_ascii=False, indent=2))
-
+# bridge_to_agent.py —— 本地RAG → Coze 智能体桥接（可被他人访问版）
+# 作用：把“用户问题 + 本地RAG命中片段（证据区）”发送到 Coze Bot，拿回最终中文答案
+# 仅依赖：httpx、fastapi、pydantic（以及你本机正在跑的 app.py:8000）
+
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import unicodedata
+import httpx
+from ttl_cache import TTLCache, SQLiteTTLCache
+from singleflight import AsyncSingleFlight
+import metrics
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from pydantic import BaseModel
+from fastapi import Header
+
+# ===================== 配置区 =====================
+# 【重点】你的本地 RAG 服务地址
+# - 如果只在本机自测，可改回: http://127.0.0.1:8000/ask_debug
+# - 如果要让“同一局域网里”的同事访问到你的Bridge，并让Bridge去请求你这台机的RAG，就要写成你的电脑的局域网IP
+LOCAL_RAG_URL = os.getenv("LOCAL_RAG_URL", "http://127.0.0.1:8000/ask_debug")
+# 批量接口（app.py 的 /ask_batch），/bridge/ask_batch 用它一次拿回所有问题的命中
+LOCAL_RAG_BATCH_URL = os.getenv("LOCAL_RAG_BATCH_URL", "http://127.0.0.1:8000/ask_batch")
+# RAG 调用方式：
+#   http   = 通过 LOCAL_RAG_URL 调另一个进程里的 app.py（默认，RAG 可单独部署）
+#   inproc = 本进程直接 import app.py，在线程里调用检索器，并把 RAG 服务挂到 /rag 下；
+#            单机部署时少一跳 HTTP、少一个进程，桥接与 RAG 共用同一份索引（/rag/reload 照常热更新）
+RAG_MODE = os.getenv("RAG_MODE", "http").lower()
+# 批量问答时同时进行的 Coze 调用数
+BRIDGE_BATCH_WORKERS = int(os.getenv("BRIDGE_BATCH_WORKERS", "8"))
+
+# 上游连接池：RAG 与 Coze 各一个长连接池（keep-alive 复用 TCP/TLS），请求全部异步，
+# 等 Coze 思考时不占线程，一个进程可以同时挂几百个 Coze 调用
+RAG_POOL_SIZE    = int(os.getenv("RAG_POOL_SIZE", "100"))
+COZE_POOL_SIZE   = int(os.getenv("COZE_POOL_SIZE", "200"))
+KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))   # 空闲连接保留秒数
+CONNECT_TIMEOUT  = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+RAG_TIMEOUT      = float(os.getenv("RAG_TIMEOUT", "20"))
+RAG_BATCH_TIMEOUT = float(os.getenv("RAG_BATCH_TIMEOUT", "120"))
+COZE_TIMEOUT     = float(os.getenv("COZE_TIMEOUT", "45"))
+
+# 答案缓存：键 = 归一化问题 + 证据区哈希（+ Bot ID），KB 更新后证据变了自然不命中
+BRIDGE_CACHE             = os.getenv("BRIDGE_CACHE", "1") != "0"
+BRIDGE_CACHE_TTL         = float(os.getenv("BRIDGE_CACHE_TTL", "3600"))   # 秒，<=0 不过期
+BRIDGE_CACHE_MAX_ENTRIES = int(os.getenv("BRIDGE_CACHE_MAX_ENTRIES", "2048"))
+BRIDGE_CACHE_DB          = os.getenv("BRIDGE_CACHE_DB", "")   # 设成文件路径则额外持久化到 SQLite，重启后仍可命中
+
+# Coze API 配置（务必先在环境变量里配置你自己的 Token 与 BotID）
+# 国内站： https://api.coze.cn/open_api/v2
+# 海外站： https://api.coze.com/open_api/v2
+COZE_BASE      = os.getenv("COZE_BASE", "https://api.coze.cn/open_api/v2")
+COZE_API_TOKEN = os.getenv("COZE_API_TOKEN", "")          # 必填：你的 Coze API Key
+COZE_BOT_ID    = os.getenv("COZE_BOT_ID", "")             # 必填：你的 Bot ID
+COZE_USER_ID   = os.getenv("COZE_USER_ID", "lan_user")    # 可随意指定一个“用户ID”
+
+# ===================== 请求体模型 =====================
+class BridgeReq(BaseModel):
+    question: str
+    topk: int = 4
+    mode: str = "answer"   # "answer"：RAG+Coze；"check"：只看RAG命中与证据，不发Coze
+
+class BridgeBatchReq(BaseModel):
+    questions: list[str]
+    topk: int = 4
+    mode: str = "answer"
+
+# ===================== HTTP 连接池 =====================
+_clients: dict[str, httpx.AsyncClient] = {}
+
+def _http(name: str) -> httpx.AsyncClient:
+    """按上游名（"rag" / "coze"）取共享的 AsyncClient，没有就建一个"""
+    c = _clients.get(name)
+    if c is None or c.is_closed:
+        size, timeout = (RAG_POOL_SIZE, RAG_TIMEOUT) if name == "rag" else (COZE_POOL_SIZE, COZE_TIMEOUT)
+        c = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=size, max_keepalive_connections=size,
+                                keepalive_expiry=KEEPALIVE_EXPIRY),
+            timeout=httpx.Timeout(timeout, connect=CONNECT_TIMEOUT),
+        )
+        _clients[name] = c
+    return c
+
+async def close_http_clients():
+    for c in list(_clients.values()):
+        await c.aclose()
+    _clients.clear()
+
+# ===================== 指标 =====================
+REQUEST_SECONDS  = metrics.Histogram("bridge_request_seconds", "Bridge 请求总耗时（秒）", ["path"])
+UPSTREAM_SECONDS = metrics.Histogram("bridge_upstream_seconds", "上游调用耗时（秒）", ["upstream"])
+UPSTREAM_ERRORS  = metrics.Counter("bridge_upstream_errors_total", "上游调用失败次数", ["upstream"])
+BRIDGE_FALLBACKS = metrics.Counter("bridge_fallback_total", "未拿到 Coze 答案、给兜底回复的次数", ["reason"])
+
+async def _timed(upstream: str, coro, failed):
+    """等待上游调用并记录耗时；failed(结果) 为真时记一次失败"""
+    t0 = time.perf_counter()
+    res = await coro
+    UPSTREAM_SECONDS.observe(time.perf_counter() - t0, upstream=upstream)
+    if failed(res):
+        UPSTREAM_ERRORS.inc(upstream=upstream)
+    return res
+
+# ===================== 工具函数 =====================
+def _inproc_hits(hits: list[dict]) -> list[dict]:
+    """进程内检索结果转成 /ask_debug 的结构（不截断 text，证据区拼接时再截）"""
+    return [{"rank": i + 1, **h} for i, h in enumerate(hits)]
+
+# 并发的相同请求只打一次上游：RAG 按 (去首尾空白的问题, topk)，Coze 按答案缓存的键（问题 + 证据区）
+_rag_flight = AsyncSingleFlight()
+_coze_flight = AsyncSingleFlight()
+metrics.CallbackMetric("bridge_coalesced_total", "并发相同请求被合并的次数", "counter", ["upstream"],
+                       lambda: {("rag",): _rag_flight.coalesced, ("coze",): _coze_flight.coalesced})
+
+async def call_local_rag(question: str, topk: int = 4) -> dict:
+    """
+    调用你本地的 RAG 接口，拿命中片段。
+    建议配合 app.py 的 /ask_debug 使用：返回 {"hits":[{score, source, idx, text}, ...]}
+    RAG_MODE=inproc 时直接调本进程的检索器（放到线程里跑，不阻塞事件循环）。
+    同一问题正在检索时，后来的请求直接等它的结果。只合并检索结果必然相同的请求（问题去首尾空白后一致）：
+    检索区分大小写、标点，不能用答案缓存那套更宽松的 _normalize_question，否则跟着等的请求会拿到别的问法的命中。
+    """
+    rag, _ = await _rag_flight.do(
+        (question.strip(), topk),
+        lambda: _timed("rag", _call_local_rag(question, topk), lambda r: bool(r.get("error"))))
+    return rag
+
+async def _call_local_rag(question: str, topk: int) -> dict:
+    if RAG_MODE == "inproc":
+        try:
+            hits = await asyncio.to_thread(rag_service.current_retriever().retrieve, question, topk)
+            return {"hits": _inproc_hits(hits)}
+        except Exception as e:
+            return {"error": f"RAG调用失败: {e}", "results": [], "hits": []}
+    try:
+        r = await _http("rag").post(LOCAL_RAG_URL, json={"question": question, "topk": topk})
+        r.raise_for_status()
+        return r.json()
+    except Exception as e:
+        return {"error": f"RAG调用失败: {e}", "results": [], "hits": []}
+
+async def call_local_rag_batch(questions: list[str], topk: int = 4) -> list[dict]:
+    """
+    一次调用 /ask_batch 拿回所有问题的命中，返回与 questions 同序的列表，
+    每项结构与 call_local_rag 的返回相同（{"hits": [...]}）。
+    返回条数与问题数对不上时无法按位置对应，每个问题都给一条错误，不会悄悄丢掉后面的问题。
+    """
+    rags = await _timed("rag_batch", _call_local_rag_batch(questions, topk),
+                        lambda rs: len(rs) != len(questions) or any(r.get("error") for r in rs))
+    if len(rags) != len(questions):
+        err = f"RAG批量调用失败: 返回 {len(rags)} 条结果，问题有 {len(questions)} 个"
+        return [{"error": err, "results": [], "hits": []} for _ in questions]
+    return rags
+
+async def _call_local_rag_batch(questions: list[str], topk: int) -> list[dict]:
+    if RAG_MODE == "inproc":
+        try:
+            all_hits = await asyncio.to_thread(rag_service.current_retriever().retrieve_batch, questions, topk)
+            return [{"hits": _inproc_hits(hits)} for hits in all_hits]
+        except Exception as e:
+            return [{"error": f"RAG批量调用失败: {e}", "results": [], "hits": []} for _ in questions]
+    try:
+        r = await _http("rag").post(LOCAL_RAG_BATCH_URL,
+                                    json={"questions": questions, "topk": topk, "debug": True},
+                                    timeout=httpx.Timeout(RAG_BATCH_TIMEOUT, connect=CONNECT_TIMEOUT))
+        r.raise_for_status()
+        return [{"hits": item.get("hits") or []} for item in r.json().get("results", [])]
+    except Exception as e:
+        return [{"error": f"RAG批量调用失败: {e}", "results": [], "hits": []} for _ in questions]
+
+def build_context_from_hits(hits: list[dict], max_refs: int = 3, max_each: int = 300) -> str:
+    """
+    把命中片段拼成【证据区】字符串。最多取 max_refs 条，每条最多 max_each 字符。
+    兼容 /ask_debug 的字段(text) 和 /ask 的字段(snippet)。
+    """
+    if not hits:
+        return ""
+    parts = []
+    for i, h in enumerate(hits[:max_refs], 1):
+        text = (h.get("text") or h.get("snippet") or "").replace("\n", " ")
+        if len(text) > max_each:
+            text = text[:max_each] + "…"
+        src = h.get("source") or "unknown"
+        idx = h.get("idx") or h.get("paragraphIndex") or "?"
+        parts.append(f"[{i}] {src}#段{idx}: {text}")
+    return "\n".join(parts)
+
+def _pick_last_assistant(data: dict) -> str | None:
+    """
+    选择规则（按优先级）：
+    1) 第一优先：messages 里第一条 role=assistant 且 type in {"answer","final","reply"} 的 content/text
+    2) 第二优先：messages 里 role=assistant 但 type 不是 {"follow_up","verbose"} 的“最后一条有文本”
+    3) 第三优先：messages 里“最后一条有文本”的（任何 type）
+    4) 兜底：data/data 顶层的 content/answer
+    """
+    if not isinstance(data, dict):
+        return None
+
+    # 错误包优先直接返回错误信息
+    code = data.get("code")
+    if isinstance(code, int) and code not in (0, 200):
+        return data.get("msg") or data.get("message") or json.dumps(data, ensure_ascii=False)
+
+    d = data.get("data") if isinstance(data.get("data"), dict) else data
+
+    # 统一拿列表
+    msgs = None
+    for key in ("messages", "list", "message_list"):
+        if isinstance(d.get(key), list):
+            msgs = d.get(key)
+            break
+    if not isinstance(msgs, list) or not msgs:
+        # 没有 messages，看看是否直接给了 content/answer
+        direct = d.get("content") or d.get("answer") or data.get("content") or data.get("answer")
+        return (direct.strip() if isinstance(direct, str) and direct.strip() else None)
+
+    # 1) 第一优先：第一条 assistant 且 type=answer/final/reply
+    for m in msgs:
+        role = (m.get("role") or m.get("sender") or m.get("sender_type") or "").lower()
+        mtype = (m.get("type") or "").lower()
+        if role == "assistant" and mtype in ("answer", "final", "reply"):
+            t = m.get("content") or m.get("text")
+            if isinstance(t, str) and t.strip():
+                return t.strip()
+
+    # 2) 第二优先：从后往前找 assistant，且类型不是 follow_up/verbose 的“最后一条”
+    for m in reversed(msgs):
+        role = (m.get("role") or m.get("sender") or m.get("sender_type") or "").lower()
+        mtype = (m.get("type") or "").lower()
+        if role == "assistant" and mtype not in ("follow_up", "verbose"):
+            t = m.get("content") or m.get("text")
+            if isinstance(t, str) and t.strip():
+                return t.strip()
+
+    # 3) 第三优先：就拿最后一条“有文本”的
+    for m in reversed(msgs):
+        t = m.get("content") or m.get("text")
+        if isinstance(t, str) and t.strip():
+            return t.strip()
+
+    # 4) 顶层兜底
+    top = d.get("content") or d.get("answer") or data.get("content") or data.get("answer")
+    return (top.strip() if isinstance(top, str) and top.strip() else None)
+
+    return None
+
+def _coze_request(question: str, context: str, stream: bool = False) -> tuple[str, dict, dict]:
+    """拼 Coze /chat 请求：返回 (url, headers, body)"""
+    prompt = f"""你是PLUS生活服务包客服助手。请严格依据【证据区】回答，禁止编造未在证据中的信息。
+- 先给结论（1-3条要点），再给依据编号（如 [1][3]）
+- 术语统一：运费券=免费寄件；开通=开卡；续约=续费
+- 若证据不足或冲突，请输出：“需要人工复核：原因…”，不要给武断结论
+
+【用户问题】
+{question}
+
+【证据区】
+{context}
+"""
+
+    url = f"{COZE_BASE}/chat"
+    headers = {
+        "Authorization": f"Bearer {COZE_API_TOKEN}",
+        "Content-Type": "application/json",
+    }
+    body = {
+        "bot_id": COZE_BOT_ID,
+        "user": f"{COZE_USER_ID}-{int(time.time() * 1000) % 1000000}",  # 每次一个新会话，如果你确实需要连续多轮，再把这行改回固定的 COZE_USER_ID
+        "query": prompt,
+        "stream": stream
+    }
+    return url, headers, body
+
+async def call_coze_chat(question: str, context: str) -> dict:
+    """
+    把“用户问题 + 证据区”发到 Coze，并“强制”抽取最后一条 assistant 文本作为 final。
+    若失败/报错，会把错误信息作为 final 返回，便于你直接看到问题。
+    """
+    if not COZE_API_TOKEN or not COZE_BOT_ID:
+        return {"ok": False, "status": 0, "final": "（缺少 COZE_API_TOKEN / COZE_BOT_ID 环境变量）"}
+    return await _timed("coze", _call_coze_chat(question, context), lambda c: not c.get("ok"))
+
+async def _call_coze_chat(question: str, context: str) -> dict:
+    url, headers, body = _coze_request(question, context)
+    try:
+        r = await _http("coze").post(url, headers=headers, json=body)
+        status = r.status_code
+        text = r.text
+        try:
+            data = r.json()
+        except Exception:
+            data = None
+
+        final = _pick_last_assistant(data) if isinstance(data, dict) else None
+        if not final:
+            final = text.strip() if isinstance(text, str) and text.strip() else "（未提取到回答，且无可读返回）"
+
+        return {
+            "ok": (200 <= status < 300),
+            "status": status,
+            "final": final,
+            "data": data,
+            "raw": text[:2000],
+            "via": "force_pick_last_assistant"
+        }
+    except Exception as e:
+        return {"ok": False, "status": 0, "final": f"（请求异常：{repr(e)}）"}
+
+async def stream_coze_chat(question: str, context: str):
+    """
+    流式版 call_coze_chat（异步生成器）：
+      - 每收到 assistant/answer 的增量就产出 {"type": "delta", "text": ...}
+      - 结束时把收到的消息按条拼好，同样用 _pick_last_assistant 选出 final，产出 {"type": "final", ...}
+    Coze 没按 SSE 返回（如鉴权失败直接回 JSON）时，按非流式的方式解析整包。
+    """
+    if not COZE_API_TOKEN or not COZE_BOT_ID:
+        yield {"type": "final", "ok": False, "status": 0, "final": "（缺少 COZE_API_TOKEN / COZE_BOT_ID 环境变量）"}
+        return
+
+    url, headers, body = _coze_request(question, context, stream=True)
+    msgs, error = [], None
+    t0 = time.perf_counter()
+    try:
+        async with _http("coze").stream("POST", url, headers=headers, json=body) as r:
+            status = r.status_code
+            if "text/event-stream" not in r.headers.get("content-type", ""):
+                text = (await r.aread()).decode("utf-8", "replace")
+                try:
+                    data = json.loads(text)
+                except Exception:
+                    data = None
+                final = _pick_last_assistant(data) if isinstance(data, dict) else None
+                if not final:
+                    final = text.strip() or "（未提取到回答，且无可读返回）"
+                UPSTREAM_SECONDS.observe(time.perf_counter() - t0, upstream="coze_stream")
+                if not 200 <= status < 300:
+                    UPSTREAM_ERRORS.inc(upstream="coze_stream")
+                yield {"type": "final", "ok": (200 <= status < 300), "status": status, "final": final,
+                       "via": "force_pick_last_assistant"}
+                return
+
+            async for line in r.aiter_lines():
+                if not line.startswith("data:"):
+                    continue
+                try:
+                    ev = json.loads(line[5:].strip())
+                except Exception:
+                    continue
+                event = ev.get("event")
+                if event == "error":
+                    info = ev.get("error_information") or {}
+                    error = info.get("err_msg") or json.dumps(ev, ensure_ascii=False)
+                    break
+                if event == "done":
+                    break
+                m = ev.get("message")
+                if event != "message" or not isinstance(m, dict):
+                    continue
+                piece = m.get("content") or ""
+                # 同一条消息的增量拼到一起；新消息（角色/类型变了或上一条已结束）另起一条
+                last = msgs[-1] if msgs else None
+                if last and not last["_done"] and last["role"] == m.get("role") and last["type"] == m.get("type"):
+                    last["content"] += piece
+                else:
+                    msgs.append({"role": m.get("role"), "type": m.get("type"), "content": piece, "_done": False})
+                    last = msgs[-1]
+                last["_done"] = bool(ev.get("is_finish"))
+                if piece and (m.get("role") or "").lower() == "assistant" and (m.get("type") or "").lower() == "answer":
+                    yield {"type": "delta", "text": piece}
+    except Exception as e:
+        error = f"（请求异常：{repr(e)}）"
+        status = 0
+
+    final = error or _pick_last_assistant({"messages": msgs}) or "（未提取到回答，且无可读返回）"
+    ok = error is None and 200 <= status < 300
+    UPSTREAM_SECONDS.observe(time.perf_counter() - t0, upstream="coze_stream")
+    if not ok:
+        UPSTREAM_ERRORS.inc(upstream="coze_stream")
+    yield {"type": "final", "ok": ok, "status": status, "final": final, "via": "force_pick_last_assistant"}
+
+# ===================== 答案缓存 =====================
+_answer_mem = TTLCache(BRIDGE_CACHE_MAX_ENTRIES, 0, BRIDGE_CACHE_TTL)
+metrics.CallbackMetric("bridge_answer_cache_total", "答案缓存（内存层）查找次数", "counter", ["result"],
+                       lambda: {("hit",): _answer_mem.hits, ("miss",): _answer_mem.misses})
+_answer_db = (SQLiteTTLCache(BRIDGE_CACHE_DB, max_entries=BRIDGE_CACHE_MAX_ENTRIES * 10, ttl=BRIDGE_CACHE_TTL)
+              if BRIDGE_CACHE and BRIDGE_CACHE_DB else None)
+
+def _normalize_question(q: str) -> str:
+    """全半角统一、去空白、去首尾标点，让“洗车多久过期？”与“洗车多久过期”算同一问"""
+    q = unicodedata.normalize("NFKC", q or "").lower()
+    q = re.sub(r"\s+", "", q)
+    return q.strip(",.;:!?~，。；：！？～、")
+
+def answer_cache_key(question: str, context: str) -> str:
+    ctx_hash = hashlib.sha1(context.encode("utf-8")).hexdigest()
+    raw = f"{COZE_BOT_ID}\n{_normalize_question(question)}\n{ctx_hash}"
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def answer_cache_get(key: str) -> dict | None:
+    hit = _answer_mem.get(key)
+    if hit is None and _answer_db is not None:
+        hit = _answer_db.get(key)
+        if hit is not None:
+            _answer_mem.put(key, hit)
+    return hit
+
+def _from_cache(hit: dict) -> dict:
+    """缓存命中时返回给调用方的结果：流式与非流式一样，via 标成 cache"""
+    return {**hit, "via": "cache", "cached": True}
+
+def answer_cache_put(key: str, coze: dict):
+    """只缓存成功且有答案的结果；只存答案相关字段，不存 Coze 原始包"""
+    if not coze.get("ok") or not (coze.get("final") or "").strip():
+        return
+    item = {k: coze.get(k) for k in ("ok", "status", "final")}
+    _answer_mem.put(key, item)
+    if _answer_db is not None:
+        _answer_db.put(key, item)
+
+async def cached_coze_chat(question: str, context: str) -> dict:
+    """
+    带答案缓存的 call_coze_chat；命中时结果里带 "cached": True、"via": "cache"。
+    未命中时同一（问题, 证据区）并发只调一次 Coze，跟着等的请求结果里带 "coalesced": True。
+    """
+    key = answer_cache_key(question, context)
+    if BRIDGE_CACHE:
+        hit = answer_cache_get(key)
+        if hit is not None:
+            return _from_cache(hit)
+
+    async def _call():
+        coze = await call_coze_chat(question, context)
+        if BRIDGE_CACHE:
+            answer_cache_put(key, coze)
+        return coze
+
+    coze, shared = await _coze_flight.do(key, _call)
+    return {**coze, "coalesced": True} if shared else coze
+
+async def ask_pipeline(question: str, topk: int = 4, mode: str = "answer") -> dict:
+    """
+    主流程：
+      - mode="check": 只返回 RAG 命中与证据（不调用 Coze）
+      - mode="answer": RAG→拼证据→调用 Coze→返回最终答案
+    """
+    rag = await call_local_rag(question, topk=topk)
+    # 业务加权（关键词规则）已在 RAG 检索里做过，命中按返回顺序直接用
+    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
+    return await answer_from_hits(question, hits, mode=mode)
+
+async def answer_from_hits(question: str, hits: list[dict], mode: str = "answer") -> dict:
+    """已拿到命中后的后半段：拼证据区 →（mode=answer 时）调用 Coze"""
+    # —— 用命中构建证据区（取前3条）——
+    context = build_context_from_hits(hits, max_refs=3)
+
+    if not context.strip():
+        BRIDGE_FALLBACKS.inc(reason="no_evidence")
+        return {
+            "stage": "answer",
+            "question": question,
+            "context": context,
+            "coze_result": {
+                "ok": True,
+                "status": 200,
+                "messages": [{"role": "assistant", "type": "answer",
+                              "content": "需要人工复核：知识库未命中或证据不足。"}],
+                "final": "需要人工复核：知识库未命中或证据不足。"
+            }
+        }
+
+    if mode != "answer":
+        return {
+            "stage": "check_only",
+            "question": question,
+            "hits_count": len(hits),
+            "context": context,
+            "raw_hits": hits[:4],
+        }
+
+    coze = await cached_coze_chat(question, context)
+    return {
+        "stage": "answer",
+        "question": question,
+        "context": context,
+        "coze_result": coze
+    }
+
+# ===================== FastAPI 应用与路由 =====================
+app = FastAPI(title="Bridge to Coze Bot", version="1.0.0")
+
+# 进程内 RAG：import 时就会加载（或从缓存读取）索引；RAG 的接口挂在 /rag 下
+rag_service = None
+if RAG_MODE == "inproc":
+    import app as rag_service
+    app.mount("/rag", rag_service.app)
+
+# 统一把 JSON 响应头加上 charset=utf-8，避免中文显示成乱码
+@app.middleware("http")
+async def _observe_latency(request, call_next):
+    t0 = time.perf_counter()
+    resp = await call_next(request)
+    route = request.scope.get("route")
+    if route is not None and route in app.router.routes:   # 只统计本应用的路由（/rag 挂载的子应用自己统计）
+        REQUEST_SECONDS.observe(time.perf_counter() - t0, path=route.path)
+    return resp
+
+@app.middleware("http")
+async def _force_utf8_json(request, call_next):
+    resp = await call_next(request)
+    ctype = resp.headers.get("content-type", "")
+    if ctype.startswith("application/json") and "charset=" not in ctype:
+        resp.headers["content-type"] = "application/json; charset=utf-8"
+    return resp
+
+@app.on_event("startup")
+async def _on_start():
+    print("[bridge] STARTED:", __file__, "rag_mode:", RAG_MODE)
+    # 挂载的子应用不会触发自己的 startup，语义模型预热在这里做
+    if rag_service is not None and rag_service.SEM_PRELOAD != "0":
+        rag_service.preload_sem_model(background=True)
+
+@app.on_event("shutdown")
+async def _on_stop():
+    await close_http_clients()
+
+@app.exception_handler(Exception)
+async def _global_ex_handler(request, exc):
+    import traceback
+    tb = "".join(traceback.format_exception(type(exc), exc, exc.__traceback__))
+    print("\n[GLOBAL][EXCEPTION]", tb, "\n")
+    return JSONResponse(
+        status_code=200,
+        content={"ok": False, "where": "global", "error": str(exc), "traceback": tb[:2000]},
+    )
+
+@app.get("/whoami")
+def whoami():
+    import os
+    return {"app": "bridge_coze", "pid": os.getpid(), "port_hint": 8016, "rag_url": LOCAL_RAG_URL,
+            "rag_mode": RAG_MODE}
+
+# UTF-8 自检（排查中文乱码）
+@app.get("/utf8-test/json")
+def utf8_test_json():
+    return JSONResponse({"msg": "中文OK，JSON没问题"}, media_type="application/json; charset=utf-8")
+
+@app.get("/utf8-test/text")
+def utf8_test_text():
+    return PlainTextResponse("中文OK，纯文本没问题")
+
+# 运行状况检查
+@app.get("/health")
+async def health():
+    rag_ok = False
+    if RAG_MODE == "inproc":
+        rag_ok = rag_service.current_retriever() is not None
+    else:
+        try:
+            r = await _http("rag").post(LOCAL_RAG_URL, json={"question":"ping","topk":1}, timeout=5)
+            rag_ok = (r.status_code == 200)
+        except Exception:
+            rag_ok = False
+    return {
+        "ok": True,
+        "rag_mode": RAG_MODE,
+        "rag_url": LOCAL_RAG_URL if RAG_MODE != "inproc" else "/rag",
+        "rag_ok": rag_ok,
+        "coze_base": COZE_BASE,
+        "coze_token_set": bool(COZE_API_TOKEN),
+        "coze_bot_set": bool(COZE_BOT_ID),
+    }
+
+# 主入口（JSON）：返回 context + coze_result
+@app.post("/bridge/ask")
+async def bridge_ask(req: BridgeReq):
+    q = (req.question or "").strip()
+    if not q:
+        return {"ok": False, "error": "缺少 question"}
+    topk = int(req.topk)
+    mode = (req.mode or "answer").lower()
+    out = await ask_pipeline(q, topk=topk, mode=mode)
+    return {"ok": True, **out}
+
+# 一把梭（纯文本）：最适合在平台里直接接收最终答案
+@app.post("/bridge/ask-and-wait")
+async def bridge_ask_and_wait(req: BridgeReq, x_bridge_secret: str | None = Header(None)):
+    secret = os.getenv("BRIDGE_SECRET", "")
+    if secret and x_bridge_secret != secret:
+        return PlainTextResponse("Unauthorized", status_code=401)
+    q = (req.question or "").strip()
+    if not q:
+        return PlainTextResponse("（缺少 question）", status_code=200)
+    topk = int(req.topk)
+    rag = await call_local_rag(q, topk=topk)
+    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
+    context = build_context_from_hits(hits, max_refs=3)
+    coze = await cached_coze_chat(q, context)
+    # 这里改一下：
+    final = (coze.get("final") or "").strip()
+    if not coze.get("ok") or not final:
+        BRIDGE_FALLBACKS.inc(reason="coze_failed")
+    final = final or "（抱歉，未拿到答案）"
+    return PlainTextResponse(final)   # 直接返回纯文本
+
+from fastapi import Request
+
+def _check_secret(req: Request) -> bool:
+    secret = os.getenv("BRIDGE_SECRET", "")
+    if not secret:
+        return True  # 未设置则不校验（本地开发用），线上务必设置
+    return req.headers.get("X-Bridge-Secret") == secret
+
+# 批量问答：一次 RAG 批量检索，Coze 调用并发进行，结果按输入顺序返回
+@app.post("/bridge/ask_batch")
+async def bridge_ask_batch(req: BridgeBatchReq, request: Request):
+    if not _check_secret(request):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    questions = [(q or "").strip() for q in req.questions]
+    mode = (req.mode or "answer").lower()
+    rags = await call_local_rag_batch(questions, topk=int(req.topk))
+    sem = asyncio.Semaphore(max(1, BRIDGE_BATCH_WORKERS))
+
+    async def _one(q, rag):
+        if not q:
+            return {"ok": False, "question": q, "error": "缺少 question"}
+        if rag.get("error"):
+            return {"ok": False, "question": q, "error": rag["error"]}
+        hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
+        async with sem:
+            return {"ok": True, **(await answer_from_hits(q, hits, mode=mode))}
+
+    results = await asyncio.gather(*(_one(q, rag) for q, rag in zip(questions, rags)))
+    return {"ok": True, "count": len(results), "results": results}
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+# 流式问答（SSE）：先推 context 事件（证据区，检索完就到），再逐段推 Coze 的 delta，最后推 final
+@app.post("/bridge/ask-stream")
+async def bridge_ask_stream(req: BridgeReq, request: Request):
+    if not _check_secret(request):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    q = (req.question or "").strip()
+    if not q:
+        return PlainTextResponse("（缺少 question）", status_code=200)
+    rag = await call_local_rag(q, topk=int(req.topk))
+    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
+    context = build_context_from_hits(hits, max_refs=3)
+
+    async def _events():
+        yield _sse("context", {"question": q, "hits_count": len(hits), "context": context,
+                               "error": rag.get("error")})
+        if not context.strip():
+            BRIDGE_FALLBACKS.inc(reason="no_evidence")
+            yield _sse("final", {"ok": True, "status": 200,
+                                 "final": "需要人工复核：知识库未命中或证据不足。"})
+            return
+        key = answer_cache_key(q, context) if BRIDGE_CACHE else None
+        hit = answer_cache_get(key) if key else None
+        if hit is not None:
+            yield _sse("final", _from_cache(hit))
+            return
+        async for ev in stream_coze_chat(q, context):
+            kind = ev.pop("type")
+            if kind == "final" and key:
+                answer_cache_put(key, ev)
+            yield _sse(kind, ev)
+
+    return StreamingResponse(_events(), media_type="text/event-stream; charset=utf-8",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@app.get("/bridge/cache/stats")
+async def bridge_cache_stats():
+    return {"ok": True, "enabled": BRIDGE_CACHE, "memory": _answer_mem.stats(),
+            "sqlite": _answer_db.stats() if _answer_db is not None else None,
+            "coalesce": {"rag": _rag_flight.stats(), "coze": _coze_flight.stats()}}
+
+@app.post("/bridge/cache/clear")
+async def bridge_cache_clear(request: Request):
+    if not _check_secret(request):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    _answer_mem.clear()
+    if _answer_db is not None:
+        _answer_db.clear()
+    return {"ok": True}
+
+@app.post("/debug/rag-only")
+async def debug_rag_only(req: BridgeReq, request: Request):
+    if not _check_secret(request):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    rag = await call_local_rag(req.question, topk=req.topk)
+    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
+    context = build_context_from_hits(hits, max_refs=4, max_each=200)
+    return {"question": req.question, "hits_count": len(hits), "context": context, "raw_hits": hits[:4]}
+
+@app.post("/debug/coze-raw")
+async def debug_coze_raw(req: BridgeReq, request: Request):
+    if not _check_secret(request):
+        return PlainTextResponse("Unauthorized", status_code=401)
+    rag = await call_local_rag(req.question, topk=req.topk)
+    hits = rag.get("results") or rag.get("hits") or rag.get("citations") or []
+    context = build_context_from_hits(hits, max_refs=3)
+    coze = await call_coze_chat(req.question, context)
+    return {"question": req.question, "context": context, "status": coze.get("status"),
+            "final_picked": coze.get("final"), "data": coze.get("data"), "raw": coze.get("raw")}
+
+# 诊断信息
+@app.get("/diag")
+def diag():
+    import os, time
+    return {
+        "signature": "bridge_diag_v1",
+        "file": __file__,
+        "pid": os.getpid(),
+        "time": int(time.time())
+    }
+
+# 直接作为脚本跑一把（可选）
+if __name__ == "__main__":
+    demo = asyncio.run(ask_pipeline("为什么积分只有9分", topk=3, mode="check"))
+
+    print(json.dumps(demo, ensure_ascii=False, indent=2))
+
@@ -0,0 +1,236 @@
+# chunk_store.py —— 紧凑的知识块存储（可 mmap）
+# 作用：替代 [{"text","source","idx"}, ...] 的 dict 列表：
+#   - 所有块正文按 UTF-8 拼成一个 blob，offsets[i]:offsets[i+1] 是第 i 块的字节区间（从索引缓存加载时 mmap，不进堆）
+#   - 来源文件名只存一份（sources），每块只记一个 int32 的来源号 + int32 的 idx
+#   - (source, idx) → 行号 O(1)：文件名走哈希表，同一文件的块连续且 idx 从 1 递增时直接按偏移寻址，否则退回 (来源号, idx) 哈希表
+# 按下标取块时现解码成与原来相同的 dict，检索器和接口的用法不变。
+# StringArray 是同样布局的通用只读字符串数组（归一化文本、BM25 词表用），多个 worker 加载同一份缓存时共享页缓存。
+
+import os
+import json
+import mmap
+import numpy as np
+
+
+class ChunkStore:
+    ARRAYS = ("offsets", "src_ids", "idxs")
+
+    def __init__(self, sources, src_ids, idxs, offsets, blob):
+        self.sources = sources          # list[str]，来源号 → 文件名
+        self.src_ids = src_ids          # int32[N]
+        self.idxs = idxs                # int32[N]，文件内 1-based 段号
+        self.offsets = offsets          # int64[N+1]，blob 内的字节偏移
+        self.blob = blob                # bytes 或只读 mmap
+        self._build_lookup()
+
+    # ---------- 构建 ----------
+    @classmethod
+    def from_chunks(cls, chunks):
+        b = ChunkStoreBuilder()
+        b.add_chunks(chunks)
+        return b.build()
+
+    def _build_lookup(self):
+        n = len(self.idxs)
+        self._src_index = {s: i for i, s in enumerate(self.sources)}
+        self._src_start = np.zeros(len(self.sources), dtype=np.int64)
+        self._src_count = np.zeros(len(self.sources), dtype=np.int64)
+        self._pos = None
+        if not n:
+            return
+        src = np.asarray(self.src_ids)
+        idxs = np.asarray(self.idxs)
+        run_starts = np.flatnonzero(np.r_[True, src[1:] != src[:-1]])
+        run_lens = np.diff(np.r_[run_starts, n])
+        direct = len(run_starts) == len(np.unique(src))
+        if direct:
+            # 每个来源的块连续且 idx 为 1..count，行号 = 起始行 + idx - 1
+            expected = np.arange(n) - np.repeat(run_starts, run_lens) + 1
+            direct = bool(np.array_equal(idxs, expected))
+        if direct:
+            self._src_start[src[run_starts]] = run_starts
+            self._src_count[src[run_starts]] = run_lens
+        else:
+            # 顺序被打乱或有重号：(来源号, idx) → 行号，重号时与原来的线性扫描一样取第一条
+            self._pos = {}
+            for row, key in enumerate(zip(src.tolist(), idxs.tolist())):
+                self._pos.setdefault(key, row)
+
+    # ---------- 读取 ----------
+    def __len__(self):
+        return len(self.idxs)
+
+    def text(self, i):
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])].decode("utf-8")
+
+    def source(self, i):
+        return self.sources[int(self.src_ids[i])]
+
+    def idx(self, i):
+        return int(self.idxs[i])
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return {"text": self.text(i), "source": self.source(i), "idx": self.idx(i)}
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def find(self, source, idx):
+        """(source, idx) → 行号，找不到返回 None"""
+        sid = self._src_index.get(source)
+        if sid is None:
+            return None
+        idx = int(idx)
+        if self._pos is not None:
+            return self._pos.get((sid, idx))
+        if 1 <= idx <= self._src_count[sid]:
+            return int(self._src_start[sid]) + idx - 1
+        return None
+
+    def get(self, source, idx):
+        row = self.find(source, idx)
+        return None if row is None else self[row]
+
+    def spans(self):
+        """来源文件名 → 它的块在存储里的行区间 [start, end)（首次出现到最后一次出现）"""
+        out = {}
+        src = np.asarray(self.src_ids)
+        if not len(src):
+            return out
+        uniq, first = np.unique(src, return_index=True)
+        _, last_rev = np.unique(src[::-1], return_index=True)
+        for sid, a, z in zip(uniq.tolist(), first.tolist(), (len(src) - last_rev).tolist()):
+            out[self.sources[sid]] = (a, z)
+        return out
+
+    @property
+    def nbytes(self):
+        return len(self.blob) + sum(int(getattr(self, a).nbytes) for a in self.ARRAYS)
+
+    # ---------- 落盘 ----------
+    def save(self, d):
+        with open(os.path.join(d, "chunks_blob.bin"), "wb") as f:
+            f.write(self.blob)
+        for name in self.ARRAYS:
+            np.save(os.path.join(d, f"chunks_{name}.npy"), np.asarray(getattr(self, name)))
+        with open(os.path.join(d, "chunks_sources.json"), "w", encoding="utf-8") as f:
+            json.dump(self.sources, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, d, mmap_mode="r"):
+        with open(os.path.join(d, "chunks_sources.json"), "r", encoding="utf-8") as f:
+            sources = json.load(f)
+        arrs = {name: np.load(os.path.join(d, f"chunks_{name}.npy"), mmap_mode=mmap_mode)
+                for name in cls.ARRAYS}
+        return cls(sources, arrs["src_ids"], arrs["idxs"], arrs["offsets"],
+                   _map_blob(os.path.join(d, "chunks_blob.bin")))
+
+
+class StringArray:
+    """只读字符串数组：UTF-8 blob + int64 偏移；arr[i] 为 str，arr[a:b] 为 list[str]，从缓存加载时 blob 走 mmap"""
+
+    def __init__(self, offsets, blob):
+        self.offsets = offsets          # int64[N+1]
+        self.blob = blob                # bytes 或只读 mmap
+
+    @classmethod
+    def from_strings(cls, strings):
+        pieces = [s.encode("utf-8") for s in strings]
+        offsets = np.zeros(len(pieces) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter(map(len, pieces), dtype=np.int64, count=len(pieces)), out=offsets[1:])
+        return cls(offsets, b"".join(pieces))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        """第 i 个字符串的 UTF-8 字节（不解码，比较 / 查找用）"""
+        return self.blob[int(self.offsets[i]):int(self.offsets[i + 1])]
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return self.raw(i).decode("utf-8")
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.raw(i).decode("utf-8")
+
+    @property
+    def nbytes(self):
+        return len(self.blob) + int(self.offsets.nbytes)
+
+    def save(self, d, name):
+        with open(os.path.join(d, f"{name}_blob.bin"), "wb") as f:
+            f.write(self.blob)
+        np.save(os.path.join(d, f"{name}_offsets.npy"), np.asarray(self.offsets))
+
+    @classmethod
+    def load(cls, d, name, mmap_mode="r"):
+        offsets = np.load(os.path.join(d, f"{name}_offsets.npy"), mmap_mode=mmap_mode)
+        return cls(offsets, _map_blob(os.path.join(d, f"{name}_blob.bin")))
+
+
+def _map_blob(path):
+    """只读 mmap 整个文件（空文件不能 mmap，返回空 bytes）"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return b""
+
+
+class ChunkStoreBuilder:
+    """按顺序追加块（dict 列表或已有存储的一段行区间），最后一次性生成 ChunkStore"""
+
+    def __init__(self):
+        self._sources = []
+        self._src_index = {}
+        self._pieces = []       # blob 片段
+        self._lens = []         # 每块字节数
+        self._src_ids = []
+        self._idxs = []
+
+    def _sid(self, source):
+        sid = self._src_index.get(source)
+        if sid is None:
+            sid = self._src_index[source] = len(self._sources)
+            self._sources.append(source)
+        return sid
+
+    def add_chunks(self, chunks):
+        for c in chunks:
+            data = c["text"].encode("utf-8")
+            self._pieces.append(data)
+            self._lens.append(len(data))
+            self._src_ids.append(self._sid(c["source"]))
+            self._idxs.append(int(c["idx"]))
+
+    def add_range(self, store, start, end):
+        """直接搬已有存储的 [start, end) 行：正文按字节整段拷贝，不解码"""
+        if end <= start:
+            return
+        a, z = int(store.offsets[start]), int(store.offsets[end])
+        self._pieces.append(store.blob[a:z])
+        self._lens.extend(np.diff(np.asarray(store.offsets[start:end + 1])).tolist())
+        remap = [self._sid(s) for s in store.sources]
+        self._src_ids.extend(remap[s] for s in np.asarray(store.src_ids[start:end]).tolist())
+        self._idxs.extend(np.asarray(store.idxs[start:end]).tolist())
+
+    def build(self):
+        offsets = np.zeros(len(self._lens) + 1, dtype=np.int64)
+        np.cumsum(np.asarray(self._lens, dtype=np.int64), out=offsets[1:])
+        return ChunkStore(list(self._sources),
+                          np.asarray(self._src_ids, dtype=np.int32),
+                          np.asarray(self._idxs, dtype=np.int32),
+                          offsets, b"".join(self._pieces))
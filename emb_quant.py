@@ -0,0 +1,116 @@
+# emb_quant.py —— 块向量的压缩存储（float16 / int8）
+# 作用：语义重排 / 向量召回用的块向量矩阵默认是 float32；KB 很大时可改存
+#   - float16：每维 2 字节，内存减半，余弦误差约 1e-4 量级（部分 CPU 上半精度转换较慢，全表扫描会变慢）
+#   - int8   ：每维 1 字节 + 每个向量一个 float32 缩放系数（对称量化，scale = max|x| / 127），内存约为 1/4，余弦误差约 1e-3 量级
+# 打分时按块反量化成 float32 再做矩阵乘法，不会一次性还原整张矩阵。
+# 用法：EMB_DTYPE=float16 / int8（见 rag_step1_bm25.py），float32 时仍是普通 ndarray，行为与原来完全一致。
+
+import os
+import numpy as np
+
+EMB_KINDS = ("float32", "float16", "int8")
+SCORE_BLOCK = 2048   # 打分时每次反量化的行数：2048 × 512 维 float32 约 4MB，能留在缓存里，且反复复用同一块缓冲
+
+
+class QuantizedEmbeddings:
+    """
+    行为上像一个只读的 float32 矩阵：emb[i] / emb[行号数组] / emb[a:b] 返回反量化后的 float32，
+    len / shape / nbytes 可用；score(q, rows) 直接算 emb[rows] @ q，int8 时先乘码值再乘缩放系数。
+    """
+
+    def __init__(self, codes, scale=None):
+        self.codes = codes    # float16[N, dim] 或 int8[N, dim]
+        self.scale = scale    # int8 时为 float32[N]，float16 时为 None
+        self.kind = "int8" if scale is not None else "float16"
+
+    @classmethod
+    def quantize(cls, emb, kind, block=65536):
+        if kind == "float16":
+            return cls(np.asarray(emb, dtype=np.float16))
+        if kind != "int8":
+            raise ValueError(f"不支持的向量存储类型：{kind}")
+        n, dim = emb.shape
+        codes = np.empty((n, dim), dtype=np.int8)
+        scale = np.empty(n, dtype=np.float32)
+        for s in range(0, n, block):
+            x = np.asarray(emb[s:s + block], dtype=np.float32)
+            m = np.abs(x).max(axis=1) / 127.0
+            m[m == 0] = 1.0
+            codes[s:s + block] = np.clip(np.rint(x / m[:, None]), -127, 127)
+            scale[s:s + block] = m
+        return cls(codes, scale)
+
+    def __len__(self):
+        return len(self.codes)
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return int(self.codes.nbytes) + (int(self.scale.nbytes) if self.scale is not None else 0)
+
+    def __getitem__(self, key):
+        x = np.asarray(self.codes[key], dtype=np.float32)
+        if self.scale is not None:
+            s = np.asarray(self.scale[key], dtype=np.float32)
+            x = x * (s[..., None] if x.ndim > s.ndim else s)
+        return x
+
+    def score(self, q, rows=None, block=SCORE_BLOCK):
+        """emb[rows] @ q（rows 为 None 时全表；可为切片或行号数组），每次反量化 block 行到同一块缓冲里再乘"""
+        q = np.asarray(q, dtype=np.float32)
+        if rows is None:
+            rows = slice(0, len(self.codes))
+        if isinstance(rows, slice):
+            start, stop, step = rows.indices(len(self.codes))
+            if step != 1:
+                rows = np.arange(start, stop, step)
+            else:
+                keys = [slice(s, min(s + block, stop)) for s in range(start, stop, block)]
+                n = max(0, stop - start)
+        if not isinstance(rows, slice):
+            rows = np.asarray(rows, dtype=np.int64)
+            keys = [rows[s:s + block] for s in range(0, len(rows), block)]
+            n = len(rows)
+        out = np.empty(n, dtype=np.float32)
+        buf = np.empty((min(block, n), self.codes.shape[1]), dtype=np.float32)
+        pos = 0
+        for key in keys:
+            codes = self.codes[key]
+            m = len(codes)
+            np.copyto(buf[:m], codes, casting="unsafe")
+            sims = out[pos:pos + m]
+            np.matmul(buf[:m], q, out=sims)
+            if self.scale is not None:
+                sims *= self.scale[key]
+            pos += m
+        return out
+
+    def save(self, d):
+        np.save(os.path.join(d, f"emb_{self.kind}.npy"), np.asarray(self.codes))
+        if self.scale is not None:
+            np.save(os.path.join(d, "emb_scale.npy"), np.asarray(self.scale))
+
+    @classmethod
+    def load(cls, d, kind, mmap_mode="r"):
+        codes = np.load(os.path.join(d, f"emb_{kind}.npy"), mmap_mode=mmap_mode)
+        scale = np.load(os.path.join(d, "emb_scale.npy"), mmap_mode=mmap_mode) if kind == "int8" else None
+        return cls(codes, scale)
+
+
+def store_embeddings(emb, kind):
+    """把 encode 出的 float32 矩阵按 kind 转成存储形式；已是目标形式或为 None 时原样返回"""
+    if emb is None or kind == "float32" or isinstance(emb, QuantizedEmbeddings):
+        return emb
+    return QuantizedEmbeddings.quantize(emb, kind)
+
+
+def score_rows(emb, q, rows=None):
+    """emb[rows] @ q，emb 可以是 float32 矩阵 / memmap，也可以是 QuantizedEmbeddings"""
+    if isinstance(emb, QuantizedEmbeddings):
+        return emb.score(q, rows)
+    if rows is None:
+        return np.asarray(emb) @ q
+    return np.asarray(emb[rows]) @ q
@@ -0,0 +1,235 @@
+# eval_retrieval.py —— 检索效果 + 延迟评测（带标注的问题集）
+# 作用：读一个 JSONL 问题集（每行一个问题 + 期望命中的 source#idx），用 RetrieverBM25.retrieve_batch 批量检索，
+#       输出每组配置的 recall@k、MRR、批量/单条延迟；--sweep 时对多组参数做笛卡尔积扫描。
+#
+# 问题集格式（每行一个 JSON）：
+#   {"question": "洗车多久过期", "expected": ["demo_rules.txt#3"]}
+#   {"question": "积分兑换能开发票吗", "expected": "demo_rules.txt#7", "expected_text": ["不支持开具发票"]}
+#   expected：期望命中的块（source#idx，可多个）；expected_text：期望命中块里包含的原文片段（可多个），
+#   扫 chunk_size / overlap 时块号会变，这时要靠 expected_text 判定命中。
+#
+# 用法示例：
+#   python eval_retrieval.py --cases eval.jsonl
+#   python eval_retrieval.py --cases eval.jsonl --sweep "chunk_size=400,500;overlap=100,150;k1=1.2,1.5;b=0.6,0.75;blend=0.4,0.6"
+#   python eval_retrieval.py --cases eval.jsonl --sweep "mode=bm25,hybrid;alpha=0.3,0.5,0.7" --out eval.json
+# 可扫的参数：chunk_size / overlap（重新切块）、k1 / b（BM25）、blend（语义重排权重 SEM_BLEND）、
+#             mode（bm25 / dense / hybrid）、alpha（HYBRID_ALPHA，weighted 融合时 BM25 的权重）。
+# 复用：同一切块配置的切块、分词、BM25 统计和块向量只算一次（并落盘到 --cache-dir，下次直接加载）；
+#       换 k1 / b 只重算 tf 饱和项，不重新分词；问题的归一化和向量全程只算一次。
+
+import os
+import sys
+import json
+import time
+import argparse
+import itertools
+
+# ===================== 问题集 =====================
+def load_cases(path):
+    cases = []
+    with open(path, "r", encoding="utf-8") as f:
+        for ln, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            obj = json.loads(line)
+            q = (obj.get("question") or "").strip()
+            expected = obj.get("expected") or []
+            if isinstance(expected, str):
+                expected = [expected]
+            texts = obj.get("expected_text") or []
+            if isinstance(texts, str):
+                texts = [texts]
+            if not q or not (expected or texts):
+                print(f"[eval] 第 {ln} 行缺 question 或 expected/expected_text，跳过", file=sys.stderr)
+                continue
+            cases.append({"question": q, "expected": [e.strip() for e in expected],
+                          "expected_text": texts})
+    return cases
+
+
+def _relevant(hit, target):
+    """target 为 ("id", "source#idx") 或 ("text", 原文片段)"""
+    kind, val = target
+    if kind == "id":
+        return f"{hit['source']}#{hit['idx']}" == val
+    return val in hit["text"]
+
+
+def score_case(case, hits, ks):
+    """单个问题：每个 k 的召回（命中的期望项 / 期望项总数）与首个相关命中的名次（未命中为 None）"""
+    targets = [("id", e) for e in case["expected"]] + [("text", t) for t in case["expected_text"]]
+    found_at = []   # 每个期望项第一次被命中的名次
+    for t in targets:
+        rank = next((i + 1 for i, h in enumerate(hits) if _relevant(h, t)), None)
+        found_at.append(rank)
+    recall = {k: sum(1 for r in found_at if r is not None and r <= k) / len(targets) for k in ks}
+    ranks = [r for r in found_at if r is not None]
+    return recall, (min(ranks) if ranks else None)
+
+
+# ===================== 单组配置评测 =====================
+def _pct(xs, p):
+    if not xs:
+        return None
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+
+def evaluate(r, cases, ks, q_embs=None, batch=32, latency_sample=0):
+    questions = [c["question"] for c in cases]
+    topk = max(ks)
+    hits = []
+    t0 = time.perf_counter()
+    for s in range(0, len(questions), batch):
+        sub = q_embs[s:s + batch] if q_embs is not None else None
+        hits.extend(r.retrieve_batch(questions[s:s + batch], topk=topk, q_embs=sub))
+    batch_s = time.perf_counter() - t0
+
+    recall_sum = {k: 0.0 for k in ks}
+    rr_sum = 0.0
+    misses = []
+    for c, h in zip(cases, hits):
+        recall, first = score_case(c, h, ks)
+        for k in ks:
+            recall_sum[k] += recall[k]
+        if first is not None:
+            rr_sum += 1.0 / first
+        else:
+            misses.append(c["question"])
+    n = len(cases)
+    out = {
+        "n": n,
+        **{f"recall@{k}": round(recall_sum[k] / n, 4) for k in ks},
+        "mrr": round(rr_sum / n, 4),
+        "batch_ms_per_query": round(batch_s * 1000 / n, 3),
+        "misses": misses,
+    }
+    # 单条延迟：抽前 latency_sample 条逐条 retrieve（含现场 encode），反映线上单请求的耗时
+    if latency_sample > 0:
+        lat = []
+        for q in questions[:latency_sample]:
+            t = time.perf_counter()
+            r.retrieve(q, topk=topk)
+            lat.append((time.perf_counter() - t) * 1000)
+        out["p50_ms"] = round(_pct(lat, 50), 3)
+        out["p95_ms"] = round(_pct(lat, 95), 3)
+    return out
+
+
+# ===================== 参数扫描 =====================
+SWEEP_KEYS = {
+    "chunk_size": int, "overlap": int, "k1": float, "b": float,
+    "blend": float, "mode": str, "alpha": float,
+}
+
+
+def parse_sweep(spec):
+    """ "chunk_size=400,500;k1=1.2,1.5" → 按 SWEEP_KEYS 顺序展开的配置列表（笛卡尔积）"""
+    grid = {}
+    for part in (spec or "").split(";"):
+        if not part.strip():
+            continue
+        name, _, vals = part.partition("=")
+        name = name.strip()
+        if name not in SWEEP_KEYS:
+            raise SystemExit(f"[eval] 不支持扫描参数 {name!r}，可选：{', '.join(SWEEP_KEYS)}")
+        grid[name] = [SWEEP_KEYS[name](v.strip()) for v in vals.split(",") if v.strip()]
+    names = [k for k in SWEEP_KEYS if k in grid]
+    return [dict(zip(names, combo)) for combo in itertools.product(*(grid[k] for k in names))]
+
+
+class Workbench:
+    """按切块配置缓存检索器；同一切块配置下换 k1/b/blend/mode 只做增量工作"""
+
+    def __init__(self, rag, cache_dir):
+        self.rag = rag
+        self.base = {}   # (chunk_size, overlap) → 用默认 k1/b 建好的 RetrieverBM25
+        rag.INDEX_CACHE_DIR = cache_dir
+        rag.INDEX_CACHE_KEEP = max(rag.INDEX_CACHE_KEEP, 64)
+
+    def retriever(self, cfg, defaults):
+        rag = self.rag
+        full = {**defaults, **cfg}
+        ck = (full["chunk_size"], full["overlap"])
+        base = self.base.get(ck)
+        if base is None:
+            rag.CHUNK_SIZE, rag.CHUNK_OVERLAP = ck
+            t0 = time.perf_counter()
+            base = self.base[ck] = rag.get_retriever(use_cache=True)
+            print(f"[eval] 切块配置 chunk_size={ck[0]} overlap={ck[1]}：{len(base.chunks)} 段，"
+                  f"用时 {time.perf_counter() - t0:.1f}s", file=sys.stderr)
+        rag.RETRIEVAL_MODE = full["mode"]
+        rag.SEM_BLEND = full["blend"]
+        rag.HYBRID_ALPHA = full["alpha"]
+        if full["mode"] != "bm25" and base.emb is not None and base.ann is None:
+            base.ann = rag.build_ann(base.emb)
+        if (full["k1"], full["b"]) == (base.bm25.k1, base.bm25.b):
+            return base
+        return rag.RetrieverBM25(base.chunks, bm25=base.bm25.with_params(full["k1"], full["b"]),
+                                 emb=base.emb, files=base.files, norm_texts=base.norm_texts,
+                                 ann=base.ann)
+
+
+def _print_table(rows, ks):
+    cols = ["recall@%d" % k for k in ks] + ["mrr", "batch_ms_per_query", "p50_ms", "p95_ms"]
+    print("\t".join(["config"] + cols))
+    for row in rows:
+        cfg = " ".join(f"{k}={v}" for k, v in row["config"].items()) or "(默认)"
+        print("\t".join([cfg] + [str(row["metrics"].get(c, "")) for c in cols]))
+
+
+def main():
+    ap = argparse.ArgumentParser(description="RAG 检索效果 / 延迟评测")
+    ap.add_argument("--cases", required=True, help="问题集 JSONL（question + expected / expected_text）")
+    ap.add_argument("--ks", default="1,3,5,10", help="recall@k 的 k，逗号分隔")
+    ap.add_argument("--sweep", default="", help='参数扫描，如 "chunk_size=400,500;k1=1.2,1.5;blend=0.4,0.6"')
+    ap.add_argument("--batch", type=int, default=32, help="retrieve_batch 每批条数")
+    ap.add_argument("--latency-sample", type=int, default=50, help="逐条测单查询延迟的条数（0 不测）")
+    ap.add_argument("--cache-dir", default="./.eval_cache", help="各切块配置的索引缓存目录")
+    ap.add_argument("--out", default=None, help="结果 JSON 路径（默认只打印表格）")
+    args = ap.parse_args()
+
+    os.environ["QUERY_CACHE"] = "0"   # 评的是检索本身，不让结果缓存掩盖延迟
+    import rag_step1_bm25 as rag
+    rag.USE_QUERY_CACHE = False
+
+    cases = load_cases(args.cases)
+    if not cases:
+        raise SystemExit("[eval] 问题集为空")
+    ks = sorted({int(k) for k in args.ks.split(",") if k.strip()})
+    configs = parse_sweep(args.sweep) or [{}]
+    if any("chunk_size" in c or "overlap" in c for c in configs) and \
+            any(not c["expected_text"] for c in cases):
+        print("[eval] 提示：扫描切块参数时块号会变，只标了 source#idx 的问题在非默认切块下结果不可比，"
+              "建议补 expected_text", file=sys.stderr)
+
+    k1, b = rag._bm25_params()
+    defaults = {"chunk_size": rag.CHUNK_SIZE, "overlap": rag.CHUNK_OVERLAP, "k1": k1, "b": b,
+                "blend": rag.SEM_BLEND, "mode": rag.RETRIEVAL_MODE, "alpha": rag.HYBRID_ALPHA}
+    bench = Workbench(rag, args.cache_dir)
+
+    # 问题向量与切块无关，全程只编码一次
+    q_embs = rag.encode_queries([rag.normalize_query(c["question"]) for c in cases])
+
+    rows = []
+    for i, cfg in enumerate(configs, 1):
+        r = bench.retriever(cfg, defaults)
+        m = evaluate(r, cases, ks, q_embs=q_embs, batch=args.batch,
+                     latency_sample=args.latency_sample)
+        rows.append({"config": cfg, "metrics": m})
+        print(f"[eval] {i}/{len(configs)} {cfg or '(默认)'}：MRR {m['mrr']}，"
+              f"recall@{ks[-1]} {m[f'recall@{ks[-1]}']}", file=sys.stderr)
+
+    rows.sort(key=lambda row: -row["metrics"]["mrr"])
+    _print_table(rows, ks)
+    if args.out:
+        report = {"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "cases": len(cases), "ks": ks,
+                  "defaults": defaults, "semantic": q_embs is not None, "results": rows}
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"[eval] 结果已写入 {args.out}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
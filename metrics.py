@@ -0,0 +1,119 @@
+# metrics.py —— 极简 Prometheus 文本格式指标（不依赖 prometheus_client）
+# 用法：
+#   STAGE = Histogram("rag_stage_seconds", "检索各阶段耗时", ["stage"])
+#   with STAGE.time(stage="bm25"): ...
+#   ERRORS = Counter("bridge_upstream_errors_total", "上游调用失败次数", ["upstream"])
+#   ERRORS.inc(upstream="coze")
+#   render() 输出 /metrics 文本
+
+import time
+import threading
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_registry = {}   # 名称 -> 指标对象（同名重复注册时后者覆盖，便于模块重载）
+
+
+def _fmt_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    body = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+                    for k, v in pairs)
+    return "{" + body + "}"
+
+
+def _fmt_num(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def lines(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_num(v)}" for k, v in items]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.labelnames = name, help_text, tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self._data = {}   # 标签值 -> [各桶计数..., 总数, 总和]
+        self._lock = threading.Lock()
+        _registry[name] = self
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labelnames)
+        with self._lock:
+            d = self._data.get(key)
+            if d is None:
+                d = self._data[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    d[i] += 1
+            d[-2] += 1
+            d[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, **labels)
+
+    def lines(self):
+        with self._lock:
+            items = sorted((k, list(d)) for k, d in self._data.items())
+        out = []
+        for key, d in items:
+            for b, c in zip(self.buckets + (float("inf"),), d[:len(self.buckets)] + [d[-2]]):
+                out.append(f"{self.name}_bucket{_fmt_labels(self.labelnames, key, [('le', _fmt_num(b))])} {c}")
+            out.append(f"{self.name}_count{_fmt_labels(self.labelnames, key)} {d[-2]}")
+            out.append(f"{self.name}_sum{_fmt_labels(self.labelnames, key)} {_fmt_num(d[-1])}")
+        return out
+
+
+class CallbackMetric:
+    """抓取时才取值的指标（如缓存对象自己维护的命中计数），fn 返回 {标签值元组: 数值}"""
+
+    def __init__(self, name, help_text, kind, labelnames, fn):
+        self.name, self.help, self.kind = name, help_text, kind
+        self.labelnames, self.fn = tuple(labelnames), fn
+        _registry[name] = self
+
+    def lines(self):
+        try:
+            items = sorted(self.fn().items())
+        except Exception:
+            return []
+        return [f"{self.name}{_fmt_labels(self.labelnames, k)} {_fmt_num(v)}" for k, v in items]
+
+
+def render():
+    out = []
+    for name in sorted(_registry):
+        m = _registry[name]
+        out.append(f"# HELP {name} {m.help}")
+        out.append(f"# TYPE {name} {m.kind}")
+        out.extend(m.lines())
+    return "\n".join(out) + "\n"
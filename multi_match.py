@@ -0,0 +1,134 @@
+# multi_match.py —— 多模式串匹配：停用词 / 同义词 / 关键词规则一次扫描
+# 作用：规则上千条时，逐条 str.replace、逐条 `kw in text` 的开销是 规则数 × 文本长。
+#   - KeywordMatcher：所有模式串建成字典树，再编译成一个正则交给 re 引擎跑（共享前缀只比一次，
+#     不可能开头的位置按首字符集合直接跳过），一次扫描找出文本里出现的全部模式串（含重叠、互为前缀的）
+#   - ReplaceChain：结果与 `for k, v in rules: s = s.replace(k, v)` 逐字相同，但只执行文本里出现过的规则，
+#     以及前面的替换结果可能新造出来的规则（编译时预先算好“规则 i 的替换值会牵动哪些后续规则”）
+# 说明：纯 Python 逐字符跑 Aho-Corasick 自动机，比 C 实现的 str.replace 还慢，所以字典树交给 re 引擎执行。
+
+import re
+import heapq
+
+
+def _trie_regex(words):
+    """非空模式串 → 字典树形状的正则；同一起点总是匹配最长的模式串"""
+    trie = {}
+    for w in words:
+        node = trie
+        for ch in w:
+            node = node.setdefault(ch, {})
+        node[""] = True   # 终止标记
+
+    def build(node):
+        alts = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch]
+        if not alts:
+            return ""
+        body = alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+        return "(?:" + body + ")?" if "" in node else body
+
+    return build(trie)
+
+
+class KeywordMatcher:
+    """
+    一组模式串编译一次，find(text) 返回 text 里出现过的模式串集合（与逐个 `p in text` 的结果相同）。
+    re 引擎做一遍不重叠扫描（每处取最长的模式串 w），被 w 盖住的其他出现分两种：
+    完全落在 w 里面的，编译时就算好（implied）；从 w 中间开始、伸出 w 末尾的，只可能是少数几个，现查 `p in text`。
+    """
+
+    def __init__(self, patterns):
+        self.patterns = list(dict.fromkeys(patterns))
+        words = [p for p in self.patterns if p]
+        self._empty = {""} if len(words) < len(self.patterns) else set()   # 空串在任何文本里都“出现”
+        self._re = re.compile(_trie_regex(words)) if words else None
+        prefix_of = {}   # 模式串的真前缀 → 模式串
+        for w in words:
+            for j in range(1, len(w)):
+                prefix_of.setdefault(w[:j], []).append(w)
+        pset = set(words)
+        self._implied, self._cross = {}, {}
+        for w in words:
+            self._implied[w] = {w[a:b] for a in range(len(w)) for b in range(a + 1, len(w) + 1)
+                                if w[a:b] in pset}
+            self._cross[w] = [p for j in range(1, len(w)) for p in prefix_of.get(w[-j:], ())]
+
+    def find(self, text):
+        found = set(self._empty)
+        if self._re is None:
+            return found
+        cross = []
+        for w in set(self._re.findall(text)):
+            found |= self._implied[w]
+            cross += self._cross[w]
+        found.update(p for p in cross if p not in found and p in text)
+        return found
+
+
+class ReplaceChain:
+    """
+    按顺序的替换规则 [(k, v), ...]。apply(s) 与依次 s = s.replace(k, v) 结果相同：
+    某条规则的键在当时的文本里出现，要么原文里就有，要么与之前某次替换写进去的值有重叠（包含、被包含或首尾相接），
+    所以只需执行“原文里出现过的规则 + 已执行规则的值牵动的后续规则”，按原顺序执行。
+    有空键或空值时（空键会在每个字符间插入，空值删掉后两侧会拼成新串）退回逐条替换。
+    """
+
+    def __init__(self, rules):
+        self.rules = [(k, v) for k, v in rules]
+        self.exact = all(k and v for k, v in self.rules)
+        self.matcher = KeywordMatcher(k for k, _ in self.rules)
+        self._by_key = {}
+        for i, (k, _) in enumerate(self.rules):
+            self._by_key.setdefault(k, []).append(i)
+        self._follow = self._build_follow() if self.exact else None
+
+    def _build_follow(self):
+        """_follow[i]：规则 i 的值与其键有重叠的后续规则号"""
+        n = len(self.rules)
+        prefix_of, suffix_of = {}, {}   # 键的真前缀 / 真后缀 → 规则号
+        for i, (k, _) in enumerate(self.rules):
+            for j in range(1, len(k)):
+                prefix_of.setdefault(k[:j], []).append(i)
+                suffix_of.setdefault(k[-j:], []).append(i)
+        follow = [set() for _ in range(n)]
+        for i, (_, v) in enumerate(self.rules):
+            # 键在值里面
+            for k in self.matcher.find(v):
+                follow[i].update(self._by_key[k])
+            # 值的后缀接键的前缀 / 值的前缀接键的后缀
+            for j in range(1, len(v) + 1):
+                follow[i].update(prefix_of.get(v[-j:], ()))
+                follow[i].update(suffix_of.get(v[:j], ()))
+        # 值在键里面
+        values = KeywordMatcher(v for _, v in self.rules)
+        value_rules = {}
+        for i, (_, v) in enumerate(self.rules):
+            value_rules.setdefault(v, []).append(i)
+        for l, (k, _) in enumerate(self.rules):
+            for v in values.find(k):
+                for i in value_rules[v]:
+                    follow[i].add(l)
+        return [sorted(j for j in f if j > i) for i, f in enumerate(follow)]
+
+    def apply(self, s, present=None):
+        """present：原文里出现过的键（可多不可少），不传就现扫一遍"""
+        if not self.exact:
+            for k, v in self.rules:
+                s = s.replace(k, v)
+            return s
+        if present is None:
+            present = self.matcher.find(s)
+        todo = [i for k in present for i in self._by_key.get(k, ())]
+        heapq.heapify(todo)
+        done = set()
+        while todo:
+            i = heapq.heappop(todo)
+            if i in done:
+                continue
+            done.add(i)
+            k, v = self.rules[i]
+            if k in s:
+                s = s.replace(k, v)
+                for j in self._follow[i]:
+                    if j not in done:
+                        heapq.heappush(todo, j)
+        return s
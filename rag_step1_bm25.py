@@ -1,439 +1,1661 @@
-# rag_step1_bm25.py
-import os
-os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
-
-# --- 依赖 ---
-import os, re, glob, datetime
-import jieba
-from rank_bm25 import BM25Okapi
-from sentence_transformers import SentenceTransformer
-import numpy as np
-
-# ===================== 配置 =====================
-USE_SEMANTIC = True   # 设为 False 时仅用 BM25
-if USE_SEMANTIC:
-    _sem = SentenceTransformer("BAAI/bge-small-zh-v1.5")
-else:
-    _sem = None
-
-# KB 目录：从环境变量读取，默认 ./kb
-KB_DIR = os.getenv("KB_DIR", "./kb")
-
-# 每块目标字数/重叠字数（保持你的习惯）
-CHUNK_SIZE = 500
-CHUNK_OVERLAP = 150
-
-# 自定义词典：避免破坏业务词
-custom_words = [
-    "在籍续约","提前续约","效期生效","积分",
-    "PLUS会员","生活服务包","年卡","折算积分"
-]
-for w in custom_words:
-    jieba.add_word(w, freq=100)
-
-# 停用词 / 同义词归一
-STOPWORDS = ["您好","辛苦","核实","客户","反馈","用户名","问题：","请问","谢谢","麻烦","一下","表示"]
-SYNONYMS = {
-    "续约": "续费",
-    "开通": "开卡",
-    "发放": "下发",
-    "发": "下发",
-    "优惠卷": "优惠券"
-}
-
-# “必须包含/奖励/惩罚关键词”占位（保留你原有接口）
-MUST_ANY_LEFT  = []
-MUST_ANY_RIGHT = []
-CORE_KEYWORDS = []
-PAIR_BONUS    = []
-PENALTY_KEYWORDS = []
-
-
-# ===================== 工具函数 =====================
-def _cos(a, b):
-    return float(np.dot(a, b) / (np.linalg.norm(a) + 1e-9) / (np.linalg.norm(b) + 1e-9))
-
-def rerank_semantic(query, candidates, topk=4):
-    if not USE_SEMANTIC or _sem is None:
-        return [i for i, _, _ in candidates[:topk]]
-    q = normalize_text(query)
-    q_emb = _sem.encode([q], normalize_embeddings=True)[0]
-    d_emb = _sem.encode([normalize_text(t) for _, t, _ in candidates], normalize_embeddings=True)
-    rescored = []
-    for (i, t, bm25_s), e in zip(candidates, d_emb):
-        rescored.append((i, 0.4 * bm25_s + 0.6 * _cos(q_emb, e)))  # 混合权重
-    rescored.sort(key=lambda x: x[1], reverse=True)
-    return [i for i, _ in rescored[:topk]]
-
-def clean_text(s: str) -> str:
-    s = s.replace("\uFEFF", "").replace("\u200b", "")
-    s = re.sub(r"\?{3,}", "", s)
-    s = re.sub(r"[·•◦\t]+", " ", s)
-    s = s.replace("\r\n", "\n").replace("\r", "\n")
-    return s.strip()
-
-def normalize_text(s: str) -> str:
-    for sw in STOPWORDS:
-        s = s.replace(sw, " ")
-    s = re.sub(r"[^\u4e00-\u9fa5A-Za-z0-9，。；：、\-\(\)（）/ ]+"," ", s)
-    for k,v in SYNONYMS.items():
-        s = s.replace(k,v)
-    s = re.sub(r"\s{2,}"," ", s).strip()
-    return s
-
-def normalize_query(q: str) -> str:
-    for sw in STOPWORDS:
-        q = q.replace(sw, " ")
-    q = re.sub(r"[^\u4e00-\u9fa5A-Za-z0-9，。；：、\-\(\)（）/ ]+", " ", q)
-    for k, v in SYNONYMS.items():
-        q = q.replace(k, v)
-    q = re.sub(r"\s{2,}", " ", q).strip()
-    return q
-
-
-# ===================== 段落切分（关键改造） =====================
-_Q_PAT = re.compile(r"^\s*(?:Q:|Q：|问:|问：)\s*")
-_A_PAT = re.compile(r"^\s*(?:A:|A：|答:|答：)\s*")
-
-# 编号/标题行：1. / 1.1 / 2.3.4 / 1、 / 1) / （一） / 一、 等
-_HEADING_PATS = [
-    re.compile(r"^\s*\d+(?:\.\d+)*[、\.)]?\s+"),         # 1. / 1.1 / 1.2.3 / 1、 / 1) / 1.)
-    re.compile(r"^\s*[（(][一二三四五六七八九十]+[)）]\s*"), # （一）（二）
-    re.compile(r"^\s*[一二三四五六七八九十]+、\s*"),         # 一、二、三、
-    re.compile(r"^\s*[-•·*]\s+"),                        # - • · *
-]
-
-_SENT_SPLIT = re.compile(r"(?<=[。；！!？\?])")  # 句末分句
-
-def _is_heading(line: str) -> bool:
-    return any(p.match(line) for p in _HEADING_PATS)
-
-def _is_blank(line: str) -> bool:
-    return len(line.strip()) == 0
-
-def split_into_paragraphs(text: str):
-    """
-    目标：
-      1) 优先按“空行 / 标题编号行”切段
-      2) 若遇到 Q: 开头，则用状态机把 Q + A + 后续解释 合成一个完整块（直到下一个 Q: 或新的标题/空行）
-      3) 超长段再按句号/分号等断句拼块，尽量不切断句子
-    """
-    text = clean_text(text)
-    lines = text.split("\n")
-
-    parts = []
-    cur = []               # 普通段缓冲
-    qa_buf = []            # Q&A 段缓冲
-    in_qa = False
-    seen_a = False
-
-    def _flush_cur():
-        nonlocal cur
-        if cur:
-            s = "\n".join(cur).strip()
-            if s:
-                parts.append(s)
-        cur = []
-
-    def _flush_qa():
-        nonlocal qa_buf, in_qa, seen_a
-        if qa_buf:
-            s = "\n".join(qa_buf).strip()
-            if s:
-                parts.append(s)
-        qa_buf = []
-        in_qa = False
-        seen_a = False
-
-    for ln in lines:
-        # 命中新的标题/编号：切断当前缓冲
-        if _is_heading(ln):
-            if in_qa:
-                _flush_qa()
-            _flush_cur()
-            cur.append(ln)
-            continue
-
-        # 空行：结束一个逻辑段
-        if _is_blank(ln):
-            if in_qa:
-                _flush_qa()
-            else:
-                _flush_cur()
-            continue
-
-        # Q/A 状态机
-        if _Q_PAT.match(ln):
-            # 新的 Q 来了：切掉上一段（无论上一段是否普通/QA）
-            if in_qa:
-                _flush_qa()
-            else:
-                _flush_cur()
-            qa_buf = [ln]
-            in_qa = True
-            seen_a = False
-            continue
-
-        if in_qa:
-            if _Q_PAT.match(ln):
-                # 极端：Q 后又来了一个 Q（上一问没 A），也切段
-                _flush_qa()
-                qa_buf = [ln]
-                in_qa = True
-                seen_a = False
-                continue
-            if _A_PAT.match(ln):
-                seen_a = True
-                qa_buf.append(ln)
-                continue
-            # 既不是新 Q 也不是 A：就作为 Q/A 的补充说明
-            qa_buf.append(ln)
-            continue
-
-        # 普通行：拼进当前段
-        cur.append(ln)
-
-    # 文件结束，收尾
-    if in_qa:
-        _flush_qa()
-    else:
-        _flush_cur()
-
-    # 二次处理：把过长的 parts 再“按句子拼接”成 <= CHUNK_SIZE
-    paragraphs = []
-    for p in parts:
-        if len(p) <= CHUNK_SIZE:
-            paragraphs.append(p)
-        else:
-            sent = _SENT_SPLIT.split(p)
-            buf = ""
-            for s in sent:
-                if len(buf) + len(s) <= CHUNK_SIZE:
-                    buf += s
-                else:
-                    if buf:
-                        paragraphs.append(buf.strip())
-                    buf = s
-            if buf:
-                paragraphs.append(buf.strip())
-
-    return paragraphs
-
-
-# ===================== KB 读取与打包 =====================
-def read_kb_chunks():
-    """
-    读取 kb/*.txt：
-      1) 先用 split_into_paragraphs 做“结构化段落”切分（不切断句子/不切断 Q&A）
-      2) 在不破坏上一步边界的前提下，打包成 <= CHUNK_SIZE 的块
-      3) 对相邻块做字符级“尾部重叠” CHUNK_OVERLAP（仅作为上下文桥，不改变边界含义）
-    """
-    chunks = []
-    for path in glob.glob(os.path.join(KB_DIR, "*.txt")):
-        with open(path, "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read()
-        text = clean_text(text)
-        paras = split_into_paragraphs(text)
-
-        # 1) 段落打包（不打断结构化段）
-        blocks = []
-        cur, cur_len = "", 0
-        for para in paras:
-            if not cur:
-                cur = para
-                cur_len = len(para)
-            elif cur_len + 2 + len(para) <= CHUNK_SIZE:
-                cur = cur + "\n\n" + para
-                cur_len = len(cur)
-            else:
-                blocks.append(cur.strip())
-                cur = para
-                cur_len = len(para)
-        if cur:
-            blocks.append(cur.strip())
-
-        # 2) 滑动重叠：保留上一块的末尾 CHUNK_OVERLAP 字符，接到下一块开头
-        for i, blk in enumerate(blocks):
-            chunks.append({
-                "text": blk,
-                "source": os.path.basename(path),
-                "idx": i + 1
-            })
-            if i < len(blocks) - 1 and CHUNK_OVERLAP > 0:
-                overlap = blk[-CHUNK_OVERLAP:] if len(blk) > CHUNK_OVERLAP else blk
-                blocks[i + 1] = overlap + "\n\n" + blocks[i + 1]
-
-    return chunks
-
-# ======== 调试辅助：暴露分段与打包 ========
-
-def debug_split_paragraphs_from_text(text: str):
-    """
-    仅做“段落级”切分，不做打包/重叠，用于预览 split_into_paragraphs 的结果。
-    """
-    return split_into_paragraphs(clean_text(text))
-
-
-def debug_pack_paragraphs_to_blocks(paragraphs: list[str], chunk_size: int = None):
-    """
-    把段落按 CHUNK_SIZE 打包成“块”（不做重叠）并返回，便于你在接口里预览“块层”的结果。
-    """
-    if chunk_size is None:
-        chunk_size = CHUNK_SIZE
-    blocks = []
-    cur, cur_len = "", 0
-    for para in paragraphs:
-        if not cur:
-            cur = para
-            cur_len = len(para)
-        elif cur_len + 2 + len(para) <= chunk_size:
-            cur = cur + "\n\n" + para
-            cur_len = len(cur)
-        else:
-            blocks.append(cur.strip())
-            cur = para
-            cur_len = len(para)
-    if cur:
-        blocks.append(cur.strip())
-    return blocks
-
-# ===================== 检索器 =====================
-class RetrieverBM25:
-    def __init__(self, chunks):
-        self.chunks = chunks
-        tokenized = [list(jieba.cut(c["text"])) for c in chunks]
-        k1 = float(os.getenv("BM25_K1", "1.5"))
-        b  = float(os.getenv("BM25_B", "0.75"))
-        self.bm25 = BM25Okapi(tokenized, k1=k1, b=b)
-
-    def retrieve(self, query, topk=4):
-        q_norm = normalize_text(query)
-        q_tokens = list(jieba.cut(q_norm))
-
-        base_scores = self.bm25.get_scores(q_tokens)
-
-        # 必要词过滤（保持你的逻辑）
-        pool_both, pool_either = [], []
-        for i, c in enumerate(self.chunks):
-            t = normalize_text(c["text"])
-            has_left  = any(k in t for k in MUST_ANY_LEFT) if MUST_ANY_LEFT else True
-            has_right = any(k in t for k in MUST_ANY_RIGHT) if MUST_ANY_RIGHT else True
-            if has_left and has_right:
-                pool_both.append(i)
-            if has_left or has_right:
-                pool_either.append(i)
-
-        # 候选集放宽
-        idx_pool = pool_both
-        if len(idx_pool) < topk:
-            idx_pool = pool_either
-        if len(idx_pool) < topk:
-            idx_pool = list(range(len(self.chunks)))
-
-        topk = min(topk, len(idx_pool))
-
-        # 业务加权
-        scored = []
-        for i in idx_pool:
-            t_doc = normalize_text(self.chunks[i]["text"])
-            bonus = 0.0
-            for kw, w in CORE_KEYWORDS:
-                if kw in t_doc: bonus += w
-            for a, b, w in PAIR_BONUS:
-                if (a in t_doc) and (b in t_doc): bonus += w
-            for kw, w in PENALTY_KEYWORDS:
-                if kw in t_doc: bonus -= w
-            scored.append((i, base_scores[i] + bonus))
-
-        scored.sort(key=lambda x: x[1], reverse=True)
-        N = min(30, len(scored))
-        candidates = [(i, self.chunks[i]["text"], base_scores[i]) for i, _ in scored[:N]]
-
-        if USE_SEMANTIC and _sem is not None and len(candidates) > 0:
-            final_idxs = rerank_semantic(q_norm, candidates, topk=topk)
-        else:
-            final_idxs = [i for i, _ in scored[:topk]]
-
-        results = []
-        for i in final_idxs:
-            c = self.chunks[i]
-            results.append({
-                "score": round(float(base_scores[i]), 3),
-                "text": c["text"],
-                "source": c["source"],
-                "idx": c["idx"],
-            })
-        return results
-
-
-# ===================== 调试 & 导出 =====================
-def pretty_print_hits(hits, show_chars=None):
-    print("\n===== 命中明细（完整片段）=====")
-    for i, h in enumerate(hits, 1):
-        print(f"[Top{i}] 来源：{h['source']}#段{h['idx']} | 分数={h['score']}")
-        text = h["text"].replace("\r", " ").replace("\n", " ")
-        if show_chars is None:
-            print(text)
-        else:
-            print(text[:show_chars] + ("…" if len(text) > show_chars else ""))
-        print("-" * 60)
-
-def export_hits_to_txt(query, hits, out_path=None):
-    if out_path is None:
-        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        out_path = f"hits_{ts}.txt"
-    lines = []
-    lines.append(f"【问题】{query}\n")
-    for i, h in enumerate(hits, 1):
-        lines.append(f"[Top{i}] 来源：{h['source']}#段{h['idx']} | 分数={h['score']}")
-        lines.append(h["text"])
-        lines.append("\n" + "=" * 80 + "\n")
-    with open(out_path, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
-    print(f"已导出命中结果到：{out_path}")
-
-def get_retriever():
-    chunks = read_kb_chunks()
-    print(f"[loader] 知识块加载完成：{len(chunks)} 段")
-    return RetrieverBM25(chunks)
-
-
-# ===================== 直接运行自测 =====================
-if __name__ == "__main__":
-    chunks = read_kb_chunks()
-    print(f"已加载知识块：{len(chunks)} 段")
-
-    retriever = RetrieverBM25(chunks)
-
-    queries = [
-        "您好用户名：jd_66d0a9851510b客户进线询问她的会员明天过期她兑换了洗车服务问洗车服务会随着会员过期而无法使用吗？",
-        "积分兑换的商品是否可以开发票",
-        "洗车多久过期",
-        "Q：为什么积分只有9分？A：……"
-    ]
-    for q in queries:
-        q_norm = normalize_text(q)
-        print("\n【问题】", q)
-        print("[debug] 归一后：", q_norm)
-        hits = retriever.retrieve(q_norm, topk=4)
-        for h in hits:
-            print(f"- 命中：{h['source']}#段{h['idx']}  分数={h['score']}")
-            print("  片段：", h["text"][:120].replace("\n", " "), "…")
-
-    # 导出示例
-    from datetime import datetime
-    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
-    out_path = f"hits_{ts}.txt"
-    with open(out_path, "w", encoding="utf-8") as f:
-        for q in queries:
-            q_norm = normalize_text(q)
-            f.write(f"【问题】{q}\n")
-            hits = retriever.retrieve(q_norm, topk=4)
-            for i, h in enumerate(hits, 1):
-                text_full = h["text"].replace("\r", " ").replace("\n", " ")
-                f.write(f"[Top{i}] 来源：{h['source']}#段{h['idx']} | 分数={h['score']}\n")
-                f.write(text_full + "\n" + "=" * 80 + "\n")
-            f.write("\n")
-
-    print(f"已导出命中结果到：{out_path}")
-
+# rag_step1_bm25.py
+import os
+os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
+
+# --- 依赖 ---
+import os, re, glob, datetime, time, json, hashlib, shutil, math, threading, itertools, contextlib, gc, ctypes
+import multiprocessing
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+try:
+    import fcntl   # 建索引的文件锁；Windows 上没有，退回不加锁
+except ImportError:
+    fcntl = None
+from ann_index import IVFIndex, exact_search
+from chunk_store import ChunkStore, ChunkStoreBuilder, StringArray
+from multi_match import KeywordMatcher, ReplaceChain
+from emb_quant import EMB_KINDS, QuantizedEmbeddings, store_embeddings, score_rows
+from tokenizer import JiebaTokenizer
+from ttl_cache import TTLCache
+from metrics import Histogram, Counter, CallbackMetric
+
+# ===================== 配置 =====================
+# 语义模型：首次用到时才加载（import 本模块不再拉起 torch），服务端可在启动后后台预热
+USE_SEMANTIC = os.getenv("USE_SEMANTIC", "1") != "0"   # 设为 0 时仅用 BM25
+SEM_MODEL_NAME = os.getenv("SEM_MODEL", "BAAI/bge-small-zh-v1.5")
+SEM_DEVICE = os.getenv("SEM_DEVICE") or None          # cpu / cuda / mps；留空由 sentence-transformers 自选
+# 块向量的存储精度：float32（默认）/ float16（内存减半）/ int8（约 1/4，每个向量一个缩放系数）
+EMB_DTYPE = os.getenv("EMB_DTYPE", "float32").lower()
+if EMB_DTYPE not in EMB_KINDS:
+    print(f"[semantic] EMB_DTYPE={EMB_DTYPE} 无效，改用 float32")
+    EMB_DTYPE = "float32"
+# 语义重排的混合权重：(1 - SEM_BLEND) * bm25 + SEM_BLEND * 余弦
+SEM_BLEND = float(os.getenv("SEM_BLEND", "0.6"))
+_sem = None
+_sem_lock = threading.Lock()
+sem_state = {"loading": False, "load_ms": None, "error": None}
+
+# KB 目录：从环境变量读取，默认 ./kb
+KB_DIR = os.getenv("KB_DIR", "./kb")
+
+# 每块目标字数/重叠字数（保持你的习惯）
+CHUNK_SIZE = 500
+CHUNK_OVERLAP = 150
+
+# 索引磁盘缓存：按“KB 文件内容 + 切分/词典/同义词配置”的哈希分目录存放
+USE_INDEX_CACHE = os.getenv("INDEX_CACHE", "1") != "0"
+INDEX_CACHE_DIR = os.getenv("INDEX_CACHE_DIR", "./.index_cache")
+INDEX_CACHE_VERSION = 6   # 缓存格式有变化就 +1，旧目录自动失效
+INDEX_CACHE_KEEP = int(os.getenv("INDEX_CACHE_KEEP", "3"))  # 最多保留几份历史缓存
+# 多 worker 共享索引：同一缓存目录同时只有一个进程建索引（文件锁），其余进程等它写完直接 mmap 加载；
+# 建索引的进程自己也换成 mmap 的那份，所有 worker 的索引数据落在同一份页缓存上，加 worker 不再成倍加内存
+INDEX_SHARED = os.getenv("INDEX_SHARED", "1") != "0"
+# 独立建索引进程最多等多少秒（持有建索引文件锁期间，其余 worker 都在等它）；超时就结束它、改在本进程建，<=0 不限
+INDEX_BUILD_TIMEOUT = float(os.getenv("INDEX_BUILD_TIMEOUT", "600"))
+# 持有建索引锁的进程号：锁住期间写进环境变量，spawn 出的子进程（建索引进程、入库进程池 worker）继承后据此认出自己
+_BUILD_OWNER_ENV = "RAG_INDEX_BUILD_OWNER"
+
+# 并行入库：读文件 / 切段 / 打包 / 分词按文件分给进程池（0 = CPU 核数，1 = 串行）
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "0"))
+INGEST_MIN_BYTES = int(os.getenv("INGEST_MIN_BYTES", str(8 * 1024 * 1024)))  # KB 总量小于此值时串行，省去起进程的开销
+INGEST_START_METHOD = os.getenv("INGEST_START_METHOD", "spawn")  # 服务进程里有后台线程，默认不用 fork
+
+# 检索模式：
+#   bm25   = BM25 初筛 top30 + 语义重排（默认，原有逻辑）
+#   dense  = 只用向量召回（能找回与问题没有字面重合的改写问法）
+#   hybrid = BM25 与向量召回两路融合，融合方式见 HYBRID_FUSION
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "bm25").lower()
+HYBRID_FUSION = os.getenv("HYBRID_FUSION", "rrf").lower()   # rrf：倒数名次融合；weighted：归一化分数加权
+HYBRID_ALPHA = float(os.getenv("HYBRID_ALPHA", "0.5"))      # weighted 时 BM25 一路的权重
+RRF_K = int(os.getenv("RRF_K", "60"))
+DENSE_CANDIDATES = int(os.getenv("DENSE_CANDIDATES", "30"))  # 向量召回每路取多少候选
+ANN_MIN_CHUNKS = int(os.getenv("ANN_MIN_CHUNKS", "5000"))    # 块数少于此值时直接暴力全扫
+ANN_NPROBE = int(os.getenv("ANN_NPROBE", "8"))              # IVF 每次查询扫描的簇数
+ANN_REBUILD_RATIO = float(os.getenv("ANN_REBUILD_RATIO", "0.2"))  # 增量重建时变动块占比超过此值就重新聚类
+
+# 检索结果缓存：键为 (索引版本, 规则版本, 检索模式, normalize_query 结果, topk)，换索引后旧条目自然失效
+USE_QUERY_CACHE = os.getenv("QUERY_CACHE", "1") != "0"
+QUERY_CACHE_MAX_ENTRIES = int(os.getenv("QUERY_CACHE_MAX_ENTRIES", "4096"))
+QUERY_CACHE_MAX_BYTES = int(os.getenv("QUERY_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "600"))   # 秒，<=0 不过期
+query_cache = TTLCache(QUERY_CACHE_MAX_ENTRIES, QUERY_CACHE_MAX_BYTES, QUERY_CACHE_TTL)
+
+# 指标（/metrics）：各阶段耗时、降级次数、结果缓存命中
+STAGE_SECONDS = Histogram("rag_stage_seconds", "检索各阶段耗时（秒）", ["stage"])
+RAG_FALLBACKS = Counter("rag_fallback_total", "检索降级次数", ["reason"])
+CallbackMetric("rag_query_cache_total", "检索结果缓存查找次数", "counter", ["result"],
+               lambda: {("hit",): query_cache.hits, ("miss",): query_cache.misses})
+_index_versions = itertools.count(1)
+
+# 批量检索时 BM25 分数矩阵（查询数 × 块数）最多多少格，超过就分批算，约 64MB
+BATCH_SCORE_CELLS = 8_000_000
+
+# 自定义词典：避免破坏业务词
+custom_words = [
+    "在籍续约","提前续约","效期生效","积分",
+    "PLUS会员","生活服务包","年卡","折算积分"
+]
+# 分词器：默认词典 + 业务词建好后缓存到 TOKENIZER_CACHE_DIR，get_retriever 开头统一初始化
+tokenizer = JiebaTokenizer(custom_words, freq=100)
+
+# 停用词 / 同义词归一
+STOPWORDS = ["您好","辛苦","核实","客户","反馈","用户名","问题：","请问","谢谢","麻烦","一下","表示"]
+SYNONYMS = {
+    "续约": "续费",
+    "开通": "开卡",
+    "发放": "下发",
+    "发": "下发",
+    "优惠卷": "优惠券"
+}
+
+# “必须包含/奖励/惩罚关键词”占位（保留你原有接口）
+MUST_ANY_LEFT  = []
+MUST_ANY_RIGHT = []
+CORE_KEYWORDS = []
+PAIR_BONUS    = []
+PENALTY_KEYWORDS = []
+
+
+# ===================== 工具函数 =====================
+def get_sem_model():
+    """返回语义模型；第一次调用时加载（加锁，并发调用只加载一次）。关闭或加载失败时返回 None，退回仅 BM25"""
+    global _sem
+    if not USE_SEMANTIC:
+        return None
+    if _sem is not None:
+        return _sem
+    with _sem_lock:
+        if _sem is None and sem_state["error"] is None:
+            sem_state["loading"] = True
+            t0 = time.time()
+            try:
+                from sentence_transformers import SentenceTransformer
+                _sem = SentenceTransformer(SEM_MODEL_NAME, device=SEM_DEVICE)
+                sem_state["load_ms"] = int((time.time() - t0) * 1000)
+                print(f"[semantic] 模型加载完成：{SEM_MODEL_NAME}，用时 {sem_state['load_ms']} ms")
+            except Exception as e:
+                sem_state["error"] = f"{type(e).__name__}: {e}"
+                print(f"[semantic] 模型加载失败，仅用 BM25：{sem_state['error']}")
+            finally:
+                sem_state["loading"] = False
+    return _sem
+
+def preload_sem_model(background=True):
+    """预热语义模型；background=True 时在后台线程里加载，返回线程对象"""
+    if not USE_SEMANTIC or _sem is not None:
+        return None
+    if not background:
+        get_sem_model()
+        return None
+    t = threading.Thread(target=get_sem_model, name="sem-preload", daemon=True)
+    t.start()
+    return t
+
+def semantic_status():
+    return {
+        "enabled": USE_SEMANTIC,
+        "model": SEM_MODEL_NAME,
+        "device": SEM_DEVICE,
+        "warm": _sem is not None,
+        "loading": sem_state["loading"],
+        "load_ms": sem_state["load_ms"],
+        "error": sem_state["error"],
+    }
+
+def _cos(a, b):
+    return float(np.dot(a, b) / (np.linalg.norm(a) + 1e-9) / (np.linalg.norm(b) + 1e-9))
+
+def encode_chunks(chunks, batch_size=64, norm_texts=None):
+    """
+    建索引时把所有块一次性编码成向量矩阵：float32、已归一化、C 连续。
+    查询时只需编码 query，候选块直接按行号取向量。
+    norm_texts：已算好的 normalize_text 结果，传入可省一遍归一化。
+    """
+    if not chunks:
+        return None
+    sem = get_sem_model()
+    if sem is None:
+        return None
+    if norm_texts is None:
+        norm = get_normalizer()
+        norm_texts = [norm(c["text"]) for c in chunks]
+    emb = sem.encode(norm_texts,
+                      normalize_embeddings=True, batch_size=batch_size)
+    return np.ascontiguousarray(emb, dtype=np.float32)
+
+def encode_queries(queries, batch_size=64):
+    """多条 query 一次 encode（批量检索用），与 rerank_semantic 里单条编码的归一化方式相同"""
+    if not queries:
+        return None
+    sem = get_sem_model()
+    if sem is None:
+        return None
+    norm = get_normalizer()
+    emb = sem.encode([norm(q) for q in queries],
+                      normalize_embeddings=True, batch_size=batch_size)
+    return np.ascontiguousarray(emb, dtype=np.float32)
+
+def rerank_semantic(query, candidates, topk=4, emb=None, q_emb=None):
+    """
+    candidates: [(块行号, 文本, bm25分)]；emb 为 encode_chunks 预计算的矩阵。
+    有 emb 时一次矩阵乘法算完所有候选的余弦（向量已归一化），否则退回现场编码。
+    q_emb：已编码好的 query 向量（批量检索时由 encode_queries 一次算好）。
+    """
+    sem = get_sem_model()
+    if sem is None:
+        return [i for i, _, _ in candidates[:topk]]
+    if q_emb is None:
+        q = normalize_text(query)
+        q_emb = sem.encode([q], normalize_embeddings=True)[0]
+    if emb is not None:
+        idxs = np.array([i for i, _, _ in candidates], dtype=np.int64)
+        bm25_s = np.array([s for _, _, s in candidates], dtype=np.float64)
+        sims = score_rows(emb, np.asarray(q_emb, dtype=np.float32), idxs)
+        mixed = (1 - SEM_BLEND) * bm25_s + SEM_BLEND * sims  # 混合权重
+        order = np.argsort(-mixed, kind="stable")[:topk]
+        return [int(idxs[j]) for j in order]
+    d_emb = sem.encode([normalize_text(t) for _, t, _ in candidates], normalize_embeddings=True)
+    rescored = []
+    for (i, t, bm25_s), e in zip(candidates, d_emb):
+        rescored.append((i, (1 - SEM_BLEND) * bm25_s + SEM_BLEND * _cos(q_emb, e)))  # 混合权重
+    rescored.sort(key=lambda x: x[1], reverse=True)
+    return [i for i, _ in rescored[:topk]]
+
+def _clean_fragment(s: str) -> str:
+    """clean_text 去掉首尾空白之前的部分；各步都不跨 \n，可以逐行做"""
+    s = s.replace("\uFEFF", "").replace("\u200b", "")
+    s = re.sub(r"\?{3,}", "", s)
+    s = re.sub(r"[·•◦\t]+", " ", s)
+    return s.replace("\r\n", "\n").replace("\r", "\n")
+
+def clean_text(s: str) -> str:
+    return _clean_fragment(s).strip()
+
+_NON_TEXT = re.compile(r"[^\u4e00-\u9fa5A-Za-z0-9，。；：、\-\(\)（）/ ]+")
+_MULTI_SPACE = re.compile(r"\s{2,}")
+
+class _Normalizer:
+    """
+    STOPWORDS / SYNONYMS 编译后的归一化：一次扫描原文找出出现的停用词和同义词键，只执行这些替换，
+    结果与逐条 replace（停用词 → 空格 → 字符过滤 → 同义词按 dict 顺序 → 合并空白）完全一致。
+    停用词替换和字符过滤只会写进空格，含空格的同义词键原文里没有也可能出现，所以总是执行。
+    """
+
+    def __init__(self, stopwords, synonyms):
+        self.stop = ReplaceChain((w, " ") for w in stopwords)
+        self.syn = ReplaceChain(synonyms.items())
+        self.matcher = KeywordMatcher(list(stopwords) + list(synonyms))
+        self.syn_always = {k for k in synonyms if " " in k}
+
+    def __call__(self, s):
+        found = self.matcher.find(s)
+        s = self.stop.apply(s, found)
+        s = _NON_TEXT.sub(" ", s)
+        s = self.syn.apply(s, found | self.syn_always)
+        return _MULTI_SPACE.sub(" ", s).strip()
+
+_normalizer = (None, None)   # (规则快照, _Normalizer)
+
+def get_normalizer():
+    """当前 STOPWORDS / SYNONYMS 对应的归一化函数；规则被改过（含整体替换）就重新编译。批量归一化时取一次循环里用"""
+    global _normalizer
+    key = (tuple(STOPWORDS), tuple(SYNONYMS.items()))
+    if _normalizer[0] != key:
+        _normalizer = (key, _Normalizer(STOPWORDS, SYNONYMS))
+    return _normalizer[1]
+
+def normalize_text(s: str) -> str:
+    return get_normalizer()(s)
+
+def normalize_query(q: str) -> str:
+    return get_normalizer()(q)
+
+
+# ===================== 段落切分（关键改造） =====================
+_Q_PAT = re.compile(r"^\s*(?:Q:|Q：|问:|问：)\s*")
+_A_PAT = re.compile(r"^\s*(?:A:|A：|答:|答：)\s*")
+
+# 编号/标题行：1. / 1.1 / 2.3.4 / 1、 / 1) / （一） / 一、 等
+_HEADING_PATS = [
+    re.compile(r"^\s*\d+(?:\.\d+)*[、\.)]?\s+"),         # 1. / 1.1 / 1.2.3 / 1、 / 1) / 1.)
+    re.compile(r"^\s*[（(][一二三四五六七八九十]+[)）]\s*"), # （一）（二）
+    re.compile(r"^\s*[一二三四五六七八九十]+、\s*"),         # 一、二、三、
+    re.compile(r"^\s*[-•·*]\s+"),                        # - • · *
+]
+
+_SENT_SPLIT = re.compile(r"(?<=[。；！!？\?])")  # 句末分句
+
+def _is_heading(line: str) -> bool:
+    return any(p.match(line) for p in _HEADING_PATS)
+
+def _is_blank(line: str) -> bool:
+    return len(line.strip()) == 0
+
+class _PartBuffer:
+    """
+    一个逻辑段（普通段或 Q&A 段）的流式缓冲，等价于原来的 "\n".join(行).strip() 再做超长段断句：
+      - 段长不超过 CHUNK_SIZE 时整段缓着，flush 时原样产出
+      - 一旦超过 CHUNK_SIZE，就边收行边按句末标点断句，完整的句子立刻按 <= CHUNK_SIZE 拼好产出，
+        只留最后半句在缓冲里 —— 所以内存只和 CHUNK_SIZE 与最长一句有关，和段长无关
+    """
+
+    def __init__(self):
+        self._reset()
+
+    def _reset(self):
+        self.text = ""        # 还没产出的段落文本（已去掉段首空白）
+        self.started = False
+        self.split = False    # 是否已进入断句模式
+        self.buf = ""         # 断句模式下正在拼的块
+
+    def __bool__(self):
+        return self.started
+
+    def add(self, ln):
+        if not self.started:
+            self.text, self.started = ln.lstrip(), True
+        else:
+            self.text += "\n" + ln
+        if not self.split and len(self.text.rstrip()) > CHUNK_SIZE:
+            self.split = True
+        if self.split:
+            sent = _SENT_SPLIT.split(self.text)
+            self.text = sent.pop()    # 最后一段还没遇到句末标点，留着等下一行
+            yield from self._pack(sent)
+
+    def flush(self):
+        text = self.text.rstrip()
+        if self.split:
+            yield from self._pack(_SENT_SPLIT.split(text))
+            if self.buf:
+                yield self.buf.strip()
+        elif text:
+            yield text
+        self._reset()
+
+    def _pack(self, sent):
+        for s in sent:
+            if len(self.buf) + len(s) <= CHUNK_SIZE:
+                self.buf += s
+            else:
+                if self.buf:
+                    yield self.buf.strip()
+                self.buf = s
+
+
+def iter_paragraphs(lines):
+    """
+    目标：
+      1) 优先按“空行 / 标题编号行”切段
+      2) 若遇到 Q: 开头，则用状态机把 Q + A + 后续解释 合成一个完整块（直到下一个 Q: 或新的标题/空行）
+      3) 超长段再按句号/分号等断句拼块，尽量不切断句子
+    lines 为已清洗的行（可以是逐行读文件的生成器），段落边读边产出。
+    """
+    cur = _PartBuffer()       # 普通段缓冲
+    qa_buf = _PartBuffer()    # Q&A 段缓冲
+    in_qa = False
+    seen_a = False
+
+    for ln in lines:
+        # 命中新的标题/编号：切断当前缓冲
+        if _is_heading(ln):
+            if in_qa:
+                yield from qa_buf.flush()
+                in_qa = seen_a = False
+            yield from cur.flush()
+            yield from cur.add(ln)
+            continue
+
+        # 空行：结束一个逻辑段
+        if _is_blank(ln):
+            if in_qa:
+                yield from qa_buf.flush()
+                in_qa = seen_a = False
+            else:
+                yield from cur.flush()
+            continue
+
+        # Q/A 状态机
+        if _Q_PAT.match(ln):
+            # 新的 Q 来了：切掉上一段（无论上一段是否普通/QA）
+            if in_qa:
+                yield from qa_buf.flush()
+            else:
+                yield from cur.flush()
+            yield from qa_buf.add(ln)
+            in_qa = True
+            seen_a = False
+            continue
+
+        if in_qa:
+            if _A_PAT.match(ln):
+                seen_a = True
+            # A 行，或既不是新 Q 也不是 A：就作为 Q/A 的补充说明
+            yield from qa_buf.add(ln)
+            continue
+
+        # 普通行：拼进当前段
+        yield from cur.add(ln)
+
+    # 文件结束，收尾
+    if in_qa:
+        yield from qa_buf.flush()
+    else:
+        yield from cur.flush()
+
+
+def split_into_paragraphs(text: str):
+    """整段文本版：清洗后按行喂给 iter_paragraphs，返回段落列表"""
+    return list(iter_paragraphs(clean_text(text).split("\n")))
+
+
+# ===================== KB 读取与打包 =====================
+def read_kb_chunks():
+    """
+    读取 kb/*.txt：
+      1) 先用 split_into_paragraphs 做“结构化段落”切分（不切断句子/不切断 Q&A）
+      2) 在不破坏上一步边界的前提下，打包成 <= CHUNK_SIZE 的块
+      3) 对相邻块做字符级“尾部重叠” CHUNK_OVERLAP（仅作为上下文桥，不改变边界含义）
+    """
+    chunks = []
+    for path in kb_paths():
+        chunks.extend(read_file_chunks(path))
+    return chunks
+
+def kb_paths():
+    return glob.glob(os.path.join(KB_DIR, "*.txt"))
+
+def iter_file_lines(path):
+    """
+    逐行读 kb 文件并做与 clean_text 相同的清洗，不把整个文件读进内存（\r\n、\r 在读入时已转成 \n）。
+    clean_text 最后的 strip() 会去掉文件末尾的空白（影响最后一行是否算标题，如 "1.2 "），
+    所以最后一个非空行要等到确认后面只剩空白行才产出。
+    """
+    pending, blanks = None, 0
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        for raw in f:
+            s = _clean_fragment(raw)
+            if s.endswith("\n"):
+                s = s[:-1]
+            for ln in s.split("\n"):
+                if _is_blank(ln):
+                    blanks += 1
+                    continue
+                if pending is not None:
+                    yield pending
+                for _ in range(blanks):
+                    yield ""
+                pending, blanks = ln, 0
+    if pending is not None:
+        yield pending.rstrip()
+
+def iter_blocks(paragraphs, chunk_size=None):
+    """段落打包（不打断结构化段）：相邻段落用空行拼成 <= chunk_size 的块，边收边产出"""
+    if chunk_size is None:
+        chunk_size = CHUNK_SIZE
+    cur, cur_len = "", 0
+    for para in paragraphs:
+        if not cur:
+            cur = para
+            cur_len = len(para)
+        elif cur_len + 2 + len(para) <= chunk_size:
+            cur = cur + "\n\n" + para
+            cur_len = len(cur)
+        else:
+            yield cur.strip()
+            cur = para
+            cur_len = len(para)
+    if cur:
+        yield cur.strip()
+
+def iter_overlapped(blocks):
+    """滑动重叠：保留上一块（含它自己的重叠前缀）的末尾 CHUNK_OVERLAP 字符，接到下一块开头"""
+    prev = None
+    for blk in blocks:
+        if prev is not None and CHUNK_OVERLAP > 0:
+            overlap = prev[-CHUNK_OVERLAP:] if len(prev) > CHUNK_OVERLAP else prev
+            blk = overlap + "\n\n" + blk
+        yield blk
+        prev = blk
+
+def iter_file_chunks(path):
+    """
+    单个 kb 文件 → 块（切段 + 打包 + 重叠），idx 在文件内从 1 开始。
+    逐行读、边切边产出：除了已产出的块，内存里只有当前段 / 当前块 / 上一块，
+    峰值与 CHUNK_SIZE 同量级（单行或单句超长时按最长的那一行/句算），和文件大小无关。
+    """
+    source = os.path.basename(path)
+    blocks = iter_blocks(iter_paragraphs(iter_file_lines(path)))
+    for i, text in enumerate(iter_overlapped(blocks), start=1):
+        yield {"text": text, "source": source, "idx": i}
+
+def read_file_chunks(path):
+    """单个 kb 文件 → 块列表（切段 + 打包 + 重叠），idx 在文件内从 1 开始"""
+    return list(iter_file_chunks(path))
+
+# ======== 调试辅助：暴露分段与打包 ========
+
+def debug_split_paragraphs_from_text(text: str):
+    """
+    仅做“段落级”切分，不做打包/重叠，用于预览 split_into_paragraphs 的结果。
+    """
+    return split_into_paragraphs(clean_text(text))
+
+
+def debug_pack_paragraphs_to_blocks(paragraphs: list[str], chunk_size: int = None):
+    """
+    把段落按 CHUNK_SIZE 打包成“块”（不做重叠）并返回，便于你在接口里预览“块层”的结果。
+    """
+    return list(iter_blocks(paragraphs, chunk_size))
+
+# ===================== 并行入库 =====================
+def _ingest_worker_init(cfg):
+    """进程池 worker 初始化：同步切分 / 归一化配置，从主进程写好的词典缓存载入分词器"""
+    global CHUNK_SIZE, CHUNK_OVERLAP, STOPWORDS, SYNONYMS
+    CHUNK_SIZE, CHUNK_OVERLAP = cfg["chunk_size"], cfg["chunk_overlap"]
+    STOPWORDS, SYNONYMS = cfg["stopwords"], cfg["synonyms"]
+    custom_words[:] = cfg["custom_words"]
+    tokenizer.cache_dir = cfg["tokenizer_cache_dir"]
+    tokenizer.initialize()
+
+def _ingest_config():
+    """子进程（入库进程池 / 建索引进程）要从主进程同步的切分、归一化、分词配置"""
+    return {"chunk_size": CHUNK_SIZE, "chunk_overlap": CHUNK_OVERLAP, "stopwords": STOPWORDS,
+            "synonyms": SYNONYMS, "custom_words": list(custom_words),
+            "tokenizer_cache_dir": tokenizer.cache_dir}
+
+def _ingest_file(path):
+    """
+    单个 kb 文件 → 切块 + 归一化文本 + 文件内的词频统计（worker 里跑）。
+    词频按文件内首次出现的顺序编局部词号，回传紧凑的 int32 数组，主进程按文件顺序合并。
+    """
+    chunks = read_file_chunks(path)
+    norm = get_normalizer()
+    norm_texts = [norm(c["text"]) for c in chunks]
+    vocab, coo, doc_len = {}, (array("i"), array("i"), array("i")), {}
+    BM25Index._count_docs(enumerate(_tokenize_chunks(chunks)), vocab, coo, doc_len)
+    return {"chunks": chunks, "norm_texts": norm_texts, "terms": list(vocab),
+            "coo": tuple(x.tobytes() for x in coo), "doc_len": [doc_len[d] for d in range(len(chunks))]}
+
+def _ingest_workers(paths):
+    """按配置与 KB 体量决定进程数，返回 1 表示串行"""
+    n = INGEST_WORKERS if INGEST_WORKERS > 0 else (os.cpu_count() or 1)
+    n = min(n, len(paths))
+    if n <= 1:
+        return 1
+    if sum(os.path.getsize(p) for p in paths) < INGEST_MIN_BYTES:
+        return 1
+    return n
+
+def ingest_files(paths, progress=None):
+    """
+    多个 kb 文件 → 每个文件一份 _ingest_file 结果（与 paths 同序）。
+    文件多且总量够大时分给进程池并行处理；结果按 paths 顺序收集，块的 idx、词号与串行完全一致。
+    """
+    n = _ingest_workers(paths)
+    if n == 1:
+        parts = []
+        for i, path in enumerate(paths):
+            _report(progress, "chunk", i, len(paths))
+            parts.append(_ingest_file(path))
+        return parts
+    tokenizer.initialize()   # 先在主进程建好 / 写好词典缓存，worker 直接读
+    cfg = _ingest_config()
+    print(f"[loader] 并行入库：{len(paths)} 个文件，{n} 个进程")
+    ctx = multiprocessing.get_context(INGEST_START_METHOD)
+    parts = []
+    with ProcessPoolExecutor(max_workers=n, mp_context=ctx, initializer=_ingest_worker_init,
+                             initargs=(cfg,)) as pool:
+        for i, part in enumerate(pool.map(_ingest_file, paths)):
+            _report(progress, "chunk", i, len(paths))
+            parts.append(part)
+    return parts
+
+
+# ===================== 向量召回 / 融合 =====================
+def build_ann(emb, old=None, n_changed=0):
+    """
+    dense/hybrid 模式且块数 >= ANN_MIN_CHUNKS 时建 IVF 索引。
+    old 为增量重建前的 IVF 索引：只有块数变化不大（sqrt(N) 与旧 nlist 相差不到 2 倍）、
+    且变动块（新增 + 删除）不超过 ANN_REBUILD_RATIO 时才沿用旧簇中心只重新分簇，否则重新聚类。
+    """
+    if RETRIEVAL_MODE not in ("dense", "hybrid") or emb is None or len(emb) < ANN_MIN_CHUNKS:
+        return None
+    centroids = None
+    if old is not None:
+        nlist, ideal = len(old.centroids), math.sqrt(len(emb))
+        if ideal / 2 <= nlist <= ideal * 2 and n_changed <= ANN_REBUILD_RATIO * len(emb):
+            centroids = old.centroids
+        else:
+            print(f"[loader] 块数 / 变动较大（nlist={nlist}，N={len(emb)}，变动 {n_changed} 段），向量索引重新聚类")
+    return IVFIndex.build(emb, nprobe=ANN_NPROBE, centroids=centroids)
+
+def fuse_rankings(lists, topk, method=None, alpha=None):
+    """
+    多路排名融合。lists：[[(块号, 分数), ...], ...]，每路已按分数降序，第一路为 BM25。
+      - rrf：sum(1 / (RRF_K + 名次))，只看名次，不受各路分数量纲影响
+      - weighted：每路分数 min-max 归一到 [0,1] 后按 HYBRID_ALPHA / 1-HYBRID_ALPHA 加权
+    同分按首次出现的先后。
+    """
+    method = method or HYBRID_FUSION
+    alpha = HYBRID_ALPHA if alpha is None else alpha
+    fused = {}
+    for li, lst in enumerate(lists):
+        if not lst:
+            continue
+        if method == "weighted":
+            w = alpha if li == 0 else (1 - alpha) / max(1, len(lists) - 1)
+            vals = [s for _, s in lst]
+            lo, hi = min(vals), max(vals)
+            for i, sc in lst:
+                norm = (sc - lo) / (hi - lo) if hi > lo else 1.0
+                fused[i] = fused.get(i, 0.0) + w * norm
+        else:
+            for rank, (i, _) in enumerate(lst, 1):
+                fused[i] = fused.get(i, 0.0) + 1.0 / (RRF_K + rank)
+    ranked = sorted(fused.items(), key=lambda x: x[1], reverse=True)
+    return [i for i, _ in ranked[:topk]]
+
+
+# ===================== 检索器 =====================
+def _bm25_params():
+    return float(os.getenv("BM25_K1", "1.5")), float(os.getenv("BM25_B", "0.75"))
+
+def _tokenize_chunks(chunks):
+    return [tokenizer.cut(c["text"]) for c in chunks]
+
+def _stable_top_n(ids, vals, n):
+    """按 vals 降序、同分按 ids 升序取前 n，等价于稳定降序排序后截断，但只对入围者排序"""
+    if n <= 0:
+        return ids[:0], vals[:0]
+    if len(vals) > n:
+        kth = np.partition(vals, len(vals) - n)[len(vals) - n]
+        keep = vals >= kth
+        ids, vals = ids[keep], vals[keep]
+    order = np.lexsort((ids, -vals))[:n]
+    return ids[order], vals[order]
+
+class TermVocab:
+    """
+    从索引缓存加载的只读词表：词按词号顺序存成 StringArray，另存一份按 UTF-8 字节排序的词号（order），
+    查词走二分。整个词表是 mmap 的，多个 worker 共用同一份页缓存，不再各自建一个几百万项的 dict。
+    用法与 dict 相同：vocab.get(w)、len(vocab)、按词号顺序迭代。
+    """
+
+    def __init__(self, terms, order):
+        self.terms = terms      # StringArray，第 i 个为词号 i 的词
+        self.order = order      # int32[V]，按 UTF-8 字节升序排列的词号
+
+    @classmethod
+    def from_terms(cls, terms):
+        """terms：按词号顺序的词列表（str 按码位比较与 UTF-8 字节序一致）"""
+        terms = list(terms)
+        order = np.asarray(sorted(range(len(terms)), key=terms.__getitem__), dtype=np.int32)
+        return cls(StringArray.from_strings(terms), order)
+
+    def get(self, w, default=None):
+        key = w.encode("utf-8")
+        lo, hi = 0, len(self.order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            tid = int(self.order[mid])
+            t = self.terms.raw(tid)
+            if t < key:
+                lo = mid + 1
+            elif t > key:
+                hi = mid
+            else:
+                return tid
+        return default
+
+    def __getitem__(self, w):
+        tid = self.get(w)
+        if tid is None:
+            raise KeyError(w)
+        return tid
+
+    def __contains__(self, w):
+        return self.get(w) is not None
+
+    def __len__(self):
+        return len(self.terms)
+
+    def __iter__(self):
+        return iter(self.terms)
+
+    def keys(self):
+        return iter(self.terms)
+
+    def save(self, d, name):
+        self.terms.save(d, name)
+        np.save(os.path.join(d, f"{name}_order.npy"), np.asarray(self.order))
+
+    @classmethod
+    def load(cls, d, name, mmap_mode="r"):
+        return cls(StringArray.load(d, name, mmap_mode=mmap_mode),
+                   np.load(os.path.join(d, f"{name}_order.npy"), mmap_mode=mmap_mode))
+
+
+class BM25Index:
+    """
+    自带的 BM25（Okapi）倒排索引：词表 → postings，postings 按 CSR 存成
+    indptr / doc_ids / tfs 三个数组（同一词内 doc_id 递增）。
+    打分只遍历查询词的 postings；idf 公式、负 idf 的 epsilon 下限、分数与 rank_bm25.BM25Okapi 一致。
+    """
+    ARRAYS = ("indptr", "doc_ids", "tfs", "doc_len", "idf", "weights")
+
+    def __init__(self, vocab, indptr, doc_ids, tfs, doc_len, k1=1.5, b=0.75, epsilon=0.25,
+                 idf=None, weights=None):
+        self.vocab = vocab                      # 词 → 词号（按语料中首次出现的顺序）
+        self.indptr = indptr                    # int64[V+1]
+        self.doc_ids = doc_ids                  # int32[P]
+        self.tfs = tfs                          # int32[P]
+        self.doc_len = doc_len                  # float64[N]
+        self.k1, self.b, self.epsilon = k1, b, epsilon
+        self.corpus_size = len(doc_len)
+        self.avgdl = float(doc_len.sum()) / self.corpus_size if self.corpus_size else 0.0
+        self.idf = idf if idf is not None else self._calc_idf()
+        # 每条 posting 的 tf 饱和项，与 idf 相乘即为该词对该块的贡献
+        self.weights = weights if weights is not None else self._calc_weights()
+
+    def with_params(self, k1, b):
+        """同一份 postings 换 k1/b（idf 与 k1/b 无关，直接沿用；只重算 tf 饱和项），调参扫描用"""
+        return BM25Index(self.vocab, self.indptr, self.doc_ids, self.tfs, self.doc_len,
+                         k1, b, self.epsilon, idf=self.idf)
+
+    @classmethod
+    def from_tokenized(cls, tokenized, k1=None, b=None):
+        """由分词结果（每块一个词列表）建索引"""
+        if k1 is None or b is None:
+            k1, b = _bm25_params()
+        coo = (array("i"), array("i"), array("i"))
+        doc_len = {}
+        vocab = {}
+        cls._count_docs(enumerate(tokenized), vocab, coo, doc_len)
+        return cls._from_coo(vocab, coo, doc_len, len(tokenized), k1, b)
+
+    @classmethod
+    def from_parts(cls, parts, k1=None, b=None):
+        """由 ingest_files 的逐文件统计合并建索引，结果与对全部分词调用 from_tokenized 相同"""
+        if k1 is None or b is None:
+            k1, b = _bm25_params()
+        coo = (array("i"), array("i"), array("i"))
+        doc_len = {}
+        vocab = {}
+        offset = 0
+        for part in parts:
+            cls._merge_part(part, offset, vocab, coo, doc_len)
+            offset += len(part["chunks"])
+        return cls._from_coo(vocab, coo, doc_len, offset, k1, b)
+
+    @staticmethod
+    def _merge_part(part, offset, vocab, coo, doc_len):
+        """把一个文件的局部统计追加进全局 COO：局部词号按出现顺序映射到全局词号，块号加上 offset"""
+        gid = np.fromiter((vocab.setdefault(w, len(vocab)) for w in part["terms"]),
+                          dtype=np.int32, count=len(part["terms"]))
+        term_ids, doc_ids, tfs = (np.frombuffer(x, dtype=np.int32) for x in part["coo"])
+        coo[0].frombytes(gid[term_ids].tobytes())
+        coo[1].frombytes((doc_ids + np.int32(offset)).tobytes())
+        coo[2].frombytes(tfs.tobytes())
+        doc_len.update(enumerate(part["doc_len"], start=offset))
+
+    @staticmethod
+    def _count_docs(docs, vocab, coo, doc_len):
+        """统计 (块号, 分词) 序列的词频，追加到 COO 三元组 (词号, 块号, 词频)；新词按出现顺序编号"""
+        term_ids, doc_ids, tfs = coo
+        for d, toks in docs:
+            counts = {}
+            for w in toks:
+                counts[w] = counts.get(w, 0) + 1
+            for w, c in counts.items():
+                tid = vocab.get(w)
+                if tid is None:
+                    tid = vocab[w] = len(vocab)
+                term_ids.append(tid)
+                doc_ids.append(d)
+                tfs.append(c)
+            doc_len[d] = len(toks)
+
+    @classmethod
+    def _from_coo(cls, vocab, coo, doc_len, n_docs, k1, b):
+        term_ids, doc_ids, tfs = (np.frombuffer(x, dtype=np.int32) for x in coo)
+        order = np.lexsort((doc_ids, term_ids))
+        counts = np.bincount(term_ids, minlength=len(vocab))
+        indptr = np.zeros(len(vocab) + 1, dtype=np.int64)
+        np.cumsum(counts, out=indptr[1:])
+        dl = np.zeros(n_docs, dtype=np.float64)
+        if doc_len:
+            dl[np.fromiter(doc_len.keys(), dtype=np.int64)] = np.fromiter(doc_len.values(), dtype=np.float64)
+        return cls(vocab, indptr, np.ascontiguousarray(doc_ids[order]),
+                   np.ascontiguousarray(tfs[order]), dl, k1=k1, b=b)
+
+    def _calc_idf(self):
+        # 与 BM25Okapi._calc_idf 同样的逐词顺序累加，保证平均 idf（进而 epsilon 下限）逐位一致
+        df = np.diff(self.indptr).tolist()
+        idf = np.zeros(len(df), dtype=np.float64)
+        idf_sum, n_terms, negative = 0.0, 0, []
+        for tid, freq in enumerate(df):
+            if freq == 0:
+                continue   # 增量重建后已无任何块包含的词
+            v = math.log(self.corpus_size - freq + 0.5) - math.log(freq + 0.5)
+            idf[tid] = v
+            idf_sum += v
+            n_terms += 1
+            if v < 0:
+                negative.append(tid)
+        self.average_idf = idf_sum / n_terms if n_terms else 0.0
+        if negative:
+            idf[negative] = self.epsilon * self.average_idf
+        return idf
+
+    def _calc_weights(self):
+        if not len(self.tfs):
+            return np.zeros(0, dtype=np.float64)
+        denom = self.k1 * (1 - self.b + self.b * self.doc_len / self.avgdl)
+        tf = self.tfs.astype(np.float64)
+        return tf * (self.k1 + 1) / (tf + denom[self.doc_ids])
+
+    def _term_slices(self, tokens):
+        for w in tokens:
+            tid = self.vocab.get(w)
+            if tid is None:
+                continue
+            s, e = int(self.indptr[tid]), int(self.indptr[tid + 1])
+            if s < e:
+                yield tid, s, e
+
+    def get_scores(self, tokens):
+        """所有块的 BM25 分（长度 = 块数），同 BM25Okapi.get_scores"""
+        scores = np.zeros(self.corpus_size, dtype=np.float64)
+        for tid, s, e in self._term_slices(tokens):
+            scores[self.doc_ids[s:e]] += self.idf[tid] * self.weights[s:e]
+        return scores
+
+    def top_n(self, tokens, n):
+        """
+        只在命中查询词的块里取前 n：返回 (块号数组, 分数数组)，按分数降序、同分按块号升序，
+        与对 get_scores 做稳定降序排序取前 n 的结果相同，但不生成全长分数数组。
+        命中的正分块不足 n 个时，退回全量排序补齐 0 分块。
+        """
+        n = min(n, self.corpus_size)
+        parts = list(self._term_slices(tokens))
+        if parts:
+            docs = np.concatenate([self.doc_ids[s:e] for _, s, e in parts])
+            vals = np.concatenate([self.idf[tid] * self.weights[s:e] for tid, s, e in parts])
+            uniq, inv = np.unique(docs, return_inverse=True)
+            sums = np.bincount(inv, weights=vals, minlength=len(uniq))
+            pos = sums > 0
+            if int(pos.sum()) >= n:
+                ids, vals = _stable_top_n(uniq[pos].astype(np.int64), sums[pos], n)
+                return ids, vals
+        scores = self.get_scores(tokens)
+        return _stable_top_n(np.arange(self.corpus_size), scores, n)
+
+    def score_docs(self, tokens, docs):
+        """只算指定块的 BM25 分（在每个词的 postings 里二分查找），与 get_scores 对应位置相同"""
+        docs = np.asarray(docs, dtype=np.int64)
+        out = np.zeros(len(docs), dtype=np.float64)
+        if not len(docs):
+            return out
+        for tid, s, e in self._term_slices(tokens):
+            seg = self.doc_ids[s:e]
+            pos = np.minimum(np.searchsorted(seg, docs), len(seg) - 1)
+            hit = seg[pos] == docs
+            out[hit] += self.idf[tid] * self.weights[s:e][pos[hit]]
+        return out
+
+    def get_scores_batch(self, token_lists):
+        """
+        多条查询一起打分，返回 [查询数, 块数] 的分数矩阵。
+        按词位置逐轮推进：同一轮里用到同一个词的查询共用一次 postings 读取、一次成块累加；
+        每条查询仍按自身词序累加，所以每一行与单独调用 get_scores 逐位相同。
+        """
+        scores = np.zeros((len(token_lists), self.corpus_size), dtype=np.float64)
+        tids = [[self.vocab.get(w) for w in toks] for toks in token_lists]
+        for p in range(max(map(len, tids), default=0)):
+            groups = {}
+            for row, ts in enumerate(tids):
+                if p < len(ts) and ts[p] is not None:
+                    groups.setdefault(ts[p], []).append(row)
+            for tid, rows in groups.items():
+                s, e = int(self.indptr[tid]), int(self.indptr[tid + 1])
+                if s < e:
+                    scores[np.ix_(rows, self.doc_ids[s:e])] += self.idf[tid] * self.weights[s:e]
+        return scores
+
+    def patched(self, remap, added, n_docs):
+        """
+        增量重建：remap[旧块号] = 新块号（-1 表示删除），added = [(首个新块号, ingest_files 的逐文件结果)]。
+        保留块的 postings 直接搬过去，合并新增文件的词频，然后重排成新的 CSR；self 不被修改。
+        """
+        remap = np.asarray(remap, dtype=np.int64)
+        term_of = np.repeat(np.arange(len(self.vocab), dtype=np.int32), np.diff(self.indptr))
+        new_doc = remap[self.doc_ids]
+        keep = new_doc >= 0
+        coo = (array("i", term_of[keep].tobytes()),
+               array("i", new_doc[keep].astype(np.int32).tobytes()),
+               array("i", np.asarray(self.tfs[keep], dtype=np.int32).tobytes()))
+        old_keep = np.flatnonzero(remap >= 0)
+        doc_len = dict(zip(remap[old_keep].tolist(), np.asarray(self.doc_len[old_keep]).astype(np.int64).tolist()))
+        vocab = {w: i for i, w in enumerate(self.vocab)}   # 词表按词号顺序迭代（dict / TermVocab 都是）
+        for offset, part in added:
+            self._merge_part(part, offset, vocab, coo, doc_len)
+        return self._from_coo(vocab, coo, doc_len, n_docs, self.k1, self.b)
+
+    def save(self, d):
+        for name in self.ARRAYS:
+            np.save(os.path.join(d, f"bm25_{name}.npy"), getattr(self, name))
+        vocab = self.vocab if isinstance(self.vocab, TermVocab) else TermVocab.from_terms(self.vocab)
+        vocab.save(d, "bm25_vocab")
+        with open(os.path.join(d, "bm25_params.json"), "w", encoding="utf-8") as f:
+            json.dump({"k1": self.k1, "b": self.b, "epsilon": self.epsilon}, f)
+
+    @classmethod
+    def load(cls, d, mmap_mode="r"):
+        with open(os.path.join(d, "bm25_params.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrs = {name: np.load(os.path.join(d, f"bm25_{name}.npy"), mmap_mode=mmap_mode)
+                for name in cls.ARRAYS}
+        vocab = TermVocab.load(d, "bm25_vocab", mmap_mode=mmap_mode)
+        return cls(vocab, arrs["indptr"], arrs["doc_ids"], arrs["tfs"], arrs["doc_len"],
+                   k1=meta["k1"], b=meta["b"], epsilon=meta["epsilon"],
+                   idf=arrs["idf"], weights=arrs["weights"])
+
+class RetrieverBM25:
+    def __init__(self, chunks, tokenized=None, bm25=None, emb=None, files=None, norm_texts=None,
+                 ann=None):
+        """
+        bm25 / emb / norm_texts 可由索引缓存或增量重建直接传入，缺哪个就现算哪个；
+        tokenized 为已有的分词结果（只在需要新建 BM25Index 时用到）。
+        files：建索引时 kb 文件的 mtime/size/sha1 清单，供增量 reload 比对。
+        ann：向量近似最近邻索引（IVFIndex），dense/hybrid 模式且块数够多时才需要。
+        """
+        # 块正文集中存成 ChunkStore（UTF-8 blob + 偏移数组），按下标取出的仍是 {"text","source","idx"}
+        if not isinstance(chunks, ChunkStore):
+            chunks = ChunkStore.from_chunks(chunks)
+        self.chunks = chunks
+        # 块文本的 normalize_text 结果只算一次，关键词规则和向量编码都用它
+        if norm_texts is None:
+            norm = get_normalizer()
+            norm_texts = [norm(c["text"]) for c in chunks]
+        self.norm_texts = norm_texts
+        if bm25 is None:
+            if tokenized is None:
+                tokenized = _tokenize_chunks(chunks)
+            bm25 = BM25Index.from_tokenized(tokenized)
+        self.bm25 = bm25
+        self.files = files
+        # 语义向量：建索引时一次算好，检索时按行取；EMB_DTYPE 为 float16 / int8 时压缩存放
+        if emb is None:
+            emb = encode_chunks(chunks, norm_texts=norm_texts)
+        self.emb = store_embeddings(emb, EMB_DTYPE)
+        self.ann = ann if ann is not None else build_ann(self.emb)
+        self.version = next(_index_versions)   # 结果缓存用：每个检索器对象一个版本号
+        self.cache_key = None                   # 对应的索引缓存 key（从缓存加载 / 写过缓存时才有）
+        self._rules_key = None
+        self._rules_gen = 0
+        self._ensure_rule_masks()
+
+    def _ensure_rule_masks(self):
+        """
+        把 MUST_ANY_LEFT/RIGHT、CORE_KEYWORDS、PAIR_BONUS、PENALTY_KEYWORDS
+        预先算成逐块的布尔掩码和加分向量；规则列表被改过就重算。
+        """
+        key = (tuple(MUST_ANY_LEFT), tuple(MUST_ANY_RIGHT), tuple(map(tuple, CORE_KEYWORDS)),
+               tuple(map(tuple, PAIR_BONUS)), tuple(map(tuple, PENALTY_KEYWORDS)))
+        if key == self._rules_key:
+            return
+        n = len(self.norm_texts)
+        # 所有规则关键词编译成一个匹配器，每块只扫一遍，记下每个词出现在哪些块里
+        kws = list(itertools.chain(MUST_ANY_LEFT, MUST_ANY_RIGHT, (k for k, _ in CORE_KEYWORDS),
+                                   (k for a, b, _ in PAIR_BONUS for k in (a, b)),
+                                   (k for k, _ in PENALTY_KEYWORDS)))
+        rows = {kw: [] for kw in kws}
+        if kws:
+            matcher = KeywordMatcher(kws)
+            for i, t in enumerate(self.norm_texts):
+                for kw in matcher.find(t):
+                    rows[kw].append(i)
+        masks = {}
+
+        def _has(kw):
+            if kw not in masks:
+                masks[kw] = np.zeros(n, dtype=bool)
+                masks[kw][rows[kw]] = True
+            return masks[kw]
+
+        def _has_any(kws):
+            if not kws:
+                return np.ones(n, dtype=bool)
+            return np.logical_or.reduce([_has(k) for k in kws])
+
+        left, right = _has_any(MUST_ANY_LEFT), _has_any(MUST_ANY_RIGHT)
+        self.mask_both = left & right
+        self.mask_either = left | right
+        bonus = np.zeros(n, dtype=np.float64)
+        for kw, w in CORE_KEYWORDS:
+            bonus += np.where(_has(kw), w, 0.0)
+        for a, b, w in PAIR_BONUS:
+            bonus += np.where(_has(a) & _has(b), w, 0.0)
+        for kw, w in PENALTY_KEYWORDS:
+            bonus -= np.where(_has(kw), w, 0.0)
+        self.bonus = bonus
+        # 规则全空时（当前默认）候选池就是全部块且没有加分，可以走倒排 top-n 快路径
+        self.rules_trivial = bool(self.mask_both.all() and not bonus.any())
+        self._rules_key = key
+        self._rules_gen += 1
+
+    def _cache_key(self, q_norm, topk):
+        return (self.version, self._rules_gen, RETRIEVAL_MODE, q_norm, topk)
+
+    @staticmethod
+    def _cache_put(key, hits):
+        size = 200 + sum(len(h["text"].encode("utf-8")) + len(h["source"]) + 100 for h in hits)
+        query_cache.put(key, [dict(h) for h in hits], size)
+
+    def retrieve(self, query, topk=4):
+        with STAGE_SECONDS.time(stage="normalize"):
+            q_norm = normalize_query(query)
+        with STAGE_SECONDS.time(stage="filter"):
+            self._ensure_rule_masks()
+        if not USE_QUERY_CACHE:
+            return self._retrieve(q_norm, topk)
+        key = self._cache_key(q_norm, topk)
+        hits = query_cache.get(key)
+        if hits is None:
+            hits = self._retrieve(q_norm, topk)
+            self._cache_put(key, hits)
+        return [dict(h) for h in hits]
+
+    def _retrieve(self, q_norm, topk):
+        with STAGE_SECONDS.time(stage="tokenize"):
+            q_tokens = tokenizer.cut(q_norm)
+        if self.rules_trivial:
+            # 没有过滤/加分规则：只对命中查询词的块打分取前若干，不生成全长分数数组
+            topk = min(topk, len(self.chunks))
+            with STAGE_SECONDS.time(stage="bm25"):
+                ranked, top_scores = self.bm25.top_n(q_tokens, max(30, topk))
+            base_scores = dict(zip(ranked.tolist(), top_scores.tolist()))
+        else:
+            with STAGE_SECONDS.time(stage="bm25"):
+                base_scores = self.bm25.get_scores(q_tokens)
+            with STAGE_SECONDS.time(stage="filter"):
+                ranked, topk = self._rank_pool(base_scores, topk)
+        return self._finish(q_norm, ranked, base_scores, topk, q_tokens=q_tokens)
+
+    def retrieve_batch(self, queries, topk=4, q_embs=None):
+        """
+        批量检索：一起归一化/分词，所有 query 一次 encode，BM25 按 [查询 × 块] 矩阵打分
+        （矩阵过大时按 BATCH_SCORE_CELLS 分批）。返回与 queries 同序的命中列表。
+        开启结果缓存时只对未命中的 query 走批量打分。
+        q_embs：已编码好的 query 向量（与 queries 同序，如评测扫参时复用），不传则现场 encode。
+        """
+        with STAGE_SECONDS.time(stage="normalize"):
+            norm = get_normalizer()
+            q_norms = [norm(q) for q in queries]
+        with STAGE_SECONDS.time(stage="filter"):
+            self._ensure_rule_masks()
+        if not USE_QUERY_CACHE:
+            return self._retrieve_batch(q_norms, topk, q_embs)
+        keys = [self._cache_key(q, topk) for q in q_norms]
+        results = [query_cache.get(k) for k in keys]
+        miss = [i for i, r in enumerate(results) if r is None]
+        if miss:
+            # 同一批里重复的问题只算一次
+            first = {}
+            for i in miss:
+                first.setdefault(q_norms[i], i)
+            uniq = list(first)
+            sub_embs = q_embs[[first[q] for q in uniq]] if q_embs is not None else None
+            fresh = dict(zip(uniq, self._retrieve_batch(uniq, topk, sub_embs)))
+            for q in uniq:
+                self._cache_put(self._cache_key(q, topk), fresh[q])
+            for i in miss:
+                results[i] = fresh[q_norms[i]]
+        return [[dict(h) for h in r] for r in results]
+
+    def _retrieve_batch(self, q_norms, topk, q_embs=None):
+        with STAGE_SECONDS.time(stage="tokenize"):
+            q_tokens = [tokenizer.cut(q) for q in q_norms]
+        if q_embs is None:
+            with STAGE_SECONDS.time(stage="encode"):
+                q_embs = encode_queries(q_norms) if len(self.chunks) else None
+
+        n = len(self.chunks)
+        step = max(1, BATCH_SCORE_CELLS // max(1, n))
+        results = []
+        for start in range(0, len(q_norms), step):
+            with STAGE_SECONDS.time(stage="bm25"):
+                mat = self.bm25.get_scores_batch(q_tokens[start:start + step])
+            for j, base_scores in enumerate(mat):
+                i = start + j
+                if self.rules_trivial:
+                    k = min(topk, n)
+                    ranked, _ = _stable_top_n(np.arange(n), base_scores, max(30, k))
+                else:
+                    with STAGE_SECONDS.time(stage="filter"):
+                        ranked, k = self._rank_pool(base_scores, topk)
+                q_emb = q_embs[i] if q_embs is not None else None
+                results.append(self._finish(q_norms[i], ranked, base_scores, k,
+                                            q_emb=q_emb, q_tokens=q_tokens[i]))
+        return results
+
+    def _rank_pool(self, base_scores, topk):
+        """必要词过滤 + 业务加权后的块排序，返回 (排好序的块号, 实际 topk)"""
+        # 必要词过滤（保持你的逻辑），掩码在建索引时已算好
+        idx_pool = np.flatnonzero(self.mask_both)
+
+        # 候选集放宽
+        if len(idx_pool) < topk:
+            RAG_FALLBACKS.inc(reason="rule_pool_relaxed")
+            idx_pool = np.flatnonzero(self.mask_either)
+        if len(idx_pool) < topk:
+            idx_pool = np.arange(len(self.chunks))
+
+        topk = min(topk, len(idx_pool))
+
+        # 业务加权：同分保持块顺序（稳定排序），与逐块 sort 的结果一致
+        pool_scores = base_scores[idx_pool] + self.bonus[idx_pool]
+        return idx_pool[np.argsort(-pool_scores, kind="stable")], topk
+
+    def dense_search(self, q_emb, k, mask=None):
+        """向量召回：块数多时走 IVF 近似检索，否则暴力全扫。返回 (块号数组, 余弦数组)"""
+        q_emb = np.asarray(q_emb, dtype=np.float32)
+        if self.ann is not None:
+            return self.ann.search(self.emb, q_emb, k, mask=mask)
+        return exact_search(self.emb, q_emb, k, mask=mask)
+
+    def _finish(self, q_norm, ranked, base_scores, topk, q_emb=None, q_tokens=None):
+        """
+        bm25 模式：取前 30 个候选做语义重排（或直接截断）；
+        dense / hybrid 模式：向量召回（限定在过滤后的候选池内），hybrid 再与 BM25 排名融合。
+        最后组装命中结果。
+        """
+        N = min(30, len(ranked))
+        use_dense = (RETRIEVAL_MODE in ("dense", "hybrid") and self.emb is not None
+                     and topk > 0 and get_sem_model() is not None)
+
+        if use_dense:
+            if q_emb is None:
+                with STAGE_SECONDS.time(stage="encode"):
+                    q_emb = encode_queries([q_norm])[0]
+            # 规则过滤生效时 ranked 就是整个候选池；否则不限制
+            mask = None
+            if not self.rules_trivial:
+                mask = np.zeros(len(self.chunks), dtype=bool)
+                mask[ranked] = True
+            with STAGE_SECONDS.time(stage="dense"):
+                d_ids, d_sims = self.dense_search(q_emb, max(DENSE_CANDIDATES, topk), mask=mask)
+            if RETRIEVAL_MODE == "dense":
+                final_idxs = [int(i) for i in d_ids[:topk]]
+            else:
+                bm25_list = [(int(i), float(base_scores[int(i)])) for i in ranked[:N]]
+                dense_list = list(zip(d_ids.tolist(), d_sims.tolist()))
+                final_idxs = fuse_rankings([bm25_list, dense_list], topk)
+            if isinstance(base_scores, dict):
+                # top-n 快路径只有 BM25 前几名的分数，向量召回来的块补算一下
+                missing = [i for i in final_idxs if i not in base_scores]
+                if missing:
+                    base_scores = {**base_scores, **dict(zip(missing, self.bm25.score_docs(q_tokens or [], missing).tolist()))}
+        else:
+            candidates = [(int(i), self.chunks.text(i), base_scores[int(i)]) for i in ranked[:N]]
+            if len(candidates) > 0 and get_sem_model() is not None:
+                if q_emb is None:
+                    with STAGE_SECONDS.time(stage="encode"):
+                        q_emb = encode_queries([q_norm])[0]
+                with STAGE_SECONDS.time(stage="rerank"):
+                    final_idxs = rerank_semantic(q_norm, candidates, topk=topk, emb=self.emb, q_emb=q_emb)
+            else:
+                if USE_SEMANTIC and len(candidates) > 0:
+                    RAG_FALLBACKS.inc(reason="semantic_unavailable")
+                final_idxs = [int(i) for i in ranked[:topk]]
+
+        results = []
+        for i in final_idxs:
+            c = self.chunks[i]
+            results.append({
+                "score": round(float(base_scores[i]), 3),
+                "text": c["text"],
+                "source": c["source"],
+                "idx": c["idx"],
+            })
+        return results
+
+
+# ===================== 调试 & 导出 =====================
+def pretty_print_hits(hits, show_chars=None):
+    print("\n===== 命中明细（完整片段）=====")
+    for i, h in enumerate(hits, 1):
+        print(f"[Top{i}] 来源：{h['source']}#段{h['idx']} | 分数={h['score']}")
+        text = h["text"].replace("\r", " ").replace("\n", " ")
+        if show_chars is None:
+            print(text)
+        else:
+            print(text[:show_chars] + ("…" if len(text) > show_chars else ""))
+        print("-" * 60)
+
+def export_hits_to_txt(query, hits, out_path=None):
+    if out_path is None:
+        ts = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        out_path = f"hits_{ts}.txt"
+    lines = []
+    lines.append(f"【问题】{query}\n")
+    for i, h in enumerate(hits, 1):
+        lines.append(f"[Top{i}] 来源：{h['source']}#段{h['idx']} | 分数={h['score']}")
+        lines.append(h["text"])
+        lines.append("\n" + "=" * 80 + "\n")
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.write("\n".join(lines))
+    print(f"已导出命中结果到：{out_path}")
+
+# ===================== 索引磁盘缓存 =====================
+def scan_kb_files(paths=None, prev=None):
+    """
+    列出 kb 文件及其 mtime/size/sha1。prev 为上一次的清单：
+    mtime 与 size 都没变的文件直接沿用旧 sha1，不再读内容。
+    """
+    if paths is None:
+        paths = kb_paths()
+    prev_by_src = {f["source"]: f for f in (prev or [])}
+    files = []
+    for path in paths:
+        st = os.stat(path)
+        src = os.path.basename(path)
+        old = prev_by_src.get(src)
+        if old and old["mtime"] == st.st_mtime_ns and old["size"] == st.st_size:
+            digest = old["sha1"]
+        else:
+            with open(path, "rb") as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+        files.append({"source": src, "path": path, "mtime": st.st_mtime_ns,
+                      "size": st.st_size, "sha1": digest})
+    return files
+
+def kb_fingerprint(files=None) -> str:
+    """
+    索引缓存的 key：所有 kb 文件（按加载顺序）的名字与内容哈希，
+    加上会影响切块/分词/向量的配置。任何一项变化都会得到新 key。
+    """
+    if files is None:
+        files = scan_kb_files()
+    h = hashlib.sha1()
+    cfg = {
+        "version": INDEX_CACHE_VERSION,
+        "chunk_size": CHUNK_SIZE,
+        "chunk_overlap": CHUNK_OVERLAP,
+        "custom_words": custom_words,
+        "stopwords": STOPWORDS,
+        "synonyms": SYNONYMS,
+        "bm25_k1": os.getenv("BM25_K1", "1.5"),
+        "bm25_b": os.getenv("BM25_B", "0.75"),
+        "semantic": bool(USE_SEMANTIC),
+        "model": SEM_MODEL_NAME,
+        "emb_dtype": EMB_DTYPE,
+    }
+    h.update(json.dumps(cfg, ensure_ascii=False, sort_keys=True).encode("utf-8"))
+    for f in files:
+        h.update(f"{f['source']}\0{f['sha1']}\n".encode("utf-8"))
+    return h.hexdigest()
+
+def _index_cache_path(key: str) -> str:
+    return os.path.join(INDEX_CACHE_DIR, f"v{INDEX_CACHE_VERSION}-{key[:20]}")
+
+def load_index_cache(key: str):
+    """命中则返回 RetrieverBM25（块正文、归一化文本、BM25、词表、向量都以 mmap 方式加载），否则返回 None"""
+    d = _index_cache_path(key)
+    meta_path = os.path.join(d, "meta.json")
+    if not os.path.isfile(meta_path):
+        return None
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        if meta.get("key") != key:
+            return None
+        with open(os.path.join(d, "files.json"), "r", encoding="utf-8") as f:
+            files = json.load(f)
+        emb = None
+        if meta.get("has_emb"):
+            kind = meta.get("emb_dtype", "float32")
+            if kind == "float32":
+                emb = np.load(os.path.join(d, "emb.npy"), mmap_mode="r")
+            else:
+                emb = QuantizedEmbeddings.load(d, kind)
+        bm25 = BM25Index.load(d)
+        ann = IVFIndex.load(d, nprobe=ANN_NPROBE) if meta.get("has_ann") else None
+        r = RetrieverBM25(ChunkStore.load(d), bm25=bm25, emb=emb, files=files,
+                          norm_texts=StringArray.load(d, "norm"), ann=ann)
+        r.cache_key = key
+        return r
+    except Exception as e:
+        print(f"[cache] 读取索引缓存失败，改为重建：{e}")
+        return None
+
+def save_index_cache(key: str, retriever) -> str:
+    """先写临时目录再整体 rename，避免并发进程读到写了一半的缓存"""
+    final = _index_cache_path(key)
+    if os.path.isdir(final):
+        return final
+    tmp = f"{final}.tmp-{os.getpid()}"
+    os.makedirs(tmp, exist_ok=True)
+    try:
+        with open(os.path.join(tmp, "files.json"), "w", encoding="utf-8") as f:
+            json.dump(retriever.files, f, ensure_ascii=False)
+        norm = retriever.norm_texts
+        if not isinstance(norm, StringArray):
+            norm = StringArray.from_strings(norm)
+        norm.save(tmp, "norm")
+        retriever.chunks.save(tmp)
+        retriever.bm25.save(tmp)
+        if isinstance(retriever.emb, QuantizedEmbeddings):
+            retriever.emb.save(tmp)
+        elif retriever.emb is not None:
+            np.save(os.path.join(tmp, "emb.npy"), np.asarray(retriever.emb, dtype=np.float32))
+        if retriever.ann is not None:
+            retriever.ann.save(tmp)
+        meta = {
+            "key": key,
+            "version": INDEX_CACHE_VERSION,
+            "chunks": len(retriever.chunks),
+            "has_emb": retriever.emb is not None,
+            "emb_dtype": retriever.emb.kind if isinstance(retriever.emb, QuantizedEmbeddings) else "float32",
+            "has_ann": retriever.ann is not None,
+            "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        }
+        with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, final)
+    except OSError:
+        # 别的进程抢先写好了同一个 key，直接用它的
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.isdir(final):
+            raise
+    _prune_index_cache()
+    return final
+
+def _prune_index_cache():
+    """只保留最近 INDEX_CACHE_KEEP 份缓存"""
+    try:
+        dirs = [os.path.join(INDEX_CACHE_DIR, n) for n in os.listdir(INDEX_CACHE_DIR)
+                if n.startswith(f"v{INDEX_CACHE_VERSION}-") and ".tmp-" not in n]
+    except OSError:
+        return
+    dirs.sort(key=os.path.getmtime, reverse=True)
+    for d in dirs[INDEX_CACHE_KEEP:]:
+        shutil.rmtree(d, ignore_errors=True)
+
+def _report(progress, stage, done, total):
+    if progress is not None:
+        progress(stage, done, total)
+
+@contextlib.contextmanager
+def _index_build_lock():
+    """INDEX_SHARED 时同一缓存目录同时只让一个进程建索引，其余进程在这里等"""
+    if not INDEX_SHARED or fcntl is None:
+        yield
+        return
+    os.makedirs(INDEX_CACHE_DIR, exist_ok=True)
+    with open(os.path.join(INDEX_CACHE_DIR, ".build.lock"), "a") as f:
+        t0 = time.time()
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        waited = (time.time() - t0) * 1000
+        if waited >= 100:
+            print(f"[loader] 等待其他进程建索引 {waited:.0f} ms")
+        os.environ[_BUILD_OWNER_ENV] = str(os.getpid())
+        try:
+            yield
+        finally:
+            os.environ.pop(_BUILD_OWNER_ENV, None)
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def _spawned_by_index_build():
+    """是否是持有建索引锁的进程 spawn 出来的子进程（建索引进程 / 入库进程池 worker）"""
+    owner = os.environ.get(_BUILD_OWNER_ENV)
+    return bool(owner) and owner != str(os.getpid())
+
+def _mark_current(key):
+    """记下最新的索引 key（INDEX_CACHE_DIR/CURRENT），其他 worker 据此发现索引已更新"""
+    if not INDEX_SHARED:
+        return
+    path = os.path.join(INDEX_CACHE_DIR, "CURRENT")
+    tmp = f"{path}.tmp-{os.getpid()}"
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write(key)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"[cache] 更新 CURRENT 失败（不影响使用）：{e}")
+
+def current_index_key():
+    """CURRENT 里记的最新索引 key；没开共享或还没有时返回 None"""
+    if not INDEX_SHARED:
+        return None
+    try:
+        with open(os.path.join(INDEX_CACHE_DIR, "CURRENT"), "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def _release_heap():
+    """换成 mmap 的索引后，把建索引时用过的堆内存尽量还给系统（malloc_trim 只有 glibc 有）"""
+    gc.collect()
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+def _publish_index(key, retriever):
+    """
+    新建好的索引写缓存；INDEX_SHARED 时换成从缓存 mmap 加载的那份（与其他 worker 共享页缓存），
+    并更新 CURRENT。缓存写失败时仍返回内存里的这份。
+    """
+    _save_index_cache_quietly(key, retriever)
+    retriever.cache_key = key
+    if INDEX_SHARED:
+        shared = load_index_cache(key)
+        if shared is not None:
+            _mark_current(key)
+            del retriever
+            _release_heap()
+            return shared
+    return retriever
+
+# 建索引进程要沿用的运行时配置（切分 / 分词相关的见 _ingest_config）
+_BUILDER_GLOBALS = ("USE_SEMANTIC", "SEM_MODEL_NAME", "SEM_DEVICE", "EMB_DTYPE", "RETRIEVAL_MODE",
+                    "ANN_MIN_CHUNKS", "ANN_NPROBE", "ANN_REBUILD_RATIO", "INDEX_CACHE_DIR", "INDEX_CACHE_KEEP",
+                    "INGEST_WORKERS", "INGEST_MIN_BYTES", "INGEST_START_METHOD")
+
+def _index_builder_main(cfg, key, files):
+    """建索引进程入口：同步主进程的配置，建好索引写进缓存后退出"""
+    _ingest_worker_init(cfg["ingest"])
+    globals().update(cfg["globals"])
+    save_index_cache(key, _build_retriever(files))
+
+def _build_in_subprocess(key, files, progress=None):
+    """
+    INDEX_SHARED 且 KB 总量不小于 INGEST_MIN_BYTES 时，全量建索引放到独立进程里做：
+    切块、分词、编码的堆内存随建索引进程退出一起释放，服务进程只 mmap 建好的缓存。成功返回 True。
+    """
+    if not INDEX_SHARED or sum(f["size"] for f in files) < INGEST_MIN_BYTES:
+        return False
+    tokenizer.initialize()   # 词典缓存先在这里写好，建索引进程直接读
+    cfg = {"ingest": _ingest_config(), "globals": {k: globals()[k] for k in _BUILDER_GLOBALS}}
+    t0 = time.time()
+    _report(progress, "build", 0, 1)
+    p = multiprocessing.get_context(INGEST_START_METHOD).Process(
+        target=_index_builder_main, args=(cfg, key, files), name="index-builder")
+    p.start()
+    print(f"[loader] 建索引进程已启动（pid {p.pid}）")
+    p.join(INDEX_BUILD_TIMEOUT if INDEX_BUILD_TIMEOUT > 0 else None)
+    if p.is_alive():
+        # 卡住了（编码挂起、IO 阻塞等）：结束它，不能一直占着锁
+        p.terminate()
+        p.join(5)
+        if p.is_alive():
+            p.kill()
+            p.join()
+        shutil.rmtree(f"{_index_cache_path(key)}.tmp-{p.pid}", ignore_errors=True)
+        print(f"[loader] 建索引进程超过 {INDEX_BUILD_TIMEOUT:.0f}s 未完成，已结束，改在本进程建")
+        return False
+    if p.exitcode != 0:
+        print(f"[loader] 建索引进程异常退出（exitcode={p.exitcode}），改在本进程建")
+        return False
+    _report(progress, "build", 1, 1)
+    print(f"[loader] 建索引进程完成，用时 {time.time() - t0:.1f}s")
+    return True
+
+def _build_retriever(files, progress=None):
+    parts = ingest_files([f["path"] for f in files], progress=progress)
+    builder = ChunkStoreBuilder()
+    for p in parts:
+        builder.add_chunks(p["chunks"])
+    chunks = builder.build()
+    norm_texts = [t for p in parts for t in p["norm_texts"]]
+    print(f"[loader] 知识块加载完成：{len(chunks)} 段")
+    _report(progress, "index", len(files), len(files))
+    return RetrieverBM25(chunks, bm25=BM25Index.from_parts(parts), files=files, norm_texts=norm_texts)
+
+def get_retriever(use_cache=None, progress=None):
+    """
+    progress(stage, done, total)：可选的进度回调，供后台重建时上报进度。
+    多个 worker 同时启动时（INDEX_SHARED），只有拿到文件锁的那个建索引，其余等它写完缓存后直接加载。
+    在建索引锁持有者 spawn 出的子进程里返回 None（见下）。
+    """
+    if _spawned_by_index_build():
+        # spawn 的子进程启动时会重新 import 父进程的入口脚本（如 RAG_MODE=inproc 时的 python bridge_to_agent.py），
+        # 入口在模块顶层调 get_retriever 就会走到这里：父进程正拿着建索引锁等这个子进程，不能再去抢锁，也不该再建一遍
+        print("[loader] 建索引子进程：跳过入口脚本里的 get_retriever")
+        return None
+    if use_cache is None:
+        use_cache = USE_INDEX_CACHE
+    tokenizer.initialize()   # 启动时就把分词词典载好，命中索引缓存时首个查询也不用再等
+    t0 = time.time()
+    files = scan_kb_files()
+    key = kb_fingerprint(files) if use_cache else None
+    if not key:
+        return _build_retriever(files, progress)
+    r = load_index_cache(key)
+    if r is None:
+        with _index_build_lock():
+            r = load_index_cache(key)   # 等锁期间别的 worker 可能已经建好了
+            if r is None and _build_in_subprocess(key, files, progress):
+                r = load_index_cache(key)
+            if r is None:
+                return _publish_index(key, _build_retriever(files, progress))
+    print(f"[loader] 命中索引缓存：{len(r.chunks)} 段，用时 {(time.time() - t0) * 1000:.0f} ms")
+    _mark_current(key)
+    return r
+
+def _save_index_cache_quietly(key, retriever):
+    try:
+        save_index_cache(key, retriever)
+    except Exception as e:
+        print(f"[cache] 写入索引缓存失败（不影响使用）：{e}")
+
+def refresh_retriever(old, use_cache=None, progress=None):
+    """
+    增量 reload：按 mtime+size 快速比对、变了再核对 sha1，
+    只对新增/修改的文件重新切块、分词、编码；未变文件的块、向量行、BM25 postings 原样复用，
+    BM25 只对新增块统计词频，再重排 CSR、重算 idf。
+    INDEX_SHARED 时若别的 worker 已按同一批文件建好缓存，直接加载它（summary 的 mode 为 shared）。
+    旧检索器不会被修改（正在用它的请求不受影响），返回 (新检索器, 变更摘要)。
+    """
+    if use_cache is None:
+        use_cache = USE_INDEX_CACHE
+    t0 = time.time()
+    if old is None or getattr(old, "files", None) is None:
+        # 没有文件清单可比（比如首次加载失败），只能全量
+        r = get_retriever(use_cache=use_cache, progress=progress)
+        return r, {"mode": "full", "files_added": [f["source"] for f in r.files],
+                   "files_modified": [], "files_removed": [], "files_unchanged": 0,
+                   "chunks_added": len(r.chunks), "chunks_removed": len(old.chunks) if old else 0,
+                   "chunks_unchanged": 0, "elapsed_ms": int((time.time() - t0) * 1000)}
+
+    files = scan_kb_files(prev=old.files)
+    old_sha = {f["source"]: f["sha1"] for f in old.files}
+    new_srcs = {f["source"] for f in files}
+    added = [f["source"] for f in files if f["source"] not in old_sha]
+    modified = [f["source"] for f in files if f["source"] in old_sha and old_sha[f["source"]] != f["sha1"]]
+    removed = [src for src in old_sha if src not in new_srcs]
+    changed = set(added) | set(modified)
+
+    # 旧索引里每个文件占的块区间 [start, end)
+    spans = old.chunks.spans()
+
+    summary = {"mode": "incremental", "files_added": added, "files_modified": modified,
+               "files_removed": removed, "files_unchanged": len(files) - len(changed),
+               "chunks_added": 0, "chunks_removed": 0, "chunks_unchanged": 0}
+
+    if not changed and not removed and [f["source"] for f in files] == [f["source"] for f in old.files]:
+        old.files = files   # 只刷新 mtime，省得下次再读内容
+        summary["chunks_unchanged"] = len(old.chunks)
+        summary["elapsed_ms"] = int((time.time() - t0) * 1000)
+        return old, summary
+
+    for src in removed + modified:
+        start, end = spans.get(src, (0, 0))
+        summary["chunks_removed"] += end - start
+
+    key = kb_fingerprint(files) if use_cache else None
+    if not key:
+        r = _refresh_build(old, files, changed, spans, summary, progress)
+    else:
+        with _index_build_lock():
+            r = load_index_cache(key) if INDEX_SHARED else None
+            if r is None:
+                r = _publish_index(key, _refresh_build(old, files, changed, spans, summary, progress))
+            else:
+                new_spans = r.chunks.spans()
+                summary["mode"] = "shared"
+                summary["chunks_added"] = sum(e - s for src, (s, e) in new_spans.items() if src in changed)
+                summary["chunks_unchanged"] = len(r.chunks) - summary["chunks_added"]
+                _mark_current(key)
+    summary["elapsed_ms"] = int((time.time() - t0) * 1000)
+    print(f"[loader] 增量重建完成（{summary['mode']}）：+{summary['chunks_added']} / -{summary['chunks_removed']} 段，"
+          f"复用 {summary['chunks_unchanged']} 段，用时 {summary['elapsed_ms']} ms")
+    return r, summary
+
+def _refresh_build(old, files, changed, spans, summary, progress=None):
+    """refresh_retriever 的实际重建：变了的文件重新入库，其余从旧索引搬；块数计入 summary"""
+    need_emb = get_sem_model() is not None
+    remap = np.full(len(old.chunks), -1, dtype=np.int64)   # 旧块号 → 新块号
+    added_docs = []                                          # [(首个新块号, 逐文件统计)]
+    changed_paths = [f["path"] for f in files if f["source"] in changed]
+    fresh = dict(zip(changed_paths, ingest_files(changed_paths)))
+    builder = ChunkStoreBuilder()   # 未变文件的块按字节区间直接从旧存储搬过来
+    n_chunks, norm_texts, emb_parts = 0, [], []
+    for i, f in enumerate(files):
+        _report(progress, "files", i, len(files))
+        src = f["source"]
+        if src in changed:
+            ingested = fresh[f["path"]]
+            part, part_norm = ingested["chunks"], ingested["norm_texts"]
+            added_docs.append((n_chunks, ingested))
+            builder.add_chunks(part)
+            part_emb = encode_chunks(part, norm_texts=part_norm) if need_emb else None
+            summary["chunks_added"] += len(part)
+        else:
+            start, end = spans.get(src, (0, 0))
+            part_norm = old.norm_texts[start:end]
+            builder.add_range(old.chunks, start, end)
+            remap[start:end] = np.arange(n_chunks, n_chunks + end - start)
+            if not need_emb:
+                part_emb = None
+            elif old.emb is not None:
+                part_emb = old.emb[start:end]
+            else:
+                part_emb = encode_chunks(part_norm, norm_texts=part_norm)
+            summary["chunks_unchanged"] += end - start
+        n_chunks += len(part_norm)
+        norm_texts.extend(part_norm)
+        if part_emb is not None and len(part_emb):
+            emb_parts.append(part_emb)
+
+    _report(progress, "index", len(files), len(files))
+    chunks = builder.build()
+    emb = np.ascontiguousarray(np.vstack(emb_parts), dtype=np.float32) if emb_parts else None
+    bm25 = old.bm25.patched(remap, added_docs, n_chunks)
+    # 变动不大时向量索引沿用旧簇中心，只重新分簇，省掉 k-means
+    ann = build_ann(emb, old=old.ann, n_changed=summary["chunks_added"] + summary["chunks_removed"])
+    return RetrieverBM25(chunks, bm25=bm25, emb=emb, files=files, norm_texts=norm_texts, ann=ann)
+
+
+# ===================== 直接运行自测 =====================
+if __name__ == "__main__":
+    chunks = read_kb_chunks()
+    print(f"已加载知识块：{len(chunks)} 段")
+
+    retriever = RetrieverBM25(chunks)
+
+    queries = [
+        "您好用户名：jd_66d0a9851510b客户进线询问她的会员明天过期她兑换了洗车服务问洗车服务会随着会员过期而无法使用吗？",
+        "积分兑换的商品是否可以开发票",
+        "洗车多久过期",
+        "Q：为什么积分只有9分？A：……"
+    ]
+    for q in queries:
+        q_norm = normalize_text(q)
+        print("\n【问题】", q)
+        print("[debug] 归一后：", q_norm)
+        hits = retriever.retrieve(q_norm, topk=4)
+        for h in hits:
+            print(f"- 命中：{h['source']}#段{h['idx']}  分数={h['score']}")
+            print("  片段：", h["text"][:120].replace("\n", " "), "…")
+
+    # 导出示例
+    from datetime import datetime
+    ts = datetime.now().strftime("%Y%m%d_%H%M%S")
+    out_path = f"hits_{ts}.txt"
+    with open(out_path, "w", encoding="utf-8") as f:
+        for q in queries:
+            q_norm = normalize_text(q)
+            f.write(f"【问题】{q}\n")
+            hits = retriever.retrieve(q_norm, topk=4)
+            for i, h in enumerate(hits, 1):
+                text_full = h["text"].replace("\r", " ").replace("\n", " ")
+                f.write(f"[Top{i}] 来源：{h['source']}#段{h['idx']} | 分数={h['score']}\n")
+                f.write(text_full + "\n" + "=" * 80 + "\n")
+            f.write("\n")
+
+    print(f"已导出命中结果到：{out_path}")
+
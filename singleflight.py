@@ -0,0 +1,91 @@
+# singleflight.py —— 并发相同请求合并（single-flight）
+# 同一个 key 同时只跑一次上游调用，期间进来的相同请求等它的结果，不再各自调用
+#   SingleFlight      线程版（app.py 的同步接口用）
+#   AsyncSingleFlight 协程版（bridge 的异步接口用）
+
+import asyncio
+import threading
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0       # 总请求数
+        self.coalesced = 0   # 被合并（没有自己调上游）的请求数
+
+    def do(self, key, fn):
+        """
+        执行 fn() 并返回结果；若同 key 的调用正在进行，则等待并返回它的结果（异常也一并抛出）。
+        返回 (结果, 是否被合并)。
+        """
+        with self._lock:
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.done.set()
+        return call.result, False
+
+    def stats(self):
+        with self._lock:
+            return {"calls": self.calls, "executed": self.calls - self.coalesced,
+                    "coalesced": self.coalesced, "in_flight": len(self._calls)}
+
+
+class AsyncSingleFlight:
+    """
+    协程版：上游调用放在独立的 Task 里，所有等待者 shield 住它，
+    某个请求被取消（客户端断开）不会连带取消其它人正在等的调用。
+    """
+
+    def __init__(self):
+        self._tasks = {}
+        self.calls = 0
+        self.coalesced = 0
+
+    async def do(self, key, fn):
+        """fn 为无参协程函数；返回 (结果, 是否被合并)"""
+        self.calls += 1
+        task = self._tasks.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            task = asyncio.ensure_future(fn())
+            self._tasks[key] = task
+
+            def _done(t, key=key):
+                if self._tasks.get(key) is t:
+                    del self._tasks[key]
+            task.add_done_callback(_done)
+        return await asyncio.shield(task), shared
+
+    def stats(self):
+        return {"calls": self.calls, "executed": self.calls - self.coalesced,
+                "coalesced": self.coalesced, "in_flight": len(self._tasks)}
@@ -0,0 +1,45 @@
+# IVF 近似检索：关键词规则过滤（mask）很严时仍要返回足够的块
+import numpy as np
+
+from ann_index import IVFIndex, exact_search
+
+
+def _unit(rng, n, dim):
+    x = rng.standard_normal((n, dim)).astype(np.float32)
+    return x / np.linalg.norm(x, axis=1, keepdims=True)
+
+
+def test_restrictive_mask_returns_k():
+    rng = np.random.default_rng(0)
+    emb = _unit(rng, 4000, 32)
+    ivf = IVFIndex.build(emb, nprobe=2)
+    q = _unit(rng, 1, 32)[0]
+    mask = np.zeros(len(emb), dtype=bool)
+    mask[rng.choice(len(emb), 40, replace=False)] = True
+
+    ids, sims = ivf.search(emb, q, 10, mask=mask)
+    assert len(ids) == 10
+    assert mask[ids].all()
+    assert np.all(np.diff(sims) <= 0)
+
+
+def test_mask_smaller_than_k_matches_exact():
+    rng = np.random.default_rng(1)
+    emb = _unit(rng, 4000, 32)
+    ivf = IVFIndex.build(emb, nprobe=1)
+    q = _unit(rng, 1, 32)[0]
+    mask = np.zeros(len(emb), dtype=bool)
+    mask[rng.choice(len(emb), 5, replace=False)] = True
+
+    ids, _ = ivf.search(emb, q, 10, mask=mask)
+    ref, _ = exact_search(emb, q, 10, mask=mask)
+    assert ids.tolist() == ref.tolist()
+
+
+def test_unmasked_search_unchanged():
+    rng = np.random.default_rng(2)
+    emb = _unit(rng, 4000, 32)
+    ivf = IVFIndex.build(emb, nprobe=4)
+    q = _unit(rng, 1, 32)[0]
+    ids, _ = ivf.search(emb, q, 10)
+    assert len(ids) == 10
@@ -0,0 +1,59 @@
+import random
+
+import numpy as np
+import pytest
+
+from rag_step1_bm25 import BM25Index
+
+rank_bm25 = pytest.importorskip("rank_bm25")
+
+VOCAB = ["洗车", "年卡", "积分", "退款", "过期", "门店", "会员", "的", "了", "天", "a", "b"]
+
+
+def _corpus(rng, n_docs):
+    # 前几个词出现得很频繁，保证有负 idf（走 epsilon 下限）的词；
+    # 块不会是空的（空块在 b=1 时 BM25Okapi 会算出 0/0=nan）
+    weights = [30, 20, 10] + [1] * (len(VOCAB) - 3)
+    return [rng.choices(VOCAB, weights=weights, k=rng.randint(1, 12)) for _ in range(n_docs)]
+
+
+def _queries(rng):
+    qs = [[], ["不在词表里"], VOCAB[:], ["洗车", "洗车", "年卡"]]
+    qs += [rng.choices(VOCAB + ["未登录词"], k=rng.randint(1, 6)) for _ in range(10)]
+    return qs
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("k1,b", [(1.5, 0.75), (1.2, 0.0), (2.0, 1.0)])
+def test_scores_match_rank_bm25(seed, k1, b):
+    rng = random.Random(seed)
+    corpus = _corpus(rng, rng.randint(1, 60))
+    ref = rank_bm25.BM25Okapi(corpus, k1=k1, b=b)
+    idx = BM25Index.from_tokenized(corpus, k1=k1, b=b)
+    assert idx.average_idf == ref.average_idf
+
+    queries = _queries(rng)
+    batch = idx.get_scores_batch(queries)
+    for row, q in enumerate(queries):
+        expected = ref.get_scores(q)
+        got = idx.get_scores(q)
+        np.testing.assert_array_equal(got, expected)
+        np.testing.assert_array_equal(batch[row], expected)
+
+        n = rng.randint(1, len(corpus))
+        order = np.argsort(-expected, kind="stable")[:n]
+        ids, vals = idx.top_n(q, n)
+        np.testing.assert_array_equal(ids, order)
+        np.testing.assert_array_equal(vals, expected[order])
+
+        docs = rng.sample(range(len(corpus)), rng.randint(0, len(corpus)))
+        np.testing.assert_array_equal(idx.score_docs(q, docs), expected[docs])
+
+
+def test_with_params_matches_fresh_index():
+    rng = random.Random(7)
+    corpus = _corpus(rng, 40)
+    base = BM25Index.from_tokenized(corpus, k1=1.5, b=0.75).with_params(1.2, 0.3)
+    ref = rank_bm25.BM25Okapi(corpus, k1=1.2, b=0.3)
+    for q in _queries(rng):
+        np.testing.assert_array_equal(base.get_scores(q), ref.get_scores(q))
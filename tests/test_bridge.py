@@ -0,0 +1,130 @@
+# Bridge 端到端：RAG 与 Coze 都用 httpx.MockTransport 假装，走真实的 FastAPI 路由
+import json
+
+import httpx
+import pytest
+from fastapi.testclient import TestClient
+
+import bridge_to_agent as bridge
+
+HITS = [{"rank": 1, "score": 3.2, "source": "faq.txt", "idx": 1, "text": "洗车服务自兑换之日起 30 天内有效。"}]
+
+
+@pytest.fixture
+def upstream(monkeypatch):
+    calls = {"rag": 0, "coze": 0}
+
+    def handler(request):
+        if request.url.path.endswith("/ask_debug"):
+            calls["rag"] += 1
+            return httpx.Response(200, json={"hits": HITS})
+        calls["coze"] += 1
+        return httpx.Response(200, json={"messages": [
+            {"role": "assistant", "type": "answer", "content": "30 天内有效。"}]})
+
+    clients = {}
+
+    def fake_http(name):
+        if name not in clients:
+            clients[name] = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        return clients[name]
+
+    monkeypatch.setattr(bridge, "_http", fake_http)
+    monkeypatch.setattr(bridge, "RAG_MODE", "http")
+    monkeypatch.setattr(bridge, "COZE_API_TOKEN", "token")
+    monkeypatch.setattr(bridge, "COZE_BOT_ID", "bot")
+    bridge._answer_mem.clear()
+    return calls
+
+
+def test_bridge_ask_end_to_end(upstream):
+    with TestClient(bridge.app) as client:
+        r = client.post("/bridge/ask", json={"question": "洗车多久过期", "topk": 4})
+    assert r.status_code == 200
+    body = r.json()
+    assert body["ok"] is True
+    assert "洗车服务" in body["context"]
+    assert body["coze_result"]["final"] == "30 天内有效。"
+    assert upstream == {"rag": 1, "coze": 1}
+
+
+def test_bridge_ask_check_mode_skips_coze(upstream):
+    with TestClient(bridge.app) as client:
+        r = client.post("/bridge/ask", json={"question": "洗车多久过期", "mode": "check"})
+    assert r.json()["stage"] == "check_only"
+    assert upstream == {"rag": 1, "coze": 0}
+
+
+def _sse_final(text):
+    events = [block.split("\n", 1) for block in text.strip().split("\n\n")]
+    return [json.loads(data[len("data: "):]) for head, data in events if head == "event: final"][0]
+
+
+def test_cache_hit_reports_via_cache(upstream, monkeypatch):
+    monkeypatch.setattr(bridge, "BRIDGE_CACHE", True)
+    with TestClient(bridge.app) as client:
+        first = client.post("/bridge/ask", json={"question": "洗车多久过期"}).json()["coze_result"]
+        again = client.post("/bridge/ask", json={"question": "洗车多久过期"}).json()["coze_result"]
+        stream = _sse_final(client.post("/bridge/ask-stream", json={"question": "洗车多久过期"}).text)
+    assert first["via"] == "force_pick_last_assistant" and not first.get("cached")
+    assert again["via"] == "cache" and again["cached"] is True
+    assert stream["via"] == "cache" and stream["cached"] is True
+    assert stream["final"] == again["final"] == "30 天内有效。"
+    assert upstream["coze"] == 1
+
+
+def test_rag_coalesces_identical_questions_only(monkeypatch):
+    import asyncio
+
+    calls = []
+
+    async def handler(request):
+        calls.append(json.loads(request.content)["question"])
+        await asyncio.sleep(0.05)
+        return httpx.Response(200, json={"hits": HITS})
+
+    async def run():
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        monkeypatch.setattr(bridge, "_http", lambda name: client)
+        monkeypatch.setattr(bridge, "RAG_MODE", "http")
+        try:
+            return await asyncio.gather(*(bridge.call_local_rag(q, topk=4)
+                                          for q in ("PLUS会员怎么续费", " PLUS会员怎么续费 ", "plus会员怎么续费",
+                                                    "PLUS会员怎么续费？")))
+        finally:
+            await client.aclose()
+
+    results = asyncio.run(run())
+    # 只差首尾空白的合并；大小写、标点不同的检索结果可能不同，各查各的
+    assert sorted(calls) == sorted(["PLUS会员怎么续费", "plus会员怎么续费", "PLUS会员怎么续费？"])
+    assert all(r["hits"] == HITS for r in results)
+
+
+@pytest.mark.parametrize("setting,expected", [("0", 0), ("1", 1), ("sync", 1)])
+def test_inproc_startup_respects_sem_preload(monkeypatch, setting, expected):
+    from types import SimpleNamespace
+
+    calls = []
+    fake = SimpleNamespace(SEM_PRELOAD=setting, preload_sem_model=lambda background: calls.append(background))
+    monkeypatch.setattr(bridge, "rag_service", fake)
+    with TestClient(bridge.app):
+        pass
+    assert len(calls) == expected
+
+
+def test_batch_with_short_rag_response_reports_every_question(monkeypatch):
+    def handler(request):
+        if request.url.path.endswith("/ask_batch"):
+            return httpx.Response(200, json={"results": [{"hits": HITS}]})   # 3 个问题只回了 1 条
+        return httpx.Response(200, json={"messages": [
+            {"role": "assistant", "type": "answer", "content": "30 天内有效。"}]})
+
+    clients = {}
+    monkeypatch.setattr(bridge, "_http", lambda name: clients.setdefault(
+        name, httpx.AsyncClient(transport=httpx.MockTransport(handler))))
+    monkeypatch.setattr(bridge, "RAG_MODE", "http")
+    with TestClient(bridge.app) as client:
+        body = client.post("/bridge/ask_batch", json={"questions": ["洗车多久过期", "积分", "年卡退款"]}).json()
+    assert body["count"] == 3
+    assert [r["question"] for r in body["results"]] == ["洗车多久过期", "积分", "年卡退款"]
+    assert all(r["ok"] is False and "RAG批量调用失败" in r["error"] for r in body["results"])
@@ -0,0 +1,133 @@
+import os
+import random
+import re
+
+import pytest
+
+import rag_step1_bm25 as rag
+from rag_step1_bm25 import _Q_PAT, _SENT_SPLIT, _is_blank, _is_heading
+
+
+# ===================== 参考实现：流式改造前的整段读入版 =====================
+def _ref_clean_text(s):
+    s = s.replace("\ufeff", "").replace("\u200b", "")
+    s = re.sub(r"\?{3,}", "", s)
+    s = re.sub(r"[·•◦\t]+", " ", s)
+    s = s.replace("\r\n", "\n").replace("\r", "\n")
+    return s.strip()
+
+
+def _ref_split_into_paragraphs(text, chunk_size):
+    parts, cur, qa_buf = [], [], []
+    in_qa = False
+
+    def flush(buf):
+        s = "\n".join(buf).strip()
+        if s:
+            parts.append(s)
+
+    for ln in _ref_clean_text(text).split("\n"):
+        if _is_heading(ln):
+            if in_qa:
+                flush(qa_buf)
+                qa_buf, in_qa = [], False
+            flush(cur)
+            cur = [ln]
+        elif _is_blank(ln):
+            if in_qa:
+                flush(qa_buf)
+                qa_buf, in_qa = [], False
+            else:
+                flush(cur)
+                cur = []
+        elif _Q_PAT.match(ln):
+            if in_qa:
+                flush(qa_buf)
+            else:
+                flush(cur)
+                cur = []
+            qa_buf, in_qa = [ln], True
+        elif in_qa:
+            qa_buf.append(ln)   # A 行或补充说明
+        else:
+            cur.append(ln)
+    flush(qa_buf if in_qa else cur)
+
+    paragraphs = []
+    for p in parts:
+        if len(p) <= chunk_size:
+            paragraphs.append(p)
+            continue
+        buf = ""
+        for s in _SENT_SPLIT.split(p):
+            if len(buf) + len(s) <= chunk_size:
+                buf += s
+            else:
+                if buf:
+                    paragraphs.append(buf.strip())
+                buf = s
+        if buf:
+            paragraphs.append(buf.strip())
+    return paragraphs
+
+
+def _ref_read_file_chunks(path, chunk_size, overlap):
+    with open(path, "r", encoding="utf-8", errors="ignore") as f:
+        paras = _ref_split_into_paragraphs(f.read(), chunk_size)
+    blocks, cur = [], ""
+    for para in paras:
+        if not cur:
+            cur = para
+        elif len(cur) + 2 + len(para) <= chunk_size:
+            cur = cur + "\n\n" + para
+        else:
+            blocks.append(cur.strip())
+            cur = para
+    if cur:
+        blocks.append(cur.strip())
+    chunks = []
+    for i, blk in enumerate(blocks):
+        chunks.append({"text": blk, "source": os.path.basename(path), "idx": i + 1})
+        if i < len(blocks) - 1 and overlap > 0:
+            blocks[i + 1] = (blk[-overlap:] if len(blk) > overlap else blk) + "\n\n" + blocks[i + 1]
+    return chunks
+
+
+# ===================== 随机输入 =====================
+ATOMS = ["洗车", "积分", "。", "；", "！", "?", "？", "???", "??", "\u200b", "\ufeff", "·", "•", "\t",
+         " ", "  ", "\n", "\n", "\n", "\n\n", "\r\n", "\r", "\r\u200b\n", "1. ", "1.2 ", "（一）", "一、",
+         "- ", "Q：", "A：", "问：", "答:", "\x0c", "abc", "会员过期后不可使用", "x" * 40]
+
+
+def _gen(rng, n):
+    return "".join(rng.choice(ATOMS) for _ in range(n))
+
+
+@pytest.mark.parametrize("seed", range(8))
+def test_streaming_chunker_matches_reference(seed, tmp_path, monkeypatch):
+    rng = random.Random(seed)
+    path = tmp_path / "kb.txt"
+    for _ in range(150):
+        cs, ov = rng.choice([(20, 5), (50, 0), (80, 30), (500, 150), (30, 40)])
+        monkeypatch.setattr(rag, "CHUNK_SIZE", cs)
+        monkeypatch.setattr(rag, "CHUNK_OVERLAP", ov)
+        text = _gen(rng, rng.randint(0, 200))
+        assert rag.split_into_paragraphs(text) == _ref_split_into_paragraphs(text, cs)
+
+        path.write_bytes(text.encode("utf-8"))
+        if rng.random() < 0.2:   # 非法 utf-8 字节
+            with open(path, "ab") as f:
+                f.write(b"\xff\xfe\xe6\xb4" + "尾巴".encode())
+        assert rag.read_file_chunks(str(path)) == _ref_read_file_chunks(str(path), cs, ov)
+
+
+def test_long_paragraph_is_split_without_buffering_whole_file(tmp_path, monkeypatch):
+    # 一个没有空行的超长段：输出仍与整段读入版一致，且块是边读边产出的
+    monkeypatch.setattr(rag, "CHUNK_SIZE", 50)
+    monkeypatch.setattr(rag, "CHUNK_OVERLAP", 10)
+    path = tmp_path / "long.txt"
+    path.write_text("会员洗车卡三十天内有效。\n" * 2000, encoding="utf-8")
+    it = rag.iter_file_chunks(str(path))
+    first = next(it)
+    assert first["idx"] == 1 and len(first["text"]) <= 50
+    assert [first, *it] == _ref_read_file_chunks(str(path), 50, 10)
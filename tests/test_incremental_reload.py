@@ -0,0 +1,94 @@
+import random
+
+import numpy as np
+import pytest
+
+import rag_step1_bm25 as rag
+
+WORDS = ["洗车", "积分", "会员", "年卡", "退款", "过期", "门店", "核销码", "兑换", "发票", "续费", "开卡",
+         "三十天", "不支持", "可以", "需要", "权益", "体检"]
+QUERIES = ["洗车多久过期", "积分兑换的体检是否支持开发票", "会员续约怎么开通", "年卡退款", "核销码在哪里看"]
+
+
+def _doc(rng, n_qa):
+    lines = []
+    for i in range(n_qa):
+        q = "".join(rng.choices(WORDS, k=rng.randint(2, 5)))
+        a = "，".join("".join(rng.choices(WORDS, k=rng.randint(2, 6))) for _ in range(rng.randint(1, 6)))
+        lines.append(f"Q：{q}？\nA：{a}。" if rng.random() < 0.7 else f"{i + 1}. {q}：{a}。")
+    return "\n\n".join(lines) + "\n"
+
+
+def _snapshot(r):
+    return {
+        "files": [(f["source"], f["sha1"]) for f in r.files],
+        "chunks": [(c["source"], c["idx"], c["text"]) for c in r.chunks],
+        "norm_texts": list(r.norm_texts),
+        "hits": [r.retrieve(q, topk=6) for q in QUERIES],
+    }
+
+
+def _assert_same_as_full_build(r):
+    fresh = rag.get_retriever(use_cache=False)
+    assert _snapshot(r) == _snapshot(fresh)
+    for q in QUERIES:
+        toks = rag.tokenizer.cut(rag.normalize_query(q))
+        np.testing.assert_allclose(r.bm25.get_scores(toks), fresh.bm25.get_scores(toks), rtol=1e-12, atol=0)
+    assert r.bm25.avgdl == fresh.bm25.avgdl
+
+
+@pytest.fixture
+def kb(tmp_path, monkeypatch):
+    kb_dir = tmp_path / "kb"
+    kb_dir.mkdir()
+    monkeypatch.setattr(rag, "KB_DIR", str(kb_dir))
+    monkeypatch.setattr(rag, "INDEX_CACHE_DIR", str(tmp_path / "index_cache"))
+    monkeypatch.setattr(rag, "USE_SEMANTIC", False)
+    monkeypatch.setattr(rag.tokenizer, "cache_dir", str(tmp_path / "tokenizer_cache"))
+    return kb_dir
+
+
+@pytest.mark.parametrize("use_cache", [False, True])
+@pytest.mark.parametrize("seed", range(3))
+def test_reload_matches_full_rebuild(kb, seed, use_cache):
+    rng = random.Random(seed)
+    for name in "abcde":
+        (kb / f"{name}.txt").write_text(_doc(rng, rng.randint(1, 12)), encoding="utf-8")
+    r = rag.get_retriever(use_cache=use_cache)
+
+    # 改一个（追加）、删一个、加一个
+    with open(kb / "a.txt", "a", encoding="utf-8") as f:
+        f.write("\n" + _doc(rng, 3))
+    (kb / "c.txt").unlink()
+    (kb / "f.txt").write_text(_doc(rng, 5), encoding="utf-8")
+    r, summary = rag.refresh_retriever(r, use_cache=use_cache)
+    assert (summary["files_added"], summary["files_modified"], summary["files_removed"]) == (["f.txt"], ["a.txt"], ["c.txt"])
+    _assert_same_as_full_build(r)
+
+    # 整个重写一个文件（块数变化），再把一个文件清空
+    (kb / "b.txt").write_text(_doc(rng, rng.randint(1, 20)), encoding="utf-8")
+    (kb / "d.txt").write_text("", encoding="utf-8")
+    r, summary = rag.refresh_retriever(r, use_cache=use_cache)
+    assert sorted(summary["files_modified"]) == ["b.txt", "d.txt"]
+    assert summary["chunks_unchanged"] + summary["chunks_added"] == len(r.chunks)
+    _assert_same_as_full_build(r)
+
+    # 没有变化：原样返回
+    again, summary = rag.refresh_retriever(r, use_cache=use_cache)
+    assert again is r and summary["chunks_unchanged"] == len(r.chunks)
+
+
+def test_reload_picks_up_index_built_by_another_worker(kb):
+    rng = random.Random(42)
+    for name in "abc":
+        (kb / f"{name}.txt").write_text(_doc(rng, 6), encoding="utf-8")
+    r1 = rag.get_retriever(use_cache=True)
+    r2 = rag.get_retriever(use_cache=True)
+
+    (kb / "b.txt").write_text(_doc(rng, 9), encoding="utf-8")
+    r1, s1 = rag.refresh_retriever(r1, use_cache=True)
+    r2, s2 = rag.refresh_retriever(r2, use_cache=True)
+    assert s1["mode"] == "incremental" and s2["mode"] == "shared"
+    assert s2["chunks_added"] == s1["chunks_added"]
+    assert _snapshot(r2) == _snapshot(r1)
+    _assert_same_as_full_build(r2)
@@ -0,0 +1,84 @@
+import random
+import re
+
+import pytest
+
+import rag_step1_bm25 as rag
+from multi_match import KeywordMatcher, ReplaceChain
+
+
+def _rs(rng, alpha, lo, hi):
+    return "".join(rng.choice(alpha) for _ in range(rng.randint(lo, hi)))
+
+
+def _ref_normalize(s, stopwords, synonyms):
+    """改造前 normalize_text 的逐条 replace 写法"""
+    for sw in stopwords:
+        s = s.replace(sw, " ")
+    s = re.sub(r"[^\u4e00-\u9fa5A-Za-z0-9，。；：、\-\(\)（）/ ]+", " ", s)
+    for k, v in synonyms.items():
+        s = s.replace(k, v)
+    return re.sub(r"\s{2,}", " ", s).strip()
+
+
+# 字母表很小，规则之间大量重叠、互为前后缀、替换结果又能拼出别的键
+ALPHABETS = ["ab", "abc", "ab ", "发放下", "abcd"]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_replace_chain_matches_chained_replace(seed):
+    rng = random.Random(seed)
+    for _ in range(300):
+        alpha = rng.choice(ALPHABETS)
+        rules = [(_rs(rng, alpha, 1, 3), _rs(rng, alpha, rng.choice([0, 1, 1, 1]), 4))
+                 for _ in range(rng.randint(1, 6))]
+        if rng.random() < 0.05:
+            rules.append(("", "x"))
+        chain = ReplaceChain(rules)
+        for _ in range(5):
+            s = _rs(rng, alpha + "xy", 0, 25)
+            ref = s
+            for k, v in rules:
+                ref = ref.replace(k, v)
+            assert chain.apply(s) == ref, (rules, s)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_keyword_matcher_matches_in(seed):
+    rng = random.Random(seed)
+    for _ in range(300):
+        alpha = rng.choice(ALPHABETS)
+        pats = [_rs(rng, alpha, 0, 3) for _ in range(rng.randint(1, 6))]
+        matcher = KeywordMatcher(pats)
+        for _ in range(5):
+            s = _rs(rng, alpha + "xy", 0, 25)
+            assert matcher.find(s) == {p for p in pats if p in s}, (pats, s)
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_normalizer_matches_chained_replace(seed, monkeypatch):
+    rng = random.Random(seed)
+    alpha = "发放下开卡续约费 a!？"
+    for _ in range(100):
+        stop = [_rs(rng, alpha, 1, 3) for _ in range(rng.randint(0, 5))]
+        syn = {_rs(rng, alpha, 1, 3): _rs(rng, alpha, 0, 3) for _ in range(rng.randint(0, 5))}
+        monkeypatch.setattr(rag, "STOPWORDS", stop)
+        monkeypatch.setattr(rag, "SYNONYMS", syn)
+        for _ in range(5):
+            s = _rs(rng, alpha + "xy\n\t", 0, 30)
+            assert rag.normalize_text(s) == _ref_normalize(s, stop, syn), (stop, syn, s)
+
+
+def test_normalizer_default_rules_and_in_place_edits(monkeypatch):
+    texts = ["您好用户名：jd_66d0a9851510b客户进线询问她的会员明天过期", "请问题：发放优惠卷",
+             "发放下发开通续约", "Q：为什么积分只有9分？A：……", ""]
+    for t in texts:
+        assert rag.normalize_text(t) == _ref_normalize(t, rag.STOPWORDS, rag.SYNONYMS)
+
+    # 规则列表原地修改后，编译好的匹配器要跟着重建
+    monkeypatch.setattr(rag, "STOPWORDS", list(rag.STOPWORDS))
+    monkeypatch.setattr(rag, "SYNONYMS", dict(rag.SYNONYMS))
+    rag.STOPWORDS.append("会员")
+    rag.SYNONYMS["积分"] = "分数"
+    for t in texts:
+        assert rag.normalize_text(t) == _ref_normalize(t, rag.STOPWORDS, rag.SYNONYMS)
@@ -0,0 +1,22 @@
+import os
+
+import jieba
+
+from tokenizer import JiebaTokenizer
+
+
+def test_rebuild_prunes_stale_caches(tmp_path):
+    stale = tmp_path / "jieba-0000000000000000.marshal"
+    stale.write_bytes(b"old")
+    other = tmp_path / "keep-me.txt"
+    other.write_text("x")
+
+    tok = JiebaTokenizer(["洗车卡"], cache_dir=str(tmp_path), tk=jieba.Tokenizer())
+    tok.initialize()
+    assert tok.source == "build"
+    assert sorted(os.listdir(tmp_path)) == sorted([os.path.basename(tok.cache_path()), "keep-me.txt"])
+
+    again = JiebaTokenizer(["洗车卡"], cache_dir=str(tmp_path), tk=jieba.Tokenizer())
+    again.initialize()
+    assert again.source == "cache"
+    assert again.cut("洗车卡多久过期") == tok.cut("洗车卡多久过期")
@@ -0,0 +1,126 @@
+# tokenizer.py —— jieba 分词封装：预建词典缓存 + 业务词一次性加载
+# 作用：jieba 首次分词要建前缀词典（约 1 秒），原来每个进程 import 时还要再逐个 add_word 业务词。
+#       这里把“默认词典 + 业务词（含词频）”建好后的 FREQ / total 整体 marshal 到本地缓存文件，
+#       之后每个进程（uvicorn worker、并行入库的进程池 worker）直接读入，分词结果与原来逐个 add_word 完全一致。
+#       初始化在明确的位置触发（rag_step1_bm25.get_retriever / 进程池 worker 初始化），分词统一走 cut()。
+
+import os
+import time
+import marshal
+import hashlib
+import tempfile
+import threading
+
+import jieba
+
+TOKENIZER_CACHE_DIR = os.getenv("TOKENIZER_CACHE_DIR", "./.tokenizer_cache")
+_CACHE_FORMAT = 1   # 缓存内容格式有变化就 +1
+
+
+class JiebaTokenizer:
+    """
+    words：业务词列表（初始化时读取其当前内容），freq：业务词词频（与原来的 jieba.add_word(w, freq=100) 一致）。
+    默认操作 jieba 的全局分词器 jieba.dt，所以直接调用 jieba.cut 的地方也能看到业务词。
+    """
+
+    def __init__(self, words, freq=100, cache_dir=None, tk=None):
+        self.words = words
+        self.freq = freq
+        self.cache_dir = cache_dir or TOKENIZER_CACHE_DIR
+        self.tk = tk or jieba.dt
+        self._lock = threading.Lock()
+        self.ready = False
+        self.load_ms = None
+        self.source = None   # cache / build / shared（分词器已被别处初始化过）
+
+    def _key(self):
+        h = hashlib.sha1()
+        dict_path = self.tk.dictionary   # None 表示 jieba 自带的默认词典
+        stamp = None
+        if dict_path and os.path.isfile(dict_path):
+            st = os.stat(dict_path)
+            stamp = (st.st_size, st.st_mtime_ns)
+        h.update(repr((_CACHE_FORMAT, jieba.__version__, dict_path, stamp,
+                       list(self.words), self.freq)).encode("utf-8"))
+        return h.hexdigest()
+
+    def cache_path(self, key=None):
+        return os.path.join(self.cache_dir, f"jieba-{(key or self._key())[:16]}.marshal")
+
+    def initialize(self):
+        """加载词典（命中缓存直接读入，否则建好后写缓存）；重复调用无开销"""
+        if self.ready:
+            return
+        with self._lock:
+            if self.ready:
+                return
+            t0 = time.time()
+            if self.tk.initialized:
+                # 已被别处初始化（比如直接调过 jieba.cut），只补业务词
+                for w in self.words:
+                    self.tk.add_word(w, freq=self.freq)
+                self.source = "shared"
+            else:
+                key = self._key()
+                path = self.cache_path(key)
+                if self._load(path, key):
+                    self.source = "cache"
+                else:
+                    self.tk.initialize()
+                    for w in self.words:
+                        self.tk.add_word(w, freq=self.freq)
+                    self._dump(path, key)
+                    self.source = "build"
+            self.load_ms = int((time.time() - t0) * 1000)
+            self.ready = True
+            print(f"[tokenizer] 分词词典就绪（{self.source}），用时 {self.load_ms} ms")
+
+    def _load(self, path, key):
+        try:
+            # 整个读进来再 loads：比 marshal.load(文件) 逐段读快好几倍（jieba 自带缓存就是后者）
+            with open(path, "rb") as f:
+                saved_key, freq, total = marshal.loads(f.read())
+        except (OSError, EOFError, ValueError, TypeError):
+            return False
+        if saved_key != key:
+            return False
+        with self.tk.lock:
+            self.tk.FREQ, self.tk.total = freq, total
+            self.tk.initialized = True
+        return True
+
+    def _dump(self, path, key):
+        """先写临时文件再 rename，多个进程同时建也不会读到半个文件"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            with os.fdopen(fd, "wb") as f:
+                marshal.dump((key, self.tk.FREQ, self.tk.total), f)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[tokenizer] 写入词典缓存失败（不影响使用）：{e}")
+            return
+        self._prune(path)
+
+    def _prune(self, keep):
+        """业务词 / 词典一变 key 就变，旧的 jieba-*.marshal 不会再被读到，只保留当前这一份"""
+        try:
+            names = os.listdir(self.cache_dir)
+        except OSError:
+            return
+        for n in names:
+            p = os.path.join(self.cache_dir, n)
+            if n.startswith("jieba-") and n.endswith(".marshal") and p != keep:
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+
+    def cut(self, text):
+        if not self.ready:
+            self.initialize()
+        return self.tk.lcut(text)
+
+    def status(self):
+        return {"ready": self.ready, "source": self.source, "load_ms": self.load_ms,
+                "words": len(self.words)}
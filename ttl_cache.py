@@ -0,0 +1,160 @@
+# ttl_cache.py —— 进程内 LRU + TTL 缓存（线程安全）
+# 作用：缓存重复问题的检索结果 / 桥接答案；按条数和估算字节数双重上限淘汰最久未用的条目
+# SQLiteTTLCache 为可选的持久化版本（桥接答案缓存用，重启不丢）
+
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    max_entries：最多条数；max_bytes：估算占用上限（put 时由调用方给出每条大小）；
+    ttl：秒，<=0 表示不过期。任一上限 <=0 表示不限制该项。
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=0, ttl=0):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._data = OrderedDict()   # key -> (过期时间戳, 大小, 值)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            expire_at, size, value = item
+            if expire_at and expire_at <= now:
+                del self._data[key]
+                self._bytes -= size
+                self.expired += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=0):
+        if self.max_bytes > 0 and size > self.max_bytes:
+            return   # 单条就超上限，不缓存
+        expire_at = time.monotonic() + self.ttl if self.ttl > 0 else 0
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (expire_at, size, value)
+            self._bytes += size
+            while self._data and ((self.max_entries > 0 and len(self._data) > self.max_entries)
+                                  or (self.max_bytes > 0 and self._bytes > self.max_bytes)):
+                _, (_, sz, _) = self._data.popitem(last=False)
+                self._bytes -= sz
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expired": self.expired,
+            }
+
+
+class SQLiteTTLCache:
+    """
+    与 TTLCache 接口相同的持久化版本（SQLite 单文件），进程重启后仍可命中。
+    值按 JSON 存储；超过 max_entries 时按最近使用时间淘汰最旧的条目。
+    """
+
+    def __init__(self, path, max_entries=10000, ttl=0):
+        import sqlite3
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        d = os.path.dirname(os.path.abspath(path))
+        os.makedirs(d, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS cache ("
+                         "key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                         "expire_at REAL NOT NULL, last_used REAL NOT NULL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS cache_last_used ON cache(last_used)")
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+
+    def get(self, key, default=None):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT value, expire_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return default
+            value, expire_at = row
+            if expire_at and expire_at <= now:
+                self._db.execute("DELETE FROM cache WHERE key = ?", (key,))
+                self.expired += 1
+                self.misses += 1
+                return default
+            self._db.execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+            self.hits += 1
+        return json.loads(value)
+
+    def put(self, key, value, size=0):
+        now = time.time()
+        expire_at = now + self.ttl if self.ttl > 0 else 0
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO cache (key, value, expire_at, last_used) "
+                             "VALUES (?, ?, ?, ?)", (key, data, expire_at, now))
+            if self.max_entries > 0:
+                n = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+                if n > self.max_entries:
+                    self._db.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache "
+                                     "ORDER BY last_used LIMIT ?)", (n - self.max_entries,))
+                    self.evictions += n - self.max_entries
+
+    def clear(self):
+        with self._lock:
+            self._db.execute("DELETE FROM cache")
+
+    def stats(self):
+        with self._lock:
+            n = self._db.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+            total = self.hits + self.misses
+            return {
+                "path": self.path,
+                "entries": n,
+                "max_entries": self.max_entries,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "evictions": self.evictions,
+                "expired": self.expired,
+            }